@@ -1,30 +1,238 @@
+import json
+import asyncio
+from concurrent.futures import Future
+
 import bentoml
-import threading
-from mqtt.listener import start
+from bentoml.exceptions import BadInput, ServiceUnavailable
+from mqtt import listener
+from mqtt.async_listener import AsyncListener, RUNTIME
 with bentoml.importing():
-    from core.batch_writer import BatchWriter 
+    from core.batch_writer import BatchWriter, QUEUE_FILE, DRAIN_TIMEOUT
+    from core.async_batch_writer import AsyncBatchWriter
+    from core.mqtt_publisher import DEAD_LETTER_FILE
+    from core.edge_proccesor import PUBLISHED_ALERTS
+    from core.state_cache import FleetState
+    from core.sharding import Shard, SHARD_WORKERS
+    from core.edge_pool import EdgePool, EDGE_WORKERS
+    from core.metrics import WriterMetrics
 
 '''
-We set the number of workers to 1 to ensure that we have a single instance of the MQTT listener and batch writer running
-Wich simplifies the handling of the disk queue and retries
-If we wanted to scale the service horizontally, we would need to implement a distributed locking mechanism to ensure that only one instance is flushing
-the disk queue at a time, and to handle the retries in a distributed way (for example, using a distributed task queue)
+Every worker owns one shard: a partition of the devices (by a hash of the device id in the topic, or balanced
+by the broker with an MQTT v5 shared subscription when MQTT_SHARED_GROUP is set) with its own disk queue file
+and its own flusher thread. Workers never touch each other's files, so the service scales across cores
+(SHARD_WORKERS) and containers (SHARD_COUNT / SHARD_OFFSET) without any distributed lock.
+With a shared subscription the broker balances messages round-robin, so a device is not owned by one shard
+(see Shard.per_device). Bulk readings (/ingest) carry no device and are written by the shard that receives them.
+With the default configuration (1 shard) it behaves as a single instance.
 '''
 
-@bentoml.service(workers=1) 
+# "topic" of the dead letters of the bulk ingestion (the MQTT ones carry the topic of the message)
+INGEST_TOPIC = "/ingest"
+# Content-Type of the NDJSON bodies of the bulk ingestion, any other body must be a JSON array
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+class RawBody(bentoml.IODescriptor):
+
+    '''Input of the bulk ingestion: BentoML does not parse the body, the API reads it from the request context.'''
+
+    @classmethod
+    async def from_http_request(cls, request, serde):
+        return cls()
+
+
+def parse_ingest_body(body: bytes, content_type: str | None = None):
+    '''
+     Payloads of a bulk ingestion body: a JSON array, or one JSON document per line with Content-Type
+     application/x-ndjson. Returns (payloads, parse_errors), parse_errors maps the index of a line that is
+     not JSON to the line. A body that is not a JSON array is a BadInput (400).
+    '''
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    payloads = []
+    parse_errors = {}
+    if media_type == NDJSON_CONTENT_TYPE:
+        for line in body.decode(errors="replace").splitlines():
+            if not line.strip():
+                continue
+            try:
+                payloads.append(json.loads(line))
+            except ValueError:
+                parse_errors[len(payloads)] = line
+                payloads.append(None)
+        return payloads, parse_errors
+
+    try:
+        payloads = json.loads(body or b"[]")
+    except ValueError:
+        raise BadInput("The body is not valid JSON")
+    if not isinstance(payloads, list):
+        raise BadInput(f"Expected a JSON array of readings, or one reading per line with Content-Type {NDJSON_CONTENT_TYPE}")
+    return payloads, parse_errors
+
+
+@bentoml.service(workers=SHARD_WORKERS)
 class MQTTService:
 
     '''
      Service class that initializes the MQTT listener and the batch writer. The MQTT listener will receive messages from the devices,
      enrich them with additional information (like the device_id and a timestamp) and send them to the batch writer,
-     wich will handle the logic of sending the record to PocketBase, 
+     wich will handle the logic of sending the record to PocketBase,
      handling retries in case of failures, and sending failed record to an error topic in MQTT if they fail after the maximum number of retries.
     '''
 
     def __init__(self):
-        # Get instance of BatchWriter
-        self.batch_writer = BatchWriter()
+        # Shard owned by this worker
+        self.shard = Shard.from_worker(bentoml.server_context.worker_index)
+
+        # Same edge processor as the listener, so bulk and MQTT readings share the per-sensor statistics
+        self.edge_processor = listener.edge_processor
+
+        # Last value of every sensor, for the live fleet status endpoints
+        self.state = FleetState()
+
+        files = {
+            "queue_file": self.shard.queue_file(QUEUE_FILE),
+            "dead_letter_file": self.shard.queue_file(DEAD_LETTER_FILE),
+            "metrics": WriterMetrics(self.shard.name),
+        }
+        self.batch_writer = (AsyncBatchWriter if RUNTIME == "asyncio" else BatchWriter)(**files).start()
+
+        # Edge processing in worker processes (EDGE_WORKERS), the results come back in micro-batches
+        self.edge_pool = None
+        if EDGE_WORKERS:
+            self.edge_pool = EdgePool().start(
+                lambda items: listener.deliver(self.batch_writer, self.state, items)
+            )
+
+        if RUNTIME == "asyncio":
+            # MQTT socket, flusher and sends on one event loop (mqtt/async_listener.py)
+            self.async_listener = AsyncListener(self.batch_writer, self.shard, self.state, self.edge_pool).start()
+            self.mqtt_client = self.async_listener.client
+        else:
+            self.async_listener = None
+            # Start the listener in background (paho network thread)
+            self.mqtt_client = listener.start(self.batch_writer, self.shard, self.state, self.edge_pool)
+
+    @bentoml.api(input_spec=RawBody)
+    async def ingest(self, ctx: bentoml.Context) -> dict:
+        '''
+         Bulk ingestion for gateways that already aggregate readings. Accepts the same payloads as the MQTT topic,
+         as a JSON array or as NDJSON (Content-Type application/x-ndjson), see parse_ingest_body.
+         All the accepted records are written to disk in a single append and the rejected payloads go to the error
+         topic, like the MQTT ones. Returns the result of every item, in order.
+        '''
+        payloads, parse_errors = parse_ingest_body(await ctx.request.body(), ctx.request.headers.get("content-type"))
+        # The edge processing and the disk append block: they run in a thread, not on the event loop of the server
+        return await asyncio.to_thread(self._ingest, payloads, parse_errors)
+
+    def _ingest(self, payloads, parse_errors):
+        # With EDGE_WORKERS the readings are processed by the worker of their sensor, like the MQTT readings
+        processor = self.edge_pool or self.edge_processor
+        items = []
+        results = []
+        # Item of every result, to report the outcome of its disk append
+        result_items = []
+        for index, (payload, (result, reason)) in enumerate(zip(payloads, processor.process_batch(payloads))):
+            if index in parse_errors:
+                payload, reason = parse_errors[index], "invalid_json"
+            if not result:
+                # Same as the MQTT listener: rejected payloads go to the error topic
+                self.batch_writer.publisher.publish_dead_letter(
+                    {"topic": INGEST_TOPIC, "payload": payload}, f"invalid: {reason}"
+                )
+            elif not result.get("normal_record"):
+                # Invalid value: only the *_invalid alert is stored
+                reason = result["alerts"][0]["type"]
+            items.append({
+                "index": index,
+                "status": "rejected" if reason else "accepted",
+                "message_id": payload.get("message_id") if isinstance(payload, dict) else None,
+                "reason": reason,
+            })
+            if result:
+                results.append(result)
+                result_items.append(items[-1])
+
+        if results:
+            outcomes = self.batch_writer.add_many(results)
+            if isinstance(outcomes, Future):
+                # AsyncBatchWriter: the append runs in its disk executor
+                outcomes = outcomes.result()
+            for item, result, outcome in zip(result_items, results, outcomes):
+                if outcome and item["status"] == "accepted":
+                    item["status"] = "duplicate" if outcome == "duplicate" else "failed"
+                    item["reason"] = outcome
+                if outcome == "duplicate":
+                    # Already stored (and its alerts published) when it was first received
+                    continue
+                self.state.update_from(result)
+                for alert in result.get("alerts", []):
+                    if alert["type"] in PUBLISHED_ALERTS:
+                        self.batch_writer.publisher.publish_alert(alert)
+
+        counts = {status: 0 for status in ("accepted", "rejected", "duplicate", "failed")}
+        for item in items:
+            counts[item["status"]] += 1
+        return {
+            "accepted": counts["accepted"],
+            "rejected": counts["rejected"],
+            "duplicates": counts["duplicate"],
+            "failed": counts["failed"],
+            "items": items,
+        }
+
+    def _fleet_state(self):
+        '''
+         FleetState of this worker. The cache and its version counter live in one process: with several workers
+         in this container a request would get the devices of a random shard, and a fleet_delta version from
+         another worker would give wrong deltas, so the endpoints are refused (run one worker per container).
+         They are refused too with a shared subscription: the readings of a device are split between the shards.
+        '''
+        if SHARD_WORKERS > 1:
+            raise ServiceUnavailable(
+                f"Fleet status needs one worker per container (SHARD_WORKERS={SHARD_WORKERS}), see SHARD_OFFSET"
+            )
+        if not self.shard.per_device:
+            raise ServiceUnavailable("Fleet status is not available with MQTT_SHARED_GROUP (devices are not sharded)")
+        return self.state
+
+    @bentoml.api
+    def fleet(self) -> dict:
+        '''
+         Live status of the fleet: last value of every sensor grouped by device (AGV), from memory.
+         Only with one worker per container: it knows the devices of its shard (the response includes the shard).
+        '''
+        return {"shard": self.shard.name, **self._fleet_state().snapshot()}
+
+    @bentoml.api
+    def fleet_delta(self, since: int = 0) -> dict:
+        '''Sensors updated after the version "since" (the "version" of a previous fleet/fleet_delta response).'''
+        return {"shard": self.shard.name, **self._fleet_state().delta(since)}
+
+    @bentoml.api
+    def sensor_stats(self, sensor: str) -> dict:
+        '''Streaming statistics of a numeric sensor (count, mean, std, ewma, rolling min/max) in this worker.'''
+        if self.edge_pool:
+            # The statistics live in the edge process that owns the sensor
+            return {"shard": self.shard.name, "sensor": sensor, "stats": self.edge_pool.sensor_stats(sensor)}
+        return {"shard": self.shard.name, "sensor": sensor, "stats": self.edge_processor.stats.get(sensor)}
+
+    @bentoml.api
+    def stats(self) -> dict:
+        '''Current values of the batch writer of this worker (shard).'''
+        return {"shard": self.shard.name, **self.batch_writer.stats()}
 
-        # Start the listener on a thread
-        thread = threading.Thread(target=start, args=(self.batch_writer,), daemon=True)
-        thread.start()
\ No newline at end of file
+    @bentoml.on_shutdown
+    def shutdown(self):
+        '''
+         Called by BentoML on SIGTERM. Stop receiving messages, upload the disk backlog within DRAIN_TIMEOUT seconds
+         and disconnect. Whatever is not uploaded stays on disk for the next start.
+        '''
+        if self.async_listener:
+            self.async_listener.stop(drain_timeout=DRAIN_TIMEOUT)
+            return
+        listener.pause(self.mqtt_client)
+        if self.edge_pool:
+            self.edge_pool.stop()
+        self.batch_writer.stop(drain_timeout=DRAIN_TIMEOUT)
+        listener.stop(self.mqtt_client)
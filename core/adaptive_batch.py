@@ -0,0 +1,58 @@
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_MIN = int(os.getenv("BATCH_SIZE_MIN", 1))
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", 1000))
+# Benthos round trip (seconds) under which the batch keeps growing
+BATCH_TARGET_LATENCY = float(os.getenv("BATCH_TARGET_LATENCY", 1.0))
+BATCH_SIZE_STEP = int(os.getenv("BATCH_SIZE_STEP", 10))
+BATCH_SIZE_BACKOFF = float(os.getenv("BATCH_SIZE_BACKOFF", 0.5))
+
+
+class AdaptiveBatchSize:
+
+    '''
+        AIMD controller for the batch size sent to Benthos.
+        While the round trip stays under the target latency and the batches are full (there is backlog)
+        the size grows by a fixed step; on errors or slow responses it is multiplied by the backoff factor.
+        With a trickle of messages batches are never full, so the size does not grow without reason.
+    '''
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = BATCH_SIZE_MIN,
+        maximum: int = BATCH_SIZE_MAX,
+        target_latency: float = BATCH_TARGET_LATENCY,
+        step: int = BATCH_SIZE_STEP,
+        backoff: float = BATCH_SIZE_BACKOFF,
+    ):
+        if not 1 <= minimum <= maximum:
+            raise ValueError(f"Límites de batch inválidos: {minimum}-{maximum}")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.step = step
+        self.backoff = backoff
+        self.value = min(max(initial, minimum), maximum)
+        self.last_latency = 0.0
+        # Batches can be sent from several threads (backfill)
+        self._lock = threading.Lock()
+
+    def record(self, size: int, latency: float, ok: bool):
+        '''Update the batch size with the result of sending a batch of size records.'''
+        with self._lock:
+            self.last_latency = latency
+            previous = self.value
+
+            if not ok or latency > self.target_latency:
+                self.value = max(self.minimum, int(self.value * self.backoff))
+            elif size >= self.value:
+                self.value = min(self.maximum, self.value + self.step)
+
+        if self.value != previous:
+            logger.debug("Batch size %s -> %s (latencia %.3fs, ok=%s)", previous, self.value, latency, ok)
+        return self.value
@@ -0,0 +1,217 @@
+# core/async_batch_writer.py
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from core.batch_writer import (
+    BatchWriter, BENTHOS_URL, BENTHOS_TIMEOUT, FLUSH_INTERVAL, MAX_RETRIES, BASE_DELAY, MAX_DELAY, DRAIN_TIMEOUT,
+)
+from core.pocketbase_client import PB_URL
+
+logger = logging.getLogger(__name__)
+
+# Batches sent to Benthos at the same time by the asyncio runtime
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", 4))
+
+
+class AsyncBatchWriter(BatchWriter):
+
+    """
+    BatchWriter for the asyncio runtime (RUNTIME=asyncio, see mqtt/async_listener.py).
+    Same disk queue, dedup, retention and per-record outcomes, but the flusher is a coroutine instead of a thread:
+    ASYNC_CONCURRENCY batches are sent at the same time with httpx.AsyncClient, the retries wait with
+    asyncio.sleep and every disk operation runs in a single-thread executor, so the event loop never waits
+    for the disk and the disk operations keep their order.
+    """
+
+    def __init__(self, mqtt_client=None, queue_file=None, dead_letter_file=None, metrics=None,
+                 concurrency=ASYNC_CONCURRENCY):
+        super().__init__(mqtt_client, queue_file, dead_letter_file, metrics)
+        self.concurrency = concurrency
+        self.disk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-queue")
+        self.http = None
+
+    def start(self):
+        """Open the disk queue. The flusher is run() on the event loop."""
+        self._open()
+        return self
+
+    # ===============================
+    # PUBLIC: Agregar registro
+    # ===============================
+    def add(self, processed: dict):
+        """Queue the disk append in the disk executor. Called from the MQTT callbacks, on the event loop."""
+        self.disk_executor.submit(self._add, processed)
+
+    def _add(self, processed):
+        try:
+            BatchWriter.add(self, processed)
+        except Exception as e:
+            logger.error(f"Error añadiendo registro al disco: {e}")
+
+    def add_many(self, results):
+        """
+        Queue the single disk append of a bulk ingestion in the disk executor, after the records already queued.
+        Returns a future with the outcome of every result (see BatchWriter.add_many).
+        """
+        return self.disk_executor.submit(self._add_many, results)
+
+    def _add_many(self, results):
+        try:
+            return BatchWriter.add_many(self, results)
+        except Exception as e:
+            logger.error(f"Error añadiendo registros al disco: {e}")
+            return ["disk_write_failed"] * len(results)
+
+    async def _disk(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.disk_executor, fn, *args)
+
+    # ===============================
+    # LOOP DISCO -> DB
+    # ===============================
+    async def run(self):
+        """Flusher coroutine: the asyncio version of _disk_retry_loop. Cancel it to stop, then drain()."""
+        self.http = httpx.AsyncClient(timeout=BENTHOS_TIMEOUT + 2)
+        while self.running:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self._disk(self._export_metrics)
+                if not await self._disk(self.disk.count):
+                    continue
+                await self._disk(self.retention.enforce, self.disk, self.lock)
+                if not await self._is_db_alive_async():
+                    logger.warning("DB caída, esperando para subir registros del disco...")
+                    continue
+                await self._flush_async()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el flusher asyncio: {e}")
+
+    async def drain(self, drain_timeout=DRAIN_TIMEOUT):
+        """
+        Upload the disk backlog before drain_timeout seconds, after run() was cancelled. The asyncio version of stop().
+        Returns the number of records still pending on disk.
+        """
+        if not self.running:
+            return 0
+        deadline = time.monotonic() + drain_timeout
+        self.running = False
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=BENTHOS_TIMEOUT + 2)
+
+        if await self._is_db_alive_async(min(3, drain_timeout)):
+            await self._flush_async(deadline)
+        # Publish (or spill to disk) the dead letters still in memory
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.publisher.stop(timeout=max(deadline - time.monotonic(), 1))
+        )
+
+        pending = await self._disk(self.disk.count)
+        await self._disk(self.disk.close)
+        await self.http.aclose()
+        self.disk_executor.shutdown(wait=False)
+        if pending:
+            logger.warning(f"Parada con {pending} registros pendientes en disco.")
+        else:
+            logger.info("BatchWriter parado, cola de disco vacía.")
+        return pending
+
+    async def _flush_async(self, deadline=None):
+        """
+        Upload the disk backlog: every round reads `concurrency` batches from the head of the queue,
+        sends them at the same time and acks them together (the acks of the queue are in order).
+        """
+        remaining = await self._disk(self.disk.count)
+        while remaining > 0:
+            if deadline is None and not self.running:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("Tiempo de drenado agotado")
+                return
+            step = self.batch_size.value
+            size = min(step * self.concurrency, remaining)
+            records = await self._disk(self._read, size)
+            remaining -= size
+
+            batches = [records[i:i + step] for i in range(0, len(records), step)]
+            results = await asyncio.gather(*(self._send_async(batch, deadline) for batch in batches))
+
+            sent_ids = {r.get("message_id") for sent_records in results for r in sent_records}
+            unsent = [r for r in records if r.get("message_id") not in sent_ids]
+            await self._disk(self._requeue, unsent, size)
+            await self._disk(self._export_metrics)
+
+    def _read(self, size):
+        with self.lock:
+            return self.disk.read(size)
+
+    def _requeue(self, unsent, size):
+        # Same order as _flush: the records not sent go back to the tail before the ack
+        with self.lock:
+            self.disk.append(unsent)
+            self.disk.ack(size)
+
+    # ===============================
+    # DB Health Check
+    # ===============================
+    async def _is_db_alive_async(self, timeout=3):
+        try:
+            response = await self.http.get(f"{PB_URL}/api/health", timeout=timeout)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    # ===============================
+    # Enviar batch con retries
+    # ===============================
+    async def _send_async(self, batch, deadline=None):
+        """The asyncio version of _send_with_retry_batch. Returns the records that can be removed from disk."""
+        pending, encoded, failed = self._encode(batch)
+        sent = []
+        attempt = 0
+        loop = asyncio.get_running_loop()
+
+        while pending and attempt < MAX_RETRIES:
+            timeout = BENTHOS_TIMEOUT + 2
+            if deadline is not None:
+                # While draining no request outlives the deadline
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    return sent + failed
+            started = time.monotonic()
+            try:
+                # The token manager can block while it renews the token
+                headers = await loop.run_in_executor(None, self._benthos_headers)
+                payload_str = "[" + ",".join(encoded[message_id] for message_id in pending) + "]"
+                response = await self.http.post(BENTHOS_URL, content=payload_str, headers=headers, timeout=timeout)
+                if response.status_code in (200, 201):
+                    size = len(pending)
+                    retryable = self._apply_outcomes(response, pending, sent, failed)
+                    self.batch_size.record(size, time.monotonic() - started, not retryable)
+                    logger.info(f"Batch enviado a Benthos ({size - len(pending)}/{size} registros)")
+                    if not pending:
+                        return sent + failed
+                    logger.warning(f"{len(pending)} registros fallidos, se reintentan solo esos")
+                else:
+                    self.batch_size.record(len(pending), time.monotonic() - started, False)
+                    logger.error("Error enviando a Benthos: %s %s", response.status_code, response.text)
+                attempt += 1
+                delay = min(BASE_DELAY * (2 ** attempt), MAX_DELAY)
+            except Exception as e:
+                self.batch_size.record(len(pending), time.monotonic() - started, False)
+                attempt += 1
+                delay = min(BASE_DELAY * (2 ** attempt), MAX_DELAY)
+                logger.warning(f"Retry {attempt} a Benthos en {delay}s: {e}")
+
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                return sent + failed
+            await asyncio.sleep(delay)
+
+        for r in pending.values():
+            self._send_to_error_topic(r, "max_retries_exceeded")
+        return sent + failed + list(pending.values())
@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core.batch_writer import BatchWriter, COLLECTION_READINGS, COLLECTION_URGENT
+from core.edge_proccesor import EdgeProcessor
+from core.schema import InvalidReading, READING_TYPES
+from core.utils import RecentIds
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 5
+
+
+class Backfill:
+
+    '''
+        Replay / backfill of records after an incident:
+
+            python -m core.backfill data/dead_letters.shard-0.log errors_dump.jsonl old_pending_readings.log --rate 5000
+
+        Every input file is JSON lines, any mix of:
+        - disk queue files (pending_readings.log): stored readings and alerts
+        - dead letter spill files: {"record": ..., "reason": ..., "failed_at": ...}
+        - dumps of MQTT_ERROR_TOPIC: envelopes {"count": ..., "dead_letters": [...], "sent_at": ...}
+        Raw payloads rejected by the listener ({"topic", "payload"}) go through the EdgeProcessor as new readings.
+        Stored readings are validated again by the EdgeProcessor keeping their message_id (its alerts are not generated
+        again, the original alerts are in the same sources) and stored alerts are sent as they are.
+        Records are sent straight to Benthos with BatchWriter.send (per-record outcomes and retries), without the
+        disk queue. Records rejected by the EdgeProcessor or by the sink go to the failed file (the dead letter spill
+        file of the writer, replayable with this tool) and only the records acked by the sink count as sent.
+        Duplicated message_ids are skipped, the position of every file is saved in the checkpoint file after
+        every batch is sent (a new run resumes from there) and the throughput is logged every REPORT_INTERVAL seconds.
+    '''
+
+    def __init__(self, writer=None, processor=None, batch: int = 500, rate: float = 0, concurrency: int = 4,
+                 checkpoint: str = None, dedup_window: int = 1_000_000):
+        self.writer = writer or BatchWriter(dead_letter_file="backfill_failed.log")
+        self.processor = processor or EdgeProcessor()
+        self.batch = batch
+        self.rate = rate
+        self.concurrency = concurrency
+        self.checkpoint = checkpoint
+        self.positions = self._load_checkpoint()
+        self.seen = RecentIds(dedup_window)
+        self.counts = {"read": 0, "sent": 0, "failed": 0, "duplicates": 0, "rejected": 0}
+        self.started = None
+        self._last_report = 0
+
+    # ===============================
+    # CHECKPOINT
+    # ===============================
+
+    def _load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint, "r") as f:
+            return json.load(f)
+
+    def _save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.positions, f)
+        os.replace(tmp, self.checkpoint)
+
+    # ===============================
+    # RECORDS
+    # ===============================
+
+    @staticmethod
+    def unwrap(item):
+        '''Records inside a line of any source: envelopes, dead letters or stored records.'''
+        if isinstance(item, dict) and isinstance(item.get("dead_letters"), list):
+            for dead_letter in item["dead_letters"]:
+                yield from Backfill.unwrap(dead_letter)
+        elif isinstance(item, dict) and isinstance(item.get("record"), dict):
+            yield item["record"]
+        elif isinstance(item, dict):
+            yield item
+
+    def prepare(self, record):
+        '''(records ready for the sink, None), or ([], reason) if the EdgeProcessor rejects the record.'''
+        if "payload" in record and "topic" in record:
+            # Raw payload rejected by the listener: a new reading
+            payload = record["payload"]
+            result, reason = self.processor.process_payload(payload) if isinstance(payload, dict) else (None, "not_an_object")
+            if not result:
+                return [], reason or "invalid_reading"
+            records = [result["normal_record"]] if result.get("normal_record") else []
+            records += result.get("alerts", [])
+        elif record.get("type") in READING_TYPES:
+            # Stored reading: validated against the schema of its stored type (the sensor ids of this host may
+            # differ from the ones that stored it), normalized (epoch ms times) and with the same message_id
+            payload = {"sensor": record.get("sensor"), "value": record.get("value")}
+            if record.get("time") is not None:
+                payload["timestamp"] = record["time"]
+            if record.get("message_id"):
+                payload["message_id"] = record["message_id"]
+            try:
+                sensor_type = self.processor.validator.validate(payload, record["type"])
+            except InvalidReading as e:
+                return [], str(e)
+            result = self.processor.process_reading(payload, sensor_type=sensor_type, sensor_id=payload["sensor"])
+            if not result:
+                return [], "invalid_reading"
+            normal = result["normal_record"]
+            if normal and "samples" in record:
+                # Aggregate of the downsample retention policy
+                normal.update({k: record[k] for k in ("min", "max", "samples") if k in record})
+            records = [normal or result["alerts"][0]]
+        else:
+            # Stored alert, as it is
+            records = [record]
+
+        for r in records:
+            reading = r.get("type") in READING_TYPES
+            r["_collection"] = COLLECTION_READINGS if reading else r.get("_collection") or COLLECTION_URGENT
+        return records, None
+
+    def records(self, path):
+        '''(records, end offset) of every line of path after the checkpoint.'''
+        offset = self.positions.get(path, 0)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                if not line.endswith(b"\n"):
+                    # Torn last line (file still being written): not read nor checkpointed
+                    return
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Línea inválida en {path}: {line[:100]!r}")
+                    yield [], offset
+                    continue
+                records = []
+                for record in self.unwrap(item):
+                    self.counts["read"] += 1
+                    message_id = record.get("message_id")
+                    if message_id and not self.seen.add(message_id):
+                        self.counts["duplicates"] += 1
+                        continue
+                    prepared, reason = self.prepare(record)
+                    if reason:
+                        self.counts["rejected"] += 1
+                        logger.warning(f"Registro rechazado ({reason}): {record}")
+                        self.writer.publisher.publish_dead_letter(record, f"invalid: {reason}")
+                    records.extend(prepared)
+                yield records, offset
+
+    # ===============================
+    # RUN
+    # ===============================
+
+    def run(self, paths):
+        '''Send every file. Returns the counters.'''
+        self.started = time.monotonic()
+        self.writer.publisher.start()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for path in paths:
+                self._run_file(path, pool)
+        # Rejected and failed records end in the spill file of the publisher (--failed), replayable with this tool
+        self.writer.publisher.stop()
+        self.report(final=True)
+        return self.counts
+
+    def _run_file(self, path, pool):
+        in_flight = deque()
+        batch, end = [], None
+        for records, offset in self.records(path):
+            batch.extend(records)
+            end = offset
+            if len(batch) >= self.batch:
+                in_flight.append((pool.submit(self._send, batch), end))
+                batch = []
+                # Bounded number of batches in flight, checkpointed in order
+                while len(in_flight) >= self.concurrency:
+                    self._complete(path, in_flight.popleft())
+        if end is not None:
+            in_flight.append((pool.submit(self._send, batch), end))
+        while in_flight:
+            self._complete(path, in_flight.popleft())
+
+    def _send(self, batch):
+        if not batch:
+            return [], []
+        return self.writer.send(batch)
+
+    def _complete(self, path, item):
+        future, end = item
+        sent, failed = future.result()
+        self.counts["sent"] += len(sent)
+        self.counts["failed"] += len(failed)
+        self.positions[path] = end
+        self._save_checkpoint()
+        self._throttle()
+        self.report()
+
+    def _throttle(self):
+        if self.rate > 0:
+            ahead = self.counts["sent"] / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self._last_report < REPORT_INTERVAL:
+            return
+        self._last_report = now
+        elapsed = max(now - self.started, 1e-9)
+        c = self.counts
+        logger.info(
+            f"Backfill{' terminado' if final else ''}: {c['read']} leídos, {c['sent']} enviados "
+            f"({c['sent'] / elapsed:.0f}/s), {c['failed']} fallidos, {c['duplicates']} duplicados, "
+            f"{c['rejected']} rechazados"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay dead letters, error topic dumps and old disk queues")
+    parser.add_argument("files", nargs="+", help="JSON lines files (disk queue, dead letters or error topic dump)")
+    parser.add_argument("--rate", type=float, default=0, help="Max records per second (0: no limit)")
+    parser.add_argument("--batch", type=int, default=500, help="Records per batch sent to Benthos")
+    parser.add_argument("--concurrency", type=int, default=4, help="Batches in flight")
+    parser.add_argument("--checkpoint", default="backfill.checkpoint", help="Progress file to resume")
+    parser.add_argument("--failed", default="backfill_failed.log", help="Records rejected or that could not be sent")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    writer = BatchWriter(dead_letter_file=args.failed)
+    counts = Backfill(writer, batch=args.batch, rate=args.rate, concurrency=args.concurrency,
+                      checkpoint=args.checkpoint).run(args.files)
+    json.dump(counts, sys.stdout)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,28 +5,42 @@ import threading
 import time
 import logging
 import requests
-from datetime import datetime
 
-from core.pocketbase_client import PocketBaseClient
+from core.pocketbase_client import PocketBaseClient, PB_URL
 from core.disk_queue import DiskQueue
+from core.mqtt_publisher import MQTTPublisher
+from core.adaptive_batch import AdaptiveBatchSize
+from core.benthos_config import SHARED_SETTINGS
+from core.retention import Retention
+from core.utils import RecentIds, format_times
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 COLLECTION_READINGS = os.getenv("COLLECTION_READINGS")
 COLLECTION_URGENT = os.getenv("COLLECTION_URGENT")
-MQTT_ERROR_TOPIC = os.getenv("MQTT_ERROR_TOPIC")
 
+# Initial batch size, then adapted to the Benthos latency (see core/adaptive_batch.py)
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 5))
 FLUSH_INTERVAL = int(os.getenv("FLUSH_INTERVAL", 5))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", 5))
-BASE_DELAY = float(os.getenv("BASE_DELAY", 1))
-MAX_DELAY = float(os.getenv("MAX_DELAY", 10))
+# Defaults shared with core/benthos.yaml (retry_period, max_retry_backoff and the http_server timeout)
+BASE_DELAY = float(os.getenv("BASE_DELAY", SHARED_SETTINGS["BASE_DELAY"]))
+MAX_DELAY = float(os.getenv("MAX_DELAY", SHARED_SETTINGS["MAX_DELAY"]))
 QUEUE_FILE = os.getenv("QUEUE_FILE")
 # TODO: BENTHOS_URL es una variable crítica para el funcionamiento del sistema
 # pero no está definida en .env.example ni en el bloque environment del
 # docker-compose.yml. Añadirla en ambos sitios para evitar confusión.
 BENTHOS_URL = os.getenv("BENTHOS_URL")
+# Seconds Benthos has to answer a batch (rendered into core/benthos.yaml by core/benthos_config.py).
+# The request waits a bit longer, so a slow batch gets the Benthos answer instead of a client timeout
+BENTHOS_TIMEOUT = float(os.getenv("BENTHOS_TIMEOUT", SHARED_SETTINGS["BENTHOS_TIMEOUT"]))
+# 4xx answers from PocketBase that can succeed if retried (auth, timeout, rate limit)
+RETRYABLE_CODES = (401, 403, 408, 429)
+# Number of recent message_ids remembered to drop duplicates
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 100000))
+# Max seconds to upload the backlog when the service is stopped (SIGTERM)
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 25))
 
 
 class BatchWriter:
@@ -35,20 +49,87 @@ class BatchWriter:
     via Benthos 4.27. Filter normal_record = None and send alerts to "urgent_alerts" collection
     """
 
-    def __init__(self, mqtt_client=None):
-        self.mqtt_client = mqtt_client
+    def __init__(self, mqtt_client=None, queue_file=None, dead_letter_file=None, metrics=None):
+        # Construction is cheap and has no side effects: the disk queue is opened
+        # and the flusher thread started only in start()
+        self.queue_file = queue_file or QUEUE_FILE
+        # Alerts and failed records are published from the publisher thread
+        self.publisher = MQTTPublisher(mqtt_client, spill_file=dead_letter_file)
         self.lock = threading.Lock()
-        self.running = True
+        self.running = False
+        self._wakeup = threading.Event()
+
+        self.batch_size = AdaptiveBatchSize(BATCH_SIZE)
+        self.recent_ids = RecentIds(DEDUP_WINDOW)
+        # Limits of the disk backlog (QUEUE_MAX_*), urgent alerts are never dropped
+        self.retention = Retention(keep=lambda record: record.get("_collection") == COLLECTION_URGENT)
+        self.write_errors = 0
+        # Prometheus gauges of the shard (core.metrics.WriterMetrics), set by the flusher
+        self.metrics = metrics
 
         self.pb = PocketBaseClient()
-        self.disk = DiskQueue(QUEUE_FILE)
+        self.disk = None
+        self.disk_thread = None
+
+    # ===============================
+    # LIFECYCLE
+    # ===============================
+    def start(self):
+        """Open the disk queue and start the flusher thread. Calling it twice does nothing."""
+        if self._open():
+            self.disk_thread = threading.Thread(target=self._disk_retry_loop, daemon=True)
+            self.disk_thread.start()
+        return self
+
+    def _open(self):
+        """Open the disk queue and start the publisher. Returns False if it was already running."""
+        with self.lock:
+            if self.running:
+                return False
+            # Every shard has its own queue file (see core/sharding.py)
+            self.disk = DiskQueue(self.queue_file)
+            self.running = True
+            self._wakeup.clear()
+
+        # The newest records on disk are part of the dedup window (the rest of the backlog is not parsed)
+        for record in self.disk.tail(DEDUP_WINDOW):
+            self.recent_ids.add(record.get("message_id"))
+        pending = self.disk.count()
+        if pending:
+            logger.info(f"Recuperados {pending} registros pendientes en disco.")
+
+        self.publisher.start()
+        return True
+
+    def stop(self, drain_timeout=DRAIN_TIMEOUT):
+        """
+        Stop the flusher thread and try to upload the disk backlog before drain_timeout seconds.
+        Records that could not be sent stay on disk for the next start. Returns the number of pending records.
+        """
+        if not self.running:
+            return 0
+        deadline = time.monotonic() + drain_timeout
+
+        self.running = False
+        self._wakeup.set()
+        if self.disk_thread:
+            self.disk_thread.join(timeout=max(deadline - time.monotonic(), 0))
+            if self.disk_thread.is_alive():
+                logger.warning("El hilo de subida no terminó a tiempo")
 
-        count = self.disk.count()
-        if count:
-            logger.info(f"Recuperados {count} registros pendientes en disco.")
+        left = deadline - time.monotonic()
+        if (self.disk_thread is None or not self.disk_thread.is_alive()) and left > 0 and self._is_db_alive(min(3, left)):
+            self._flush(deadline)
+        # Publish (or spill to disk) the dead letters still in memory
+        self.publisher.stop(timeout=max(deadline - time.monotonic(), 1))
 
-        self.disk_thread = threading.Thread(target=self._disk_retry_loop, daemon=True)
-        self.disk_thread.start()
+        pending = self.disk.count()
+        self.disk.close()
+        if pending:
+            logger.warning(f"Parada con {pending} registros pendientes en disco.")
+        else:
+            logger.info("BatchWriter parado, cola de disco vacía.")
+        return pending
 
     # ===============================
     # PUBLIC: Agregar registro
@@ -66,13 +147,10 @@ class BatchWriter:
             normal_record = processed.get("normal_record")
             if normal_record:
                 normal_record["_collection"] = COLLECTION_READINGS
-                # TODO: disk.exists() recorre todo el fichero en cada llamada.
-                # Con muchos AGVs enviando datos en paralelo esto puede ser
-                # un cuello de botella. Mejora: mantener un set de message_ids
-                # en memoria como caché para evitar lecturas de disco repetidas.
-                if not self.disk.exists(normal_record.get("message_id")):
-                    self.disk.append([normal_record])
-                    logger.info(f"normal_record añadido al disco: {normal_record}")
+                # Dedup with the in-memory window instead of reading the whole disk queue
+                if self._is_new(normal_record):
+                    if self._append([normal_record]):
+                        logger.info(f"normal_record añadido al disco: {normal_record}")
                 else:
                     logger.info(f"normal_record duplicado ignorado: {normal_record.get('message_id')}")
 
@@ -80,52 +158,150 @@ class BatchWriter:
             alerts = processed.get("alerts", [])
             for alert in alerts:
                 alert["_collection"] = COLLECTION_URGENT
-                if not self.disk.exists(alert.get("message_id")):
-                    self.disk.append([alert])
-                    logger.info(f"alerta añadida al disco: {alert}")
+                if self._is_new(alert):
+                    if self._append([alert]):
+                        logger.info(f"alerta añadida al disco: {alert}")
                 else:
                     logger.info(f"alerta duplicada ignorada: {alert.get('message_id')}")
 
+    def _append(self, records):
+        """
+        Write records to the disk queue. Never raises (it runs inside the MQTT callback): if the disk fails
+        (for example the volume is full) the records go to the error topic. Must be called with self.lock.
+        """
+        try:
+            self.disk.append(records)
+            return True
+        except OSError as e:
+            self.write_errors += len(records)
+            logger.error(f"No se pudo escribir en la cola de disco ({len(records)} registros): {e}")
+            for record in records:
+                self._send_to_error_topic(record, f"disk_write_failed: {e}")
+            return False
+
+    def _is_new(self, record):
+        message_id = record.get("message_id")
+        return not message_id or self.recent_ids.add(message_id)
+
+    def add_many(self, results):
+        """
+        Add a list of EdgeProcessor results (bulk ingestion) with a single disk append.
+        Returns the outcome of every result, in order: None if its records were written, "duplicate" if all of
+        them were already in the dedup window, "disk_write_failed" if the append failed (they went to the error topic).
+        """
+        groups = []
+        for processed in results:
+            records = []
+            normal_record = processed.get("normal_record")
+            if normal_record:
+                normal_record["_collection"] = COLLECTION_READINGS
+                records.append(normal_record)
+            for alert in processed.get("alerts", []):
+                alert["_collection"] = COLLECTION_URGENT
+                records.append(alert)
+            groups.append(records)
+
+        with self.lock:
+            new_groups = [[record for record in records if self._is_new(record)] for records in groups]
+            new_records = [record for records in new_groups for record in records]
+            failed = bool(new_records) and not self._append(new_records)
+
+        outcomes = []
+        for records, new in zip(groups, new_groups):
+            if new:
+                outcomes.append("disk_write_failed" if failed else None)
+            else:
+                outcomes.append("duplicate" if records else None)
+        if not failed:
+            total = sum(len(records) for records in groups)
+            logger.info(f"{len(new_records)} registros añadidos al disco ({total - len(new_records)} duplicados)")
+        return outcomes
+
+    # ===============================
+    # STATS
+    # ===============================
+    def stats(self):
+        """Current values of the writer, exposed by the service as metrics."""
+        stats = {
+            "batch_size": self.batch_size.value,
+            "last_latency": self.batch_size.last_latency,
+            "write_errors": self.write_errors,
+        }
+        if self.disk is not None:
+            with self.lock:
+                stats.update(self.retention.usage(self.disk))
+        return stats
+
     # ===============================
     # LOOP DISCO -> DB
     # ===============================
     def _disk_retry_loop(self):
         while self.running:
-            time.sleep(FLUSH_INTERVAL)
+            # Event instead of sleep so stop() does not wait a whole FLUSH_INTERVAL
+            self._wakeup.wait(FLUSH_INTERVAL)
+            if not self.running:
+                break
+            self._export_metrics()
+
             with self.lock:
-                disk_records = self.disk.load_all()
+                if not self.disk.count():
+                    continue
 
-            if not disk_records:
-                continue
+            # Retention runs here, in the only thread that acks the queue, also while the DB is down
+            try:
+                self.retention.enforce(self.disk, self.lock)
+            except OSError as e:
+                logger.error(f"Error aplicando la retención de la cola: {e}")
 
             if not self._is_db_alive():
                 logger.warning("DB caída, esperando para subir registros del disco...")
                 continue
 
-            # Processes batches
-            for i in range(0, len(disk_records), BATCH_SIZE):
-                batch = disk_records[i:i + BATCH_SIZE]
-                sent_records = self._send_with_retry_batch(batch)
+            self._flush()
+
+    def _flush(self, deadline=None):
+        """
+        Upload the disk backlog in batches, from the head of the queue. With a deadline (drain), stops between
+        batches when it is reached. Only the records pending when it starts are sent in this round.
+        """
+        with self.lock:
+            remaining = self.disk.count()
+
+        # Processes batches (the size changes with every response)
+        while remaining > 0:
+            if deadline is None and not self.running:
+                # stop() was called: it drains the rest with its own deadline
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("Tiempo de drenado agotado")
+                return
+            with self.lock:
+                size = min(self.batch_size.value, remaining)
+                batch = self.disk.read(size)
+            remaining -= size
+            sent_records = self._send_with_retry_batch(batch, deadline) if batch else []
+
+            # Ack the batch on disk; the records that were not sent go back to the tail first,
+            # so a crash in between duplicates them instead of losing them
+            sent_ids = {s.get("message_id") for s in sent_records}
+            unsent = [r for r in batch if r.get("message_id") not in sent_ids]
+            with self.lock:
+                self.disk.append(unsent)
+                self.disk.ack(size)
+            self._export_metrics()
 
-                # Delete from disk if uploaded
-                with self.lock:
-                    current_disk = self.disk.load_all()
-                    remaining = [
-                        r for r in current_disk
-                        if r.get("message_id") not in {s.get("message_id") for s in sent_records}
-                    ]
-                    self.disk.rewrite(remaining)
+    def _export_metrics(self):
+        # The multiprocess /metrics only sees the values written by the workers, it never asks the writer
+        if self.metrics is not None:
+            self.metrics.update(self)
 
     # ===============================
     # DB Health Check
     # ===============================
-    def _is_db_alive(self):
-        # TODO: Se usa PocketBaseClient para el health check, pero el cliente
-        # ya no se usa para enviar datos a la DB (todo pasa por Benthos).
-        # Esta dualidad es confusa. Simplificar usando requests.get() directamente:
-        # requests.get(f"{POCKETBASE_URL}/api/health", timeout=3)
+    def _is_db_alive(self, timeout=3):
+        # The health endpoint needs no token: a plain GET with a short timeout, so the drain deadline holds
         try:
-            return self.pb.get("/api/health").status_code == 200
+            return requests.get(f"{PB_URL}/api/health", timeout=timeout).status_code == 200
         except Exception:
             return False
 
@@ -133,66 +309,155 @@ class BatchWriter:
     # MQTT Error
     # ===============================
     def _send_to_error_topic(self, record, reason):
-        if not self.mqtt_client:
-            logger.error("MQTT client no disponible")
-            return
-        payload = {
-            "record": record,
-            "reason": str(reason),
-            "failed_at": datetime.utcnow().isoformat() + "Z"
-        }
+        # Never blocks the writer: the publisher thread packs the records in envelopes
+        self.publisher.publish_dead_letter(record, reason)
+
+    # ===============================
+    # Headers Benthos
+    # ===============================
+    def _benthos_headers(self):
+        # Benthos forwards our Authorization header to PocketBase, so the pipeline
+        # always uses the token renewed by the TokenManager instead of a static one
+        headers = {"Content-Type": "application/json"}
         try:
-            self.mqtt_client.publish(MQTT_ERROR_TOPIC, json.dumps(payload), qos=1)
-            logger.error("Registro enviado a error topic")
+            headers["Authorization"] = self.pb.tokens.authorization()
         except Exception as e:
-            logger.critical("No se pudo publicar en error topic: %s", e)
+            # Benthos falls back to POCKETBASE_TOKEN
+            logger.warning(f"No se pudo obtener token para Benthos: {e}")
+        return headers
 
     # ===============================
     # Enviar batch con retries
     # ===============================
-    def _send_with_retry_batch(self, batch):
-        # Filter duplicated messages with message_id
-        unique_batch_dict = {r['message_id']: r for r in batch}
-        unique_batch = list(unique_batch_dict.values())
+    def send(self, batch, deadline=None):
+        """
+        Send a batch to Benthos, retrying only the records that fail. Safe to call from several threads.
+        Returns (sent, failed): the records acked by the sink and the ones sent to the error topic (not serializable,
+        rejected by PocketBase or after MAX_RETRIES). With a deadline the records in neither list were not sent.
+        """
+        pending, encoded, failed = self._encode(batch)
+        sent = []
         attempt = 0
 
-        while attempt < MAX_RETRIES:
+        while pending and attempt < MAX_RETRIES:
+            timeout = BENTHOS_TIMEOUT + 2
+            if deadline is not None:
+                # While draining no request outlives the deadline
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    return sent, failed
             try:
                 # Send batch as JSON to benthos
-                payload_str = json.dumps(unique_batch, default=str)
+                started = time.monotonic()
+                payload_str = "[" + ",".join(encoded[message_id] for message_id in pending) + "]"
                 response = requests.post(
                     BENTHOS_URL,
                     data=payload_str,
-                    headers={"Content-Type": "application/json"},
-                    timeout=10
+                    headers=self._benthos_headers(),
+                    timeout=timeout
                 )
                 if response.status_code in (200, 201):
-                    logger.info(f"Batch enviado a Benthos ({len(unique_batch)} registros)")
-                    return unique_batch
+                    size = len(pending)
+                    retryable = self._apply_outcomes(response, pending, sent, failed)
+                    # Rejected records (4xx) are not a sink problem, they do not shrink the batch
+                    self.batch_size.record(size, time.monotonic() - started, not retryable)
+                    logger.info(f"Batch enviado a Benthos ({size - len(pending)}/{size} registros)")
+                    if not pending:
+                        return sent, failed
+                    logger.warning(f"{len(pending)} registros fallidos, se reintentan solo esos")
                 else:
+                    self.batch_size.record(len(pending), time.monotonic() - started, False)
                     logger.error(
                         "Error enviando a Benthos: %s %s",
                         response.status_code,
                         response.text
                     )
-                    attempt += 1
-                    delay = min(BASE_DELAY * (2 ** attempt), MAX_DELAY)
-                    time.sleep(delay)
+                attempt += 1
+                delay = min(BASE_DELAY * (2 ** attempt), MAX_DELAY)
             except Exception as e:
+                self.batch_size.record(len(pending), time.monotonic() - started, False)
                 attempt += 1
                 delay = min(BASE_DELAY * (2 ** attempt), MAX_DELAY)
                 logger.warning(f"Retry {attempt} a Benthos en {delay}s: {e}")
+
+            # While draining, keep the pending records on disk instead of sleeping past the deadline
+            if deadline is not None:
+                if time.monotonic() + delay >= deadline:
+                    return sent, failed
                 time.sleep(delay)
+            elif self._wakeup.wait(delay):
+                # stop() was called: the pending records stay on disk for its drain
+                return sent, failed
 
         # If max_retries reached, send to error topic
-        for r in unique_batch:
+        for r in pending.values():
             self._send_to_error_topic(r, "max_retries_exceeded")
-        return unique_batch
-
-# BUG: Esta instancia global se crea al importar el módulo, lo que significa
-# que si se importa batch_writer en varios sitios (como ocurre en service.py
-# donde se crea otra instancia en __init__), se iniciaran múltiples hilos
-# _disk_retry_loop compitiendo por el mismo fichero de disco.
-# Solución: usar el patrón Singleton o eliminar esta instancia global
-# y gestionar el ciclo de vida desde service.py únicamente.
-batch_writer = BatchWriter()
\ No newline at end of file
+        return sent, failed + list(pending.values())
+
+    def _send_with_retry_batch(self, batch, deadline=None):
+        """Send a batch (see send). Returns the records that can be removed from disk: sent or failed."""
+        sent, failed = self.send(batch, deadline)
+        return sent + failed
+
+    def _encode(self, batch):
+        """
+        Serialize every record once, before the retries. Times travel as epoch ms and are formatted as ISO
+        only here, at the sink. A record that can not be serialized (time out of range) goes to the error topic
+        alone instead of failing the whole batch. Returns (pending, encoded, failed).
+        """
+        # Filter duplicated messages with message_id
+        pending, encoded, failed = {}, {}, []
+        for r in batch:
+            try:
+                encoded[r['message_id']] = json.dumps(format_times(r), default=str)
+                pending[r['message_id']] = r
+            except Exception as e:
+                logger.error(f"Registro no serializable para Benthos: {r.get('message_id')}: {e}")
+                self._send_to_error_topic(r, f"invalid_record: {e}")
+                failed.append(r)
+        return pending, encoded, failed
+
+    def _apply_outcomes(self, response, pending, sent, failed):
+        """
+        Apply the per-record outcomes returned by Benthos ([{"message_id", "status", "code", "error"}, ...]).
+        Uploaded records are moved from pending to sent and records rejected by PocketBase (4xx, they would fail
+        again) to failed; the rest stay in pending to be retried. Returns the number of records to retry.
+        """
+        try:
+            outcomes = response.json()
+        except ValueError:
+            outcomes = None
+        if not isinstance(outcomes, list):
+            # Benthos without per-record outcomes: the status code is for the whole batch
+            sent.extend(pending.values())
+            pending.clear()
+            return 0
+
+        for outcome in outcomes:
+            message_id = outcome.get("message_id")
+            if message_id not in pending:
+                continue
+            code = outcome.get("code") or 0
+            if outcome.get("status") == "ok":
+                sent.append(pending.pop(message_id))
+            elif 400 <= code < 500 and code not in RETRYABLE_CODES:
+                record = pending.pop(message_id)
+                self._send_to_error_topic(record, f"rejected: {code} {outcome.get('error', '')}".strip())
+                failed.append(record)
+        # Records without outcome (or with a transient error) are retried
+        return len(pending)
+
+# ===============================
+# Default instance (lazy)
+# ===============================
+_default_writer = None
+_default_lock = threading.Lock()
+
+
+def get_batch_writer():
+    """Return the process-wide BatchWriter, building and starting it on first use."""
+    global _default_writer
+    with _default_lock:
+        if _default_writer is None:
+            _default_writer = BatchWriter().start()
+        return _default_writer
@@ -0,0 +1,161 @@
+import argparse
+
+import yaml
+
+# Generator of core/benthos.yaml. Benthos reads the same .env as the Python service (env_file in docker-compose.yml),
+# so every knob is rendered as a ${VAR:default} reference to the variable the BatchWriter reads: both stages are
+# tuned from one place. The defaults are SHARED_SETTINGS, which core/batch_writer.py also uses for its own.
+#
+#     python -m core.benthos_config --output core/benthos.yaml
+#
+# tests/test_bento.py checks that the live file is the output of this generator.
+
+HEADER = "# Generated by 'python -m core.benthos_config'. Do not edit by hand, change core/benthos_config.py instead.\n"
+
+# Settings shared with the Python stages: env var -> default used when it is not set.
+# core/batch_writer.py reads its defaults from here, keep this module free of project imports
+SHARED_SETTINGS = {
+    # BatchWriter retry policy, reused by the Benthos -> PocketBase requests
+    "BASE_DELAY": 1,
+    "MAX_DELAY": 10,
+    # Seconds Benthos has to answer a batch (the BatchWriter waits a bit longer)
+    "BENTHOS_TIMEOUT": 10,
+    # Retries of every record against PocketBase inside Benthos, before reporting it as failed, and seconds every
+    # request to PocketBase can take. All the attempts must fit in BENTHOS_TIMEOUT (see retry_budget)
+    "BENTHOS_RETRIES": 2,
+    "BENTHOS_REQUEST_TIMEOUT": 2,
+    # Pipeline threads (-1: one per CPU) and max requests per second to PocketBase
+    "BENTHOS_THREADS": -1,
+    "BENTHOS_RATE_LIMIT": 1000,
+    "POCKETBASE_URL": "http://host.docker.internal:8090",
+}
+
+
+def env(name: str, suffix: str = "") -> str:
+    '''Benthos environment reference with the shared default: ${NAME:default}'''
+    return f"${{{name}:{SHARED_SETTINGS[name]}}}{suffix}"
+
+
+def retry_budget(settings: dict = SHARED_SETTINGS) -> float:
+    '''
+    Worst case seconds Benthos spends on one record: every attempt times out and waits the whole backoff
+    (retry_period doubled on every retry, up to max_retry_backoff). It must be below BENTHOS_TIMEOUT, otherwise
+    the whole batch is answered with a 408 and the BatchWriter sends again the records that already succeeded.
+    '''
+    retries = settings["BENTHOS_RETRIES"]
+    backoff = sum(min(settings["BASE_DELAY"] * 2 ** i, settings["MAX_DELAY"]) for i in range(retries))
+    return (retries + 1) * settings["BENTHOS_REQUEST_TIMEOUT"] + backoff
+
+
+def build_config() -> dict:
+    '''Benthos configuration as a dict.'''
+    return {
+        "http": {
+            "address": "0.0.0.0:4197",
+        },
+        "input": {
+            "http_server": {
+                "path": "/ingest",
+                "allowed_verbs": ["POST"],
+                "timeout": env("BENTHOS_TIMEOUT", "s"),
+                # The response body is the result of the pipeline: one outcome per record
+                "sync_response": {
+                    "headers": {"Content-Type": "application/json"},
+                },
+            },
+        },
+        "rate_limit_resources": [
+            {
+                "label": "pocketbase",
+                "local": {"count": env("BENTHOS_RATE_LIMIT"), "interval": "1s"},
+            },
+        ],
+        "pipeline": {
+            "threads": env("BENTHOS_THREADS"),
+            "processors": [
+                {"unarchive": {"format": "json_array"}},
+                {
+                    # The schema is validated at the edge (core/schema.py): invalid messages never reach Benthos.
+                    # _queued is internal to the disk queue retention (core/retention.py)
+                    "mapping": (
+                        "meta collection = this._collection\n"
+                        "meta message_id = this.message_id\n"
+                        'root = this.without("_collection", "_queued")\n'
+                    ),
+                },
+                {
+                    # One POST per record to its collection, all the records of the batch in parallel
+                    # (the BatchWriter caps the batch with BATCH_SIZE_MAX). A record that fails is flagged
+                    # with the error instead of failing the whole batch. Records rejected by PocketBase
+                    # (drop_on) are not retried, they would fail again
+                    "http": {
+                        "url": env("POCKETBASE_URL", '/api/collections/${! meta("collection") }/records'),
+                        "verb": "POST",
+                        "headers": {
+                            "Content-Type": "application/json",
+                            # Token forwarded by the BatchWriter (core/token_manager.py),
+                            # POCKETBASE_TOKEN (token.env) is only the fallback
+                            "Authorization": '${! meta("Authorization").or("Bearer ${POCKETBASE_TOKEN}") }',
+                        },
+                        "parallel": True,
+                        "timeout": env("BENTHOS_REQUEST_TIMEOUT", "s"),
+                        "rate_limit": "pocketbase",
+                        "retries": env("BENTHOS_RETRIES"),
+                        "retry_period": env("BASE_DELAY", "s"),
+                        "max_retry_backoff": env("MAX_DELAY", "s"),
+                        "drop_on": [400, 404, 422],
+                    },
+                },
+                {
+                    # Outcome of every record for the BatchWriter: only failed records are retried or dead-lettered
+                    "mapping": (
+                        'root.message_id = meta("message_id")\n'
+                        'root.status = if errored() { "error" } else { "ok" }\n'
+                        'root.code = meta("http_status_code").or("0").number()\n'
+                        "root.error = if errored() { error() }\n"
+                    ),
+                },
+                # Clear the error flags, the failures are already in the outcomes
+                {"catch": []},
+                {"archive": {"format": "json_array"}},
+            ],
+        },
+        "output": {
+            "sync_response": {},
+        },
+    }
+
+
+class _Dumper(yaml.SafeDumper):
+    pass
+
+
+def _str_representer(dumper, value):
+    # Bloblang mappings as literal blocks (|), like a hand written config
+    style = "|" if "\n" in value else None
+    return dumper.represent_scalar("tag:yaml.org,2002:str", value, style=style)
+
+
+_Dumper.add_representer(str, _str_representer)
+
+
+def render() -> str:
+    '''benthos.yaml content.'''
+    return HEADER + yaml.dump(build_config(), Dumper=_Dumper, sort_keys=False, width=200)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the Benthos configuration")
+    parser.add_argument("--output", help="File to write (stdout by default)")
+    args = parser.parse_args()
+
+    content = render()
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(content)
+    else:
+        print(content, end="")
+
+
+if __name__ == "__main__":
+    main()
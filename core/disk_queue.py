@@ -1,72 +1,140 @@
 import os
 import json
+import zlib
+import struct
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Acked bytes at the start of the log that trigger a compaction (the pending records are copied to a new log)
+QUEUE_COMPACT_BYTES = int(os.getenv("QUEUE_COMPACT_BYTES", 64 * 1024 * 1024))
+
+# Index entry: end offset (unsigned 64 bits) of every record in the log
+_OFFSET = struct.Struct("<Q")
+
 
 class DiskQueue:
 
-    '''        
-        A simple disk-based queue implementation that allows us to store records in a file on disk. 
-        It provides methods to append records, load all records, count the number of records, rewrite the file with a new set of records, and clear the file. 
-        This is useful for our batch writer to have a persistent storage of the messages that need to be sent to PocketBase, allowing us to handle retries and ensure no data is lost in case of failures.
+    '''
+        A disk-based FIFO queue to store records in a file on disk (one JSON line per record), so the batch writer
+        has a persistent storage of the messages that need to be sent to PocketBase and no data is lost on failures.
+
+        The log is append-only: sent records are acked by moving the head, not by rewriting the file.
+        Two sidecar files make the recovery after a crash constant time, without parsing the log:
+        - <file>.idx: end byte offset of every record (8 bytes per record, appended with the record)
+        - <file>.manifest: record count, head (last acked position and its byte offset) and checksums of the
+          head and last records, rewritten atomically on every ack
+        On open the manifest is checked against the log: only the records appended after the last index entry are
+        parsed, and a torn last line (crash in the middle of a write) is detected and truncated.
+        If the sidecars are missing or do not match the log, the index is rebuilt by scanning the log once.
     '''
 
     def __init__(self, file_path: str):
         self.file_path = file_path
+        self.index_path = file_path + ".idx"
+        self.manifest_path = file_path + ".manifest"
         os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
 
+        self.records = 0  # records in the log, acked or not
+        self.head = 0     # first pending record
+        self.offset = 0   # byte offset of the head
+        self.size = 0     # bytes of the log
+        self._log = None
+        self._index = None
+        self._recover()
+
     # ===============================
     # APPEND
     # ===============================
 
     def append(self, records):
-        with open(self.file_path, "a") as f:
-            for record in records:
-                f.write(json.dumps(record) + "\n")
+        if not records:
+            return
+        lines = [(json.dumps(record) + "\n").encode() for record in records]
+        ends = []
+        end = self.size
+        for line in lines:
+            end += len(line)
+            ends.append(end)
+
+        log, index = self._files()
+        try:
+            # The log goes first: a record without index entry is recovered from the tail of the log
+            log.write(b"".join(lines))
+            log.flush()
+            index.write(b"".join(_OFFSET.pack(e) for e in ends))
+            index.flush()
+        except OSError:
+            # The caller is told that the records were not stored: none of them stays in the files
+            self._rollback()
+            raise
+        self.records += len(lines)
+        self.size = end
 
     # ===============================
-    # LOAD
+    # READ
     # ===============================
 
+    def read(self, limit=None, skip=0):
+        '''First `limit` pending records (all if None) after the first `skip`, without removing them. ack() removes them.'''
+        start = min(self.head + skip, self.records)
+        stop = self.records if limit is None else min(start + limit, self.records)
+        return self._read_range(start, stop)
+
+    def tail(self, limit):
+        '''Last `limit` pending records.'''
+        return self._read_range(max(self.head, self.records - limit), self.records)
+
     def load_all(self):
-        if not os.path.exists(self.file_path):
-            return []
+        return self.read()
+
+    # ===============================
+    # ACK
+    # ===============================
 
-        with open(self.file_path, "r") as f:
-            return [
-                json.loads(line.strip())
-                for line in f
-                if line.strip()
-            ]
+    def ack(self, count):
+        '''Remove the first `count` pending records. Only the head and the manifest are written.'''
+        self.head = min(self.head + count, self.records)
+        if self.head == self.records:
+            self._reset()
+            return
+        self.offset = self._end(self.head - 1)
+        if self.offset >= QUEUE_COMPACT_BYTES and self.offset * 2 >= self.size:
+            self._compact()
+        self._write_manifest()
 
     # ===============================
     # COUNT
     # ===============================
 
     def count(self):
-        if not os.path.exists(self.file_path):
-            return 0
+        return self.records - self.head
 
-        with open(self.file_path, "r") as f:
-            return sum(1 for line in f if line.strip())
+    def pending_bytes(self):
+        return self.size - self.offset
 
     # ===============================
     # REWRITE
     # ===============================
 
     def rewrite(self, records):
-        with open(self.file_path, "w") as f:
-            for record in records:
-                f.write(json.dumps(record) + "\n")
+        self._reset()
+        self.append(records)
 
     # ===============================
     # CLEAR
     # ===============================
 
     def clear(self):
-        open(self.file_path, "w").close()
+        self._reset()
+
+    def close(self):
+        '''Write the manifest and close the files. The queue can still be used, the files are opened again.'''
+        self._write_manifest()
+        for f in (self._log, self._index):
+            if f is not None:
+                f.close()
+        self._log = self._index = None
 
     # ===============================
     # EXISTS (FILTER)
@@ -80,4 +148,226 @@ class DiskQueue:
         for record in self.load_all():
             if record.get("message_id") == message_id:
                 return True
-        return False
\ No newline at end of file
+        return False
+
+    # ===============================
+    # FILES
+    # ===============================
+
+    def _files(self):
+        if self._log is None:
+            self._log = open(self.file_path, "ab")
+            self._index = open(self.index_path, "ab")
+        return self._log, self._index
+
+    def _end(self, i):
+        '''End offset of record i.'''
+        if i < 0:
+            return 0
+        with open(self.index_path, "rb") as f:
+            f.seek(i * _OFFSET.size)
+            return _OFFSET.unpack(f.read(_OFFSET.size))[0]
+
+    def _line(self, i):
+        '''Raw line of record i.'''
+        start = self._end(i - 1)
+        with open(self.file_path, "rb") as f:
+            f.seek(start)
+            return f.read(self._end(i) - start)
+
+    def _read_range(self, start, stop):
+        if stop <= start:
+            return []
+        begin = self._end(start - 1)
+        with open(self.file_path, "rb") as f:
+            f.seek(begin)
+            data = f.read(self._end(stop - 1) - begin)
+
+        records = []
+        for line in data.split(b"\n")[:-1]:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.error(f"Registro corrupto en {self.file_path} descartado: {line[:100]!r}")
+        return records
+
+    def _rollback(self):
+        '''Undo a failed append: log and index back to the last stored record.'''
+        for f in (self._log, self._index):
+            try:
+                f.close()
+            except OSError:
+                pass
+        self._log = self._index = None
+        try:
+            with open(self.file_path, "r+b") as f:
+                f.truncate(self.size)
+            with open(self.index_path, "r+b") as f:
+                f.truncate(self.records * _OFFSET.size)
+        except OSError as e:
+            # The state is taken from the files again (the complete records written are kept)
+            logger.error(f"No se pudo deshacer la escritura en {self.file_path}: {e}")
+            self._recover()
+
+    def _reset(self):
+        '''Empty log, index and manifest (everything acked).'''
+        log, index = self._files()
+        log.truncate(0)
+        index.truncate(0)
+        self.records = self.head = self.offset = self.size = 0
+        self._write_manifest()
+
+    def _compact(self):
+        '''Copy the pending records to a new log and index, dropping the acked ones.'''
+        log, index = self._files()
+        log.close()
+        index.close()
+        self._log = self._index = None
+
+        with open(self.file_path, "rb") as src, open(self.file_path + ".tmp", "wb") as dst:
+            src.seek(self.offset)
+            while chunk := src.read(1024 * 1024):
+                dst.write(chunk)
+        with open(self.index_path, "rb") as src, open(self.index_path + ".tmp", "wb") as dst:
+            src.seek(self.head * _OFFSET.size)
+            while chunk := src.read(_OFFSET.size * 65536):
+                dst.write(b"".join(_OFFSET.pack(end - self.offset) for (end,) in _OFFSET.iter_unpack(chunk)))
+
+        # A crash between the replaces leaves a manifest that does not match the log: it is rebuilt on open
+        os.replace(self.file_path + ".tmp", self.file_path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        logger.info(f"Cola {self.file_path} compactada: {self.offset} bytes liberados")
+        self.records -= self.head
+        self.size -= self.offset
+        self.head = self.offset = 0
+
+    # ===============================
+    # MANIFEST
+    # ===============================
+
+    def _write_manifest(self):
+        manifest = {
+            "records": self.records,
+            "head": self.head,
+            "offset": self.offset,
+            "head_crc": zlib.crc32(self._line(self.head)) if self.head < self.records else 0,
+            "last_crc": zlib.crc32(self._line(self.records - 1)) if self.records else 0,
+        }
+        manifest["checksum"] = _checksum(manifest)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            if manifest.pop("checksum") != _checksum(manifest):
+                return None
+            return manifest
+        except (OSError, ValueError, KeyError, AttributeError):
+            return None
+
+    # ===============================
+    # RECOVERY
+    # ===============================
+
+    def _recover(self):
+        log_size = os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        manifest = self._read_manifest()
+
+        if manifest is None or not self._matches(manifest, log_size, index_size):
+            if log_size:
+                logger.warning(f"Índice de {self.file_path} ausente o inválido, reconstruyendo (lectura completa)")
+            self._rebuild()
+            return
+
+        self.records = index_size // _OFFSET.size
+        if self.records > manifest["records"] and not _valid(self._line(self.records - 1)):
+            # Index entries of records that did not reach the log: index them again from the last known one
+            self.records = manifest["records"]
+        self.size = self._end(self.records - 1)
+        self.head = manifest["head"]
+        self.offset = manifest["offset"]
+        # Records written to the log after the last index entry (or a torn line): only that tail is parsed
+        if log_size != self.size or index_size != self.records * _OFFSET.size:
+            self._recover_tail(log_size)
+        if self.count():
+            logger.info(f"Cola {self.file_path} recuperada: {self.count()} registros pendientes")
+        self._write_manifest()
+
+    def _matches(self, manifest, log_size, index_size):
+        '''Constant time check that the manifest and the index describe this log.'''
+        records = index_size // _OFFSET.size
+        head = manifest["head"]
+        if not manifest["records"] <= records or not head <= manifest["records"]:
+            return False
+        if manifest["records"] and (self._end(manifest["records"] - 1) > log_size
+                                    or zlib.crc32(self._line(manifest["records"] - 1)) != manifest["last_crc"]):
+            return False
+        if head < manifest["records"] and (self._end(head - 1) != manifest["offset"]
+                                           or zlib.crc32(self._line(head)) != manifest["head_crc"]):
+            return False
+        # The last index entry must not point past the end of the log
+        return not records or self._end(records - 1) <= log_size
+
+    def _rebuild(self):
+        '''Rebuild the index from the whole log. Every record in the log is pending.'''
+        self.records = self.head = self.offset = self.size = 0
+        with open(self.index_path, "wb"):
+            pass
+        if os.path.exists(self.file_path):
+            self._recover_tail(os.path.getsize(self.file_path))
+        else:
+            open(self.file_path, "ab").close()
+        self._write_manifest()
+
+    def _recover_tail(self, log_size):
+        '''Index the complete records after self.size and truncate a torn last line.'''
+        # Drop a partial index entry
+        with open(self.index_path, "r+b") as index:
+            index.truncate(self.records * _OFFSET.size)
+
+        ends = []
+        end = self.size
+        with open(self.file_path, "rb") as f:
+            f.seek(self.size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logger.warning(f"Última línea incompleta en {self.file_path} descartada ({log_size - end} bytes)")
+                    break
+                end += len(line)
+                if not _valid(line):
+                    # Corrupt or blank line: it stays in the log, inside the range of the next record
+                    # (_read_range skips it), and the records after it are kept
+                    if line.strip():
+                        logger.error(f"Registro corrupto en {self.file_path} descartado: {line[:100]!r}")
+                    continue
+                ends.append(end)
+
+        with open(self.index_path, "ab") as index:
+            index.write(b"".join(_OFFSET.pack(e) for e in ends))
+        if end != log_size:
+            with open(self.file_path, "r+b") as f:
+                f.truncate(end)
+        self.records += len(ends)
+        self.size = end
+
+
+def _valid(line: bytes) -> bool:
+    '''A complete JSON line (the last one, if corrupt lines before it are part of the same record).'''
+    if not line.endswith(b"\n"):
+        return False
+    try:
+        json.loads(line[:-1].rsplit(b"\n", 1)[-1])
+    except ValueError:
+        return False
+    return True
+
+
+def _checksum(manifest: dict) -> int:
+    return zlib.crc32(json.dumps(manifest, sort_keys=True).encode())
@@ -0,0 +1,284 @@
+import os
+import time
+import zlib
+import queue
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for the edge processing (0: in the listener process, as always)
+EDGE_WORKERS = int(os.getenv("EDGE_WORKERS", 0))
+# Payloads per micro-batch sent to a worker, and max seconds a payload waits for its micro-batch
+EDGE_BATCH = int(os.getenv("EDGE_BATCH", 256))
+EDGE_BATCH_WAIT = float(os.getenv("EDGE_BATCH_WAIT", 0.02))
+# Micro-batches waiting for every worker. When it is full submit() blocks (back-pressure to the broker)
+EDGE_QUEUE_SIZE = int(os.getenv("EDGE_QUEUE_SIZE", 64))
+# Max seconds submit() blocks on a full queue: then (or at once if the worker is dead) the micro-batch is rejected
+EDGE_SUBMIT_TIMEOUT = float(os.getenv("EDGE_SUBMIT_TIMEOUT", 5))
+# Max seconds a request to the workers (bulk ingestion, sensor statistics) waits for the answer
+EDGE_REQUEST_TIMEOUT = float(os.getenv("EDGE_REQUEST_TIMEOUT", 10))
+# spawn: the workers do not inherit the threads (paho, BentoML) of the service process.
+# The main module of the process is imported again in the workers: scripts need the __main__ guard
+EDGE_START_METHOD = os.getenv("EDGE_START_METHOD", "spawn")
+
+
+def worker_for(sensor, workers: int) -> int:
+    '''Worker of a sensor: every reading of a sensor goes to the same worker, so their order is kept.'''
+    key = sensor if isinstance(sensor, str) else ""
+    return zlib.crc32(key.encode()) % workers
+
+
+def _work(inbox, outbox, index):
+    '''
+    Worker process: validation and rules of every micro-batch with its own EdgeProcessor (and sensor statistics).
+    Messages are (kind, request, data): "process" with [(topic, payload), ...] or "stats" with a sensor id.
+    The answer goes back with the same request (None: a micro-batch of the listener, for the handler).
+    '''
+    from core.edge_proccesor import EdgeProcessor
+
+    processor = EdgeProcessor()
+    while True:
+        message = inbox.get()
+        if message is None:
+            outbox.put((index, None, None))
+            return
+        kind, request, data = message
+        if kind == "stats":
+            outbox.put((index, request, processor.stats.get(data)))
+            continue
+        results = []
+        for topic, payload in data:
+            try:
+                result, reason = processor.process_payload(payload)
+            except Exception as e:
+                result, reason = None, f"error: {e}"
+            # The payload only goes back to the handler when it is rejected (for the error topic).
+            # Requests always get it: process_payload fills its timestamp and message_id
+            results.append((topic, payload if request is not None or not result else None, result, reason))
+        outbox.put((index, request, results))
+
+
+class EdgePool:
+
+    '''
+        Runs the EdgeProcessor in EDGE_WORKERS long-lived processes, so the rules scale with the cores instead of
+        running under the GIL of the listener. Decoded payloads are sharded by sensor (crc32) and sent in
+        micro-batches of EDGE_BATCH (or every EDGE_BATCH_WAIT seconds); each worker answers a micro-batch with
+        the results in the same order. A sensor always goes to the same worker, so the readings of a sensor
+        keep their order (and the per-sensor statistics stay in one process).
+        handler(items) is called from the collector thread with every micro-batch of results:
+        [(topic, payload or None, result, reason), ...]
+        Micro-batches that can not be queued (dead worker, or a queue full for EDGE_SUBMIT_TIMEOUT seconds) go to
+        the handler as rejected, so their payloads reach the error topic instead of blocking the listener.
+        process_batch (bulk ingestion) and sensor_stats run in the worker of every sensor too, so the statistics
+        of a sensor have one owner.
+    '''
+
+    def __init__(self, workers: int = EDGE_WORKERS, batch: int = EDGE_BATCH, wait: float = EDGE_BATCH_WAIT,
+                 queue_size: int = EDGE_QUEUE_SIZE, start_method: str = EDGE_START_METHOD):
+        self.workers = workers
+        self.batch = batch
+        self.wait = wait
+        self.context = multiprocessing.get_context(start_method)
+        self.inboxes = [self.context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.outbox = self.context.Queue()
+        self.processes = []
+        self.handler = None
+        self.running = False
+        # Payloads rejected because their micro-batch could not be queued
+        self.rejected = 0
+
+        self._requests = {}
+        self._request_ids = itertools.count(1)
+        self._requests_lock = threading.Lock()
+
+        self._buffers = [[] for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._timer = None
+        self._collector = None
+
+    # ===============================
+    # LIFECYCLE
+    # ===============================
+
+    def start(self, handler):
+        '''Start the worker processes, the collector and the micro-batch timer. Returns self.'''
+        self.handler = handler
+        self.processes = [
+            self.context.Process(target=_work, args=(inbox, self.outbox, i), name=f"edge-{i}", daemon=True)
+            for i, inbox in enumerate(self.inboxes)
+        ]
+        for process in self.processes:
+            process.start()
+        self.running = True
+        self._collector = threading.Thread(target=self._collect, name="edge-collector", daemon=True)
+        self._collector.start()
+        self._timer = threading.Thread(target=self._tick, name="edge-timer", daemon=True)
+        self._timer.start()
+        logger.info(f"EdgePool iniciado con {self.workers} procesos")
+        return self
+
+    def stop(self, timeout: float = 10):
+        '''Send the buffered payloads, wait for all the results (delivered to the handler) and stop the workers.'''
+        if not self.running:
+            return
+        self.running = False
+        self._wakeup.set()
+        self._timer.join(timeout=timeout)
+        self._send_all()
+        for index in range(self.workers):
+            self._put(index, None)
+        self._collector.join(timeout=timeout)
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        logger.info("EdgePool parado")
+
+    # ===============================
+    # SUBMIT
+    # ===============================
+
+    def submit(self, topic, payload):
+        '''Queue a decoded payload for the worker of its sensor.'''
+        sensor = payload.get("sensor") if isinstance(payload, dict) else None
+        index = worker_for(sensor, self.workers)
+        with self._lock:
+            buffer = self._buffers[index]
+            buffer.append((topic, payload))
+            if len(buffer) < self.batch:
+                return
+            self._buffers[index] = []
+            # Sent under the lock: micro-batches of a worker are queued in order
+            queued = self._put(index, ("process", None, buffer))
+        if not queued:
+            self._reject(buffer)
+
+    def _send_all(self):
+        failed = []
+        with self._lock:
+            for index, buffer in enumerate(self._buffers):
+                if buffer:
+                    self._buffers[index] = []
+                    if not self._put(index, ("process", None, buffer)):
+                        failed.extend(buffer)
+        if failed:
+            self._reject(failed)
+
+    def _put(self, index, message, timeout: float = EDGE_SUBMIT_TIMEOUT) -> bool:
+        '''Queue a message for a worker. False if the worker is dead or its queue stays full for timeout seconds.'''
+        deadline = time.monotonic() + timeout
+        while self.processes[index].is_alive():
+            try:
+                self.inboxes[index].put(message, timeout=min(1, max(deadline - time.monotonic(), 0.01)))
+                return True
+            except queue.Full:
+                if time.monotonic() >= deadline:
+                    break
+        return False
+
+    def _reject(self, items):
+        # Outside the lock: the handler writes the dead letters
+        self.rejected += len(items)
+        logger.error(f"EdgePool: {len(items)} payloads rechazados, el proceso no responde")
+        self.handler([(topic, payload, None, "edge_worker_unavailable") for topic, payload in items])
+
+    def _tick(self):
+        # Partial micro-batches wait at most EDGE_BATCH_WAIT seconds
+        while self.running:
+            self._wakeup.wait(self.wait)
+            self._send_all()
+
+    # ===============================
+    # REQUESTS
+    # ===============================
+
+    def _request(self, index, kind, data):
+        '''Send a request to a worker. Returns (request id, future of the answer), or None if it can not be queued.'''
+        request = next(self._request_ids)
+        future = Future()
+        with self._requests_lock:
+            self._requests[request] = future
+        if self._put(index, (kind, request, data)):
+            return request, future
+        with self._requests_lock:
+            self._requests.pop(request, None)
+        return None
+
+    def _answer(self, sent, deadline):
+        '''Answer of a request before the deadline, None if it did not arrive.'''
+        if sent is None:
+            return None
+        request, future = sent
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            with self._requests_lock:
+                self._requests.pop(request, None)
+            return None
+
+    def process_batch(self, payloads, timeout: float = EDGE_REQUEST_TIMEOUT):
+        '''
+        EdgeProcessor.process_batch in the workers (bulk ingestion): every payload is processed by the worker of
+        its sensor, in order. Returns [(result, reason), ...] in the order of payloads.
+        '''
+        positions = {}
+        for position, payload in enumerate(payloads):
+            sensor = payload.get("sensor") if isinstance(payload, dict) else None
+            positions.setdefault(worker_for(sensor, self.workers), []).append(position)
+
+        deadline = time.monotonic() + timeout
+        sent = {
+            index: self._request(index, "process", [(None, payloads[p]) for p in share])
+            for index, share in positions.items()
+        }
+        answers = [(None, "edge_worker_unavailable")] * len(payloads)
+        for index, share in positions.items():
+            results = self._answer(sent[index], deadline)
+            if results is None:
+                continue
+            for position, (_, payload, result, reason) in zip(share, results):
+                if isinstance(payloads[position], dict):
+                    # Same as in the service process: the payload gets its timestamp and message_id
+                    payloads[position].update(payload)
+                answers[position] = (result, reason)
+        return answers
+
+    def sensor_stats(self, sensor, timeout: float = EDGE_REQUEST_TIMEOUT):
+        '''Statistics of a sensor (SensorStats.get) from the worker that owns it, None if unknown or no answer.'''
+        return self._answer(self._request(worker_for(sensor, self.workers), "stats", sensor),
+                            time.monotonic() + timeout)
+
+    # ===============================
+    # COLLECT
+    # ===============================
+
+    def _collect(self):
+        finished = 0
+        while finished < self.workers:
+            try:
+                index, request, results = self.outbox.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    logger.error("Todos los procesos de EdgePool han terminado")
+                    return
+                continue
+            if request is not None:
+                with self._requests_lock:
+                    future = self._requests.pop(request, None)
+                # None: the request timed out, nobody waits for it
+                if future is not None:
+                    future.set_result(results)
+                continue
+            if results is None:
+                finished += 1
+                continue
+            try:
+                self.handler(results)
+            except Exception as e:
+                logger.error(f"Error entregando resultados de EdgePool: {e}")
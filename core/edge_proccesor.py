@@ -1,9 +1,10 @@
 # core/edge_processor.py
 import os
 import logging
-import datetime
 import dotenv
-from core.utils import build_ingestion_metadata
+from core.utils import build_ingestion_metadata, new_message_id, now_ms, parse_timestamp_ms
+from core.sensor_stats import SensorStats
+from core.schema import ReadingValidator, InvalidReading, NUMERIC_SENSOR_TYPES
 
 dotenv.load_dotenv()
 logger = logging.getLogger(__name__)
@@ -25,6 +26,28 @@ BATTERY_THRESHOLD = int(os.getenv("BATTERY_THRESHOLD", 15))
 # Unificar los umbrales entre ambas capas para evitar falsas alarmas en pruebas.
 TEMP_THRESHOLD = int(os.getenv("TEMP_THRESHOLD", 75))
 
+# Anomaly alerts: reading more than ANOMALY_ZSCORE standard deviations away from the sensor mean
+ANOMALY_DETECTION = os.getenv("ANOMALY_DETECTION", "false").lower() in ("1", "true", "yes")
+ANOMALY_ZSCORE = float(os.getenv("ANOMALY_ZSCORE", 4))
+ANOMALY_MIN_SAMPLES = int(os.getenv("ANOMALY_MIN_SAMPLES", 30))
+
+# Sensor ids
+BATTERY_ID = os.getenv("BATTERY_ID")
+TEMP_ID = os.getenv("TEMP_ID")
+STATUS_ID = os.getenv("STATUS_ID")
+HAS_PALLET_ID = os.getenv("HAS_PALLET_ID")
+
+SENSOR_TYPES = {
+    BATTERY_ID: "battery",
+    TEMP_ID: "temperature",
+    STATUS_ID: "status",
+    HAS_PALLET_ID: "has_pallet",
+}
+SENSOR_TYPES.pop(None, None)
+
+# Alerts that are also published on MQTT_PUBLISH_TOPIC_ALERTS
+PUBLISHED_ALERTS = ("battery_low", "overheat", "anomaly")
+
 
 class EdgeProcessor:
     """
@@ -35,20 +58,53 @@ class EdgeProcessor:
     """
 
     def __init__(self):
-        pass
+        # Per-sensor mean/variance, EWMA and rolling min/max (O(1) per reading)
+        self.stats = SensorStats()
+        # Schema check and type coercion of the raw payloads (see core/schema.py)
+        self.validator = ReadingValidator(SENSOR_TYPES)
+
+    @staticmethod
+    def sensor_type(sensor_id) -> str:
+        '''Type of a sensor from its id ("unknown" if it is not configured).'''
+        return SENSOR_TYPES.get(sensor_id, "unknown")
+
+    def process_payload(self, payload: dict):
+        '''
+        Process a raw payload sent by a device ({"sensor", "value", ["timestamp"], ["message_id"]}).
+        Validates it against the schema of its sensor type and fills the missing timestamp and message_id.
+        Returns (result, reason): result is the process_reading dict, or None with the reason it was rejected.
+        '''
+        try:
+            sensor_type = self.validator.validate(payload)
+        except InvalidReading as e:
+            return None, str(e)
+
+        # Automatic timestamp (epoch ms, formatted as ISO only when sent to Benthos)
+        if "timestamp" not in payload:
+            payload["timestamp"] = now_ms()
+
+        # Generación automática de message_id único (ordenado por tiempo) para trazabilidad
+        if "message_id" not in payload:
+            payload["message_id"] = new_message_id()
+
+        sensor_id = payload["sensor"]
+        return self.process_reading(payload, sensor_type=sensor_type, sensor_id=sensor_id), None
+
+    def process_batch(self, payloads):
+        '''Process a list of raw payloads. Returns a (result, reason) pair per payload, in the same order.'''
+        return [self.process_payload(payload) for payload in payloads]
 
     def process_reading(self, reading: dict, sensor_type: str, sensor_id: str):
         value = reading.get("value")
         if value is None:
             logger.warning(f"Sensor {sensor_id} envió valor nulo")
             return None
-        # TODO: Si sensor_type es "unknown" (asignado en listener.py cuando
-        # el sensor_id no coincide con ningún ID conocido), este método
-        # no aplica ninguna validación y genera un normal_record sin filtrar.
-        # Considerar añadir un bloque explícito para manejar sensores desconocidos
-        # o rechazarlos directamente con una alerta al error topic.
+        # Unknown sensors only get here with UNKNOWN_SENSOR_POLICY=accept (core/schema.py)
+        # and are stored without value checks
 
         alerts = []
+        # Epoch ms, already parsed by the validator (parse_timestamp_ms only fills a missing one)
+        timestamp = parse_timestamp_ms(reading.get("timestamp"))
 
         # =====================================================
         # Invalid values validations
@@ -63,7 +119,7 @@ class EdgeProcessor:
                 "sensor": sensor_id,
                 "type": "battery_invalid",
                 "value": f"Batería inválida: {value}",
-                "timestamp": reading.get("timestamp")
+                "timestamp": timestamp
             }
             logger.warning(f"Battery inválida detectada: {value}")
             return {"normal_record": None, "alerts": [alert]}
@@ -74,7 +130,7 @@ class EdgeProcessor:
                 "sensor": sensor_id,
                 "type": "temperature_invalid",
                 "value": f"Temperatura inválida: {value}",
-                "timestamp": reading.get("timestamp")
+                "timestamp": timestamp
             }
             logger.warning(f"Temperatura inválida detectada: {value}")
             return {"normal_record": None, "alerts": [alert]}
@@ -85,7 +141,7 @@ class EdgeProcessor:
                 "sensor": sensor_id,
                 "type": "has_pallet_invalid",
                 "value": f"HasPallet inválido: {value}",
-                "timestamp": reading.get("timestamp")
+                "timestamp": timestamp
             }
             logger.warning(f"HasPallet inválido detectado: {value}")
             return {"normal_record": None, "alerts": [alert]}
@@ -96,7 +152,7 @@ class EdgeProcessor:
                 "sensor": sensor_id,
                 "type": "status_invalid",
                 "value": f"Status inválido: {value}",
-                "timestamp": reading.get("timestamp")
+                "timestamp": timestamp
             }
             logger.warning(f"Status inválido detectado: {value}")
             return {"normal_record": None, "alerts": [alert]}
@@ -110,7 +166,7 @@ class EdgeProcessor:
                 "sensor": sensor_id,
                 "type": "battery_low",
                 "value": f"Batería baja: {value}%",
-                "timestamp": reading.get("timestamp")
+                "timestamp": timestamp
             })
 
         if sensor_type == "temperature" and value > TEMP_THRESHOLD:
@@ -119,25 +175,38 @@ class EdgeProcessor:
                 "sensor": sensor_id,
                 "type": "overheat",
                 "value": f"Sobrecalentamiento: {value}°C",
-                "timestamp": reading.get("timestamp")
+                "timestamp": timestamp
             })
 
         # =====================================================
-        # Build normal records
+        # Streaming statistics (z-score against the sensor history)
         # =====================================================
-        ts_str = reading.get("timestamp")
-        try:
-            timestamp = datetime.datetime.fromisoformat(ts_str.replace("Z", "+00:00")) if ts_str else datetime.datetime.utcnow()
-        except Exception:
-            timestamp = datetime.datetime.utcnow()
+        if sensor_type in NUMERIC_SENSOR_TYPES and isinstance(value, (int, float)):
+            zscore = self.stats.update(sensor_id, value)
+            if (
+                ANOMALY_DETECTION
+                and zscore is not None
+                and abs(zscore) >= ANOMALY_ZSCORE
+                and self.stats.count(sensor_id) > ANOMALY_MIN_SAMPLES
+            ):
+                alerts.append({
+                    **build_ingestion_metadata(),
+                    "sensor": sensor_id,
+                    "type": "anomaly",
+                    "value": f"Anomalía: {value} (z={zscore:.1f})",
+                    "timestamp": timestamp
+                })
+                logger.warning(f"Anomalía detectada en {sensor_id}: {value} (z={zscore:.1f})")
 
+        # =====================================================
+        # Build normal records
+        # =====================================================
         normal_record = {
-            **build_ingestion_metadata(),
+            **build_ingestion_metadata(reading.get("message_id")),
             "sensor": sensor_id,
             "type": sensor_type,
             "value": value,
-            "time": timestamp.isoformat(),
-            "message_id": reading.get("message_id"),
+            "time": timestamp,
             "_collection": "readings"
         }
 
@@ -0,0 +1,50 @@
+from prometheus_client import Gauge
+
+# Prometheus gauges of the BatchWriter, served by BentoML on /metrics.
+# BentoML runs the workers with the prometheus_client multiprocess mode: /metrics merges the values the workers
+# wrote to PROMETHEUS_MULTIPROC_DIR and never calls a gauge callback (set_function), so the flusher sets them
+# every cycle and after every batch. "livemax": the value of the live worker of every shard.
+BATCH_SIZE_GAUGE = Gauge(
+    "batch_writer_batch_size",
+    "Current adaptive batch size sent to Benthos",
+    ["shard"],
+    multiprocess_mode="livemax",
+)
+BATCH_LATENCY_GAUGE = Gauge(
+    "batch_writer_last_latency_seconds",
+    "Round trip of the last batch sent to Benthos",
+    ["shard"],
+    multiprocess_mode="livemax",
+)
+QUEUE_RECORDS_GAUGE = Gauge(
+    "batch_writer_queue_records",
+    "Records pending in the disk queue",
+    ["shard"],
+    multiprocess_mode="livemax",
+)
+QUEUE_BYTES_GAUGE = Gauge(
+    "batch_writer_queue_bytes",
+    "Bytes of the records pending in the disk queue",
+    ["shard"],
+    multiprocess_mode="livemax",
+)
+
+
+class WriterMetrics:
+
+    '''Gauges of the BatchWriter of one shard, set by its flusher (see BatchWriter._export_metrics).'''
+
+    def __init__(self, shard: str):
+        self.batch_size = BATCH_SIZE_GAUGE.labels(shard=shard)
+        self.latency = BATCH_LATENCY_GAUGE.labels(shard=shard)
+        self.queue_records = QUEUE_RECORDS_GAUGE.labels(shard=shard)
+        self.queue_bytes = QUEUE_BYTES_GAUGE.labels(shard=shard)
+
+    def update(self, writer):
+        with writer.lock:
+            records = writer.disk.count()
+            pending_bytes = writer.disk.pending_bytes()
+        self.batch_size.set(writer.batch_size.value)
+        self.latency.set(writer.batch_size.last_latency)
+        self.queue_records.set(records)
+        self.queue_bytes.set(pending_bytes)
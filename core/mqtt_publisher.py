@@ -0,0 +1,255 @@
+import os
+import json
+import fcntl
+import queue
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+
+from core.disk_queue import DiskQueue
+from core.utils import format_times
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MQTT_BROKER = os.getenv("MQTT_BROKER")
+MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
+MQTT_ERROR_TOPIC = os.getenv("MQTT_ERROR_TOPIC")
+MQTT_PUBLISH_TOPIC_ALERTS = os.getenv("MQTT_PUBLISH_TOPIC_ALERTS")
+
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", 10000))
+DEAD_LETTER_BATCH = int(os.getenv("DEAD_LETTER_BATCH", 500))
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "/app/data/dead_letters.log")
+
+
+class MQTTPublisher:
+
+    '''
+        Publishes alerts and dead letters from its own thread, so the MQTT callback and the batch writer
+        never block on the broker. Dead letters are packed in envelopes of up to DEAD_LETTER_BATCH records
+        (one publish per envelope instead of one per record). If the broker is not available or the
+        in-memory queue is full, dead letters are spilled to a local file that can be replayed later with:
+
+            python -m core.mqtt_publisher --replay
+
+        The DiskQueue of the spill file keeps its state in memory, so only one process may use the file: the
+        publisher holds an exclusive lock (fcntl.flock on <file>.lock) from the first spill until stop(), and
+        the replay tool is refused while the service holds it.
+    '''
+
+    def __init__(self, client=None, spill_file=None):
+        self.client = client
+        self.queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        self.spill_file = spill_file or DEAD_LETTER_FILE
+        self._spill = None
+        # The spill file is written by the publisher thread and by the callers when the queue is full
+        self._spill_lock = threading.Lock()
+        # Lock file that makes this process the owner of the spill file
+        self._owner = None
+        self.running = False
+        self.thread = None
+
+    @property
+    def spill(self):
+        # Opened on first use: building a publisher has no side effects
+        if self._spill is None:
+            # If the replay tool is running, wait until it is done with the file
+            self._own_spill(block=True)
+            self._spill = DiskQueue(self.spill_file)
+        return self._spill
+
+    def _own_spill(self, block):
+        '''Take the exclusive lock of the spill file. Returns False if block is False and another process holds it.'''
+        if self._owner is None:
+            os.makedirs(os.path.dirname(self.spill_file) or ".", exist_ok=True)
+            owner = open(self.spill_file + ".lock", "a")
+            try:
+                fcntl.flock(owner, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                owner.close()
+                return False
+            self._owner = owner
+        return True
+
+    def _release_spill(self):
+        '''Close the spill file and release its lock (the next spill opens it again).'''
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self._owner is not None:
+            # Closing the file releases the flock
+            self._owner.close()
+            self._owner = None
+
+    def attach(self, client):
+        '''Set the MQTT client used to publish (the listener one).'''
+        self.client = client
+
+    # ===============================
+    # LIFECYCLE
+    # ===============================
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        '''Stop the thread after publishing (or spilling) everything still in the queue.'''
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join(timeout=timeout)
+        # Whatever is left could not be published in time
+        self._spill_dead_letters([payload for kind, payload in self._drain(block=False, limit=None) if kind == "dead"])
+        with self._spill_lock:
+            self._release_spill()
+
+    # ===============================
+    # PUBLIC: Encolar
+    # ===============================
+
+    def publish_alert(self, alert: dict):
+        '''Queue an alert for MQTT_PUBLISH_TOPIC_ALERTS. Alerts are also stored in the DB, so they are dropped if the queue is full.'''
+        try:
+            self.queue.put_nowait(("alert", alert))
+        except queue.Full:
+            logger.warning("Cola de publicación llena, alerta MQTT descartada")
+
+    def publish_dead_letter(self, record: dict, reason):
+        '''Queue a record for MQTT_ERROR_TOPIC. Never blocks: if the queue is full it goes to the spill file.'''
+        payload = {
+            "record": record,
+            "reason": str(reason),
+            "failed_at": datetime.utcnow().isoformat() + "Z"
+        }
+        try:
+            self.queue.put_nowait(("dead", payload))
+        except queue.Full:
+            self._spill_dead_letters([payload])
+
+    # ===============================
+    # LOOP
+    # ===============================
+
+    def _drain(self, block=True, limit=DEAD_LETTER_BATCH):
+        '''Get up to limit queued items (waiting up to 1s for the first one if block).'''
+        items = []
+        try:
+            items.append(self.queue.get(timeout=1) if block else self.queue.get_nowait())
+            while limit is None or len(items) < limit:
+                items.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return items
+
+    def _run(self):
+        while self.running or not self.queue.empty():
+            items = self._drain()
+            if not items:
+                continue
+
+            dead_letters = [payload for kind, payload in items if kind == "dead"]
+            for kind, payload in items:
+                if kind == "alert":
+                    self._publish(MQTT_PUBLISH_TOPIC_ALERTS, format_times(payload), qos=0)
+
+            if dead_letters and not self._publish(MQTT_ERROR_TOPIC, self._envelope(dead_letters), qos=1):
+                logger.error("Broker no disponible, dead letters guardados en disco")
+                self._spill_dead_letters(dead_letters)
+            elif dead_letters:
+                logger.error(f"{len(dead_letters)} registros enviados a error topic")
+
+    def _publish(self, topic, payload, qos):
+        if not self.client or not self.client.is_connected():
+            return False
+        try:
+            info = self.client.publish(topic, json.dumps(payload, default=str), qos=qos)
+            return info.rc == mqtt.MQTT_ERR_SUCCESS
+        except Exception as e:
+            logger.error(f"Error publicando en {topic}: {e}")
+            return False
+
+    def _spill_dead_letters(self, dead_letters):
+        if not dead_letters:
+            return
+        try:
+            with self._spill_lock:
+                self.spill.append(dead_letters)
+        except OSError as e:
+            logger.critical("No se pudieron guardar %s dead letters: %s", len(dead_letters), e)
+
+    @staticmethod
+    def _envelope(dead_letters):
+        return {
+            "count": len(dead_letters),
+            "dead_letters": dead_letters,
+            "sent_at": datetime.utcnow().isoformat() + "Z"
+        }
+
+    # ===============================
+    # REPLAY
+    # ===============================
+
+    def replay(self):
+        '''
+        Publish the spilled dead letters on the error topic (synchronously, in envelopes).
+        Returns the number of dead letters published. Stops at the first failure and keeps the rest in the file.
+        Raises RuntimeError if another process (the running service) owns the spill file.
+        '''
+        with self._spill_lock:
+            if self._spill is None and not self._own_spill(block=False):
+                raise RuntimeError(f"{self.spill_file} está en uso por el servicio, páralo antes del replay")
+            pending = self.spill.load_all()
+        sent = 0
+        for i in range(0, len(pending), DEAD_LETTER_BATCH):
+            envelope = self._envelope(pending[i:i + DEAD_LETTER_BATCH])
+            info = self.client.publish(MQTT_ERROR_TOPIC, json.dumps(envelope, default=str), qos=1)
+            try:
+                info.wait_for_publish(timeout=10)
+            except Exception as e:
+                logger.error(f"Replay interrumpido: {e}")
+                break
+            if not info.is_published():
+                logger.error("Replay interrumpido: el broker no confirmó el envío")
+                break
+            sent = i + envelope["count"]
+
+        with self._spill_lock:
+            # Only the published ones are removed, what was spilled while replaying stays in the file
+            self.spill.ack(sent)
+        logger.info(f"Replay: {sent} dead letters publicados, {len(pending) - sent} pendientes")
+        return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dead letter publisher")
+    parser.add_argument("--replay", action="store_true", help="Publish the spilled dead letters on MQTT_ERROR_TOPIC")
+    parser.add_argument("--file", default=DEAD_LETTER_FILE, help="Spill file (one per shard)")
+    args = parser.parse_args()
+
+    if not args.replay:
+        parser.print_help()
+        return
+
+    client = mqtt.Client()
+    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    client.loop_start()
+    try:
+        MQTTPublisher(client, spill_file=args.file).replay()
+    except RuntimeError as e:
+        logger.error(e)
+        raise SystemExit(1)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import requests
 import os
+import logging
+
+from core.token_manager import get_token_manager
+
+logger = logging.getLogger(__name__)
 
 PB_URL = os.getenv('POCKETBASE_URL')
-PB_USER = os.getenv('POCKETBASE_USER')
-PB_PASS = os.getenv('POCKETBASE_PASSWORD')
 
 
 class PocketBaseClient:
@@ -11,13 +14,19 @@ class PocketBaseClient:
     '''
         A simple client to interact with the PocketBase API, 
         handling authentication and requests. 
-        It includes a method to authenticate and obtain a token, 
-        a method to make POST requests that automatically re-authenticates if the token is expired, 
+        The token comes from the shared TokenManager, that renews it in background before it expires.
+        It includes a method to force a new token, 
+        a method to make POST requests that re-authenticates if the token is rejected anyway, 
         and a method to make GET requests.
     '''
 
-    def __init__(self):
-        self.token = None
+    def __init__(self, token_manager=None):
+        # Shared with the rest of the clients of the process, it refreshes the token before it expires
+        self.tokens = token_manager or get_token_manager()
+
+    @property
+    def token(self):
+        return self.tokens.get()
 
     # ===============================
     # AUTH
@@ -25,31 +34,9 @@ class PocketBaseClient:
 
     def authenticate(self):
 
-        '''Authenticate with PocketBase using the provided credentials and obtain a token.'''
-        # BUG: Esta URL autentica contra la colección "users" (usuarios normales),
-        # pero el .env define POCKETBASE_SUPERUSER para usar un superusuario.
-        # Los superusuarios de PocketBase usan un endpoint distinto:
-        # /api/collections/_superusers/auth-with-password
-        # Revisar qué tipo de usuario debe autenticar este cliente y
-        # usar la URL correspondiente.
-        url = f"{PB_URL}/api/collections/users/auth-with-password"
-
-        payload = {
-            "identity": PB_USER,
-            "password": PB_PASS
-        }
-
-        r = requests.post(url, json=payload, timeout=10)
-        r.raise_for_status()
-
-        self.token = r.json()["token"]
-        # If the authentication is successful, we store the token for future requests
-        # TODO: Usar logger.info() en lugar de print(). En producción los
-        # print() no se gestionan por el sistema de logging configurado
-        # en el resto del proyecto y pueden saturar la salida estándar.
-        print()
-        print("✅ PocketBase autenticado", flush=True)
-        print()
+        '''Force a new token (normally the token manager renews it before it expires).'''
+        self.tokens.refresh(stale=self.tokens.token)
+        logger.info("PocketBase autenticado")
 
     # ===============================
     # POST (NO rompe en 400)
@@ -59,11 +46,9 @@ class PocketBaseClient:
 
         '''Make a POST request to the PocketBase API with the given endpoint and data.'''
 
-        if not self.token:
-            self.authenticate()
-
+        token = self.token
         headers = {
-            "Authorization": f"Bearer {self.token}",
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
             # We set the content type to application/json since we are sending JSON data
         }
@@ -73,18 +58,12 @@ class PocketBaseClient:
         r = requests.post(url, json=data, headers=headers, timeout=10) # We make the POST request with a timeout of 10 seconds
 
         if r.status_code == 401:
-            print("\nToken expirado, reautenticando...\n", flush=True)
-            self.authenticate()
-            headers["Authorization"] = f"Bearer {self.token}"
+            # Token revoked before its expiry: single-flight refresh and retry once
+            logger.warning("Token rechazado, reautenticando...")
+            headers["Authorization"] = f"Bearer {self.tokens.refresh(stale=token)}"
             r = requests.post(url, json=data, headers=headers, timeout=10)
-            # If the token was expired, we re-authenticate and try the request again with the new token
-        # TODO: Mismo problema. Reemplazar por:
-        # logger.debug("STATUS: %s | BODY: %s", r.status_code, r.text)
-        # Usar DEBUG y no INFO para no saturar los logs en producción
-        # con el body completo de cada respuesta de PocketBase.
-        print("\nSTATUS:", r.status_code, flush=True)
-        print("BODY:", r.text, flush=True)
-        print()
+            # If the token was rejected, we re-authenticate and try the request again with the new token
+        logger.debug("STATUS: %s | BODY: %s", r.status_code, r.text)
 
         if r.status_code >= 500:
             r.raise_for_status()
@@ -100,9 +79,6 @@ class PocketBaseClient:
 
         '''Make a GET request to the PocketBase API with the given path and query parameters.'''
 
-        if not self.token:
-            self.authenticate()
-
         url = f"{PB_URL}{path}"
         
         # NOTA: El timeout de 10s está bien para el health check, pero si
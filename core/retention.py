@@ -0,0 +1,218 @@
+import os
+import json
+import logging
+
+from core.schema import NUMERIC_SENSOR_TYPES, READING_TYPES
+from core.utils import now_ms
+
+logger = logging.getLogger(__name__)
+
+# Limits of the pending records of a disk queue (0: no limit)
+QUEUE_MAX_BYTES = int(os.getenv("QUEUE_MAX_BYTES", 0))
+QUEUE_MAX_RECORDS = int(os.getenv("QUEUE_MAX_RECORDS", 0))
+# Seconds a reading can wait in the queue
+QUEUE_MAX_AGE = float(os.getenv("QUEUE_MAX_AGE", 0))
+# "drop_oldest" drops the oldest readings, "downsample" replaces them with one aggregate per sensor and bucket
+QUEUE_OVERFLOW_POLICY = os.getenv("QUEUE_OVERFLOW_POLICY", "drop_oldest").lower()
+# Seconds covered by every aggregate of the downsample policy
+DOWNSAMPLE_BUCKET = int(os.getenv("DOWNSAMPLE_BUCKET", 60))
+# Records read from the head of the queue at a time
+RETENTION_CHUNK = 1000
+
+
+def record_ms(record: dict):
+    '''Time the record entered the queue (epoch ms), None if unknown.'''
+    value = record.get("_queued", record.get("ingestion_timestamp", record.get("time")))
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def downsample(readings, bucket_seconds: int = DOWNSAMPLE_BUCKET, now=None):
+    '''
+    One aggregate per sensor and time bucket. Readings of a continuous quantity (battery, temperature) become the
+    newest reading of the bucket with value = mean and the min, max and number of samples; the rest of the reading
+    types are codes (status, has_pallet) that can not be averaged, the newest reading of the bucket is kept with
+    the number of samples. Aggregates of the same bucket are merged. The aggregates enter the queue again
+    (_queued, dropped by Benthos). Readings without a known type or time are kept as they are.
+    '''
+    bucket_ms = bucket_seconds * 1000
+    groups = {}
+    others = []
+    for reading in readings:
+        value = reading.get("value")
+        time = reading.get("time")
+        kind = reading.get("type")
+        if kind not in READING_TYPES or not isinstance(time, int):
+            others.append(reading)
+            continue
+        numeric = kind in NUMERIC_SENSOR_TYPES and isinstance(value, (int, float)) and not isinstance(value, bool)
+        samples = reading.get("samples", 1)
+        low = reading.get("min", value)
+        high = reading.get("max", value)
+        key = (reading.get("_collection"), reading.get("sensor"), kind, numeric, time - time % bucket_ms)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [reading, value * samples if numeric else None, low, high, samples]
+        elif numeric:
+            group[0] = reading
+            group[1] += value * samples
+            group[2] = min(group[2], low)
+            group[3] = max(group[3], high)
+            group[4] += samples
+        else:
+            # Merged aggregates go back to the tail, after newer readings: the newest is chosen by time
+            if time >= group[0]["time"]:
+                group[0] = reading
+            group[4] += samples
+
+    queued = now or now_ms()
+    aggregates = []
+    for (_, _, _, numeric, start), (last, total, low, high, samples) in groups.items():
+        if not numeric:
+            # Last value of the bucket, at its own time
+            aggregates.append({**last, "samples": samples, "_queued": queued})
+            continue
+        aggregates.append({
+            **last,
+            "value": total / samples,
+            "min": low,
+            "max": high,
+            "samples": samples,
+            "time": start,
+            "_queued": queued,
+        })
+    return aggregates + others
+
+
+class Retention:
+
+    '''
+        Bounds the backlog of a disk queue during long sink outages, so disk and memory stay predictable.
+        When the pending records are over QUEUE_MAX_BYTES / QUEUE_MAX_RECORDS, or older than QUEUE_MAX_AGE,
+        the oldest ones are removed from the head of the queue according to QUEUE_OVERFLOW_POLICY:
+        - drop_oldest: the readings are dropped
+        - downsample: the readings are replaced by aggregates (see downsample) that go back to the tail;
+          aggregates are dropped only when the queue is still over the size or count limit
+        Records for which keep(record) is true (urgent alerts) are never dropped, they go back to the tail when
+        a record behind them is removed.
+        enforce() must run in the thread that acks the queue (the BatchWriter flusher).
+    '''
+
+    def __init__(self, max_bytes: int = QUEUE_MAX_BYTES, max_records: int = QUEUE_MAX_RECORDS,
+                 max_age: float = QUEUE_MAX_AGE, policy: str = QUEUE_OVERFLOW_POLICY,
+                 bucket: int = DOWNSAMPLE_BUCKET, keep=None):
+        if policy not in ("drop_oldest", "downsample"):
+            raise ValueError(f"QUEUE_OVERFLOW_POLICY inválida: {policy}")
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_age = max_age
+        self.policy = policy
+        self.bucket = bucket
+        self.keep = keep or (lambda record: False)
+        self.dropped = 0
+        self.downsampled = 0
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes or self.max_records or self.max_age)
+
+    def _excess(self, disk):
+        return (
+            (self.max_bytes and disk.pending_bytes() > self.max_bytes)
+            or (self.max_records and disk.count() > self.max_records)
+        )
+
+    def _expired(self, record, cutoff):
+        if cutoff is None:
+            return False
+        ms = record_ms(record)
+        return ms is not None and ms < cutoff
+
+    # ===============================
+    # ENFORCE
+    # ===============================
+
+    def enforce(self, disk, lock, now=None) -> int:
+        '''Apply the limits to disk (lock protects it from the writers). Returns the number of records removed.'''
+        if not self.enabled:
+            return 0
+        now = now or now_ms()
+        cutoff = now - self.max_age * 1000 if self.max_age else None
+        removed = 0
+        # Every pending record is looked at most once per call
+        budget = disk.count()
+        # Kept records at the head: they are moved to the tail only when a record behind them is removed,
+        # so a queue that is over the limits because of kept records alone is not rewritten on every call
+        held = []
+
+        while budget > 0:
+            with lock:
+                over_records = disk.count() - self.max_records if self.max_records else 0
+                over_bytes = disk.pending_bytes() - self.max_bytes if self.max_bytes else 0
+                chunk = disk.read(min(RETENTION_CHUNK, budget), skip=len(held))
+            if not chunk:
+                break
+
+            # Oldest records first: stop at the first one that is not over the limits
+            looked = 0
+            done = False
+            acked = 0
+            position = len(held)
+            moved, readings, excess_aggregates = [], [], []
+            for record in chunk:
+                excess = over_records > 0 or over_bytes > 0
+                if not excess and not self._expired(record, cutoff):
+                    done = True
+                    break
+                looked += 1
+                position += 1
+                if self.keep(record):
+                    held.append(record)
+                    continue
+                # Over the size/count limit the aggregates are dropped, otherwise they are merged again
+                (excess_aggregates if excess and record.get("samples") else readings).append(record)
+                over_records -= 1
+                over_bytes -= len(json.dumps(record)) + 1
+                # The kept records in front of this one go back to the tail, the age limit counts again from now
+                moved.extend({**kept, "_queued": now} for kept in held)
+                held = []
+                acked = position
+
+            self.dropped += len(excess_aggregates)
+            if self.policy == "downsample":
+                self.downsampled += sum(1 for r in readings if not r.get("samples"))
+                moved.extend(downsample(readings, self.bucket, now))
+            else:
+                self.dropped += len(readings)
+
+            if acked:
+                with lock:
+                    # The moved records go to the tail before the chunk is acked: a crash keeps both copies
+                    disk.append(moved)
+                    disk.ack(acked)
+                removed += acked - len(moved)
+            budget -= looked
+            if done:
+                break
+
+        if removed:
+            logger.warning(f"Retención de {disk.file_path} ({self.policy}): {removed} registros eliminados, "
+                           f"{disk.count()} pendientes")
+        if self._excess(disk):
+            logger.warning(f"Cola {disk.file_path} sigue sobre el límite (alertas urgentes o agregados recientes)")
+        return removed
+
+    # ===============================
+    # USAGE
+    # ===============================
+
+    def usage(self, disk) -> dict:
+        '''Queue usage against the limits.'''
+        head = disk.read(1)
+        oldest = record_ms(head[0]) if head else None
+        return {
+            "queue_records": disk.count(),
+            "queue_bytes": disk.pending_bytes(),
+            "queue_oldest_age": (now_ms() - oldest) / 1000 if oldest else 0.0,
+            "queue_dropped": self.dropped,
+            "queue_downsampled": self.downsampled,
+        }
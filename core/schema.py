@@ -0,0 +1,117 @@
+import os
+import math
+
+from core.utils import timestamp_ms
+
+# What to do with readings of sensors that are not configured (BATTERY_ID, TEMP_ID, ...):
+# "reject" sends them to the error path, "accept" stores them with sensor type "unknown"
+UNKNOWN_SENSOR_POLICY = os.getenv("UNKNOWN_SENSOR_POLICY", "reject").lower()
+MAX_MESSAGE_ID_LENGTH = 64
+# Last millisecond of the year 9999: timestamps (seconds, milliseconds or ISO strings) must be formattable as ISO
+MAX_TIMESTAMP_MS = 253_402_300_799_999
+
+
+class InvalidReading(ValueError):
+    '''A payload that does not match the reading schema. The message is the rejection reason.'''
+
+
+# ===============================
+# COERCION
+# ===============================
+
+def _to_float(value):
+    if isinstance(value, bool):
+        raise InvalidReading("invalid_value")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise InvalidReading("invalid_value")
+    if not math.isfinite(number):
+        raise InvalidReading("invalid_value")
+    return number
+
+
+def _to_int(value):
+    number = _to_float(value)
+    if not number.is_integer():
+        raise InvalidReading("invalid_value")
+    return int(number)
+
+
+def _to_number(value):
+    # Any finite number, ints are kept as ints
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return _to_float(value)
+
+
+# Coercion of "value" for every sensor type
+COERCERS = {
+    "battery": _to_number,
+    "temperature": _to_number,
+    "status": _to_int,
+    "has_pallet": _to_int,
+    "unknown": _to_number,
+}
+# Types of the readings, fixed whatever sensor ids are configured (the rest of the record types are alerts)
+READING_TYPES = frozenset(COERCERS)
+# Types that measure a continuous quantity: streaming statistics and averages apply (status and has_pallet are codes)
+NUMERIC_SENSOR_TYPES = ("battery", "temperature")
+
+
+class ReadingValidator:
+
+    '''
+        Schema check of the raw payloads, before anything is queued or sent.
+        The sensor id -> (type, coercion) table is built once, so validating a payload is a dict lookup
+        plus the coercion of "value" (numeric strings like "24.7" are converted, booleans, NaN or text are rejected).
+        Returns the sensor type; raises InvalidReading with the reason otherwise.
+    '''
+
+    def __init__(self, sensor_types: dict, unknown_policy: str = UNKNOWN_SENSOR_POLICY):
+        if unknown_policy not in ("reject", "accept"):
+            raise ValueError(f"UNKNOWN_SENSOR_POLICY inválida: {unknown_policy}")
+        self.unknown_policy = unknown_policy
+        self._table = {sensor_id: (sensor_type, COERCERS[sensor_type]) for sensor_id, sensor_type in sensor_types.items()}
+        self._unknown = ("unknown", COERCERS["unknown"]) if unknown_policy == "accept" else None
+
+    def validate(self, payload, sensor_type: str = None) -> str:
+        '''
+        Validate and coerce payload in place ("value", and "timestamp" as epoch ms). Returns the sensor type.
+        With sensor_type (stored readings) the schema of that type is used, whatever sensor ids are configured.
+        '''
+        if not isinstance(payload, dict):
+            raise InvalidReading("not_an_object")
+
+        sensor = payload.get("sensor")
+        if not isinstance(sensor, str) or not sensor:
+            raise InvalidReading("missing_sensor")
+        if payload.get("value") is None:
+            raise InvalidReading("missing_value")
+
+        if sensor_type is None:
+            entry = self._table.get(sensor, self._unknown)
+        else:
+            entry = (sensor_type, COERCERS[sensor_type]) if sensor_type in COERCERS else None
+        if entry is None:
+            raise InvalidReading("unknown_sensor")
+        sensor_type, coerce = entry
+        payload["value"] = coerce(payload["value"])
+
+        timestamp = payload.get("timestamp")
+        if timestamp is not None:
+            # Parsed once here (numbers and ISO strings), the EdgeProcessor gets epoch milliseconds.
+            # Text that is not a date, NaN, infinities and out of range values are rejected
+            try:
+                timestamp = timestamp_ms(timestamp)
+            except ValueError:
+                raise InvalidReading("invalid_timestamp")
+            if not 0 <= timestamp <= MAX_TIMESTAMP_MS:
+                raise InvalidReading("invalid_timestamp")
+            payload["timestamp"] = timestamp
+
+        message_id = payload.get("message_id")
+        if message_id is not None and (not isinstance(message_id, str) or not 0 < len(message_id) <= MAX_MESSAGE_ID_LENGTH):
+            raise InvalidReading("invalid_message_id")
+
+        return sensor_type
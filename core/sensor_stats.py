@@ -0,0 +1,141 @@
+import os
+import math
+import logging
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+SENSOR_STATS_CAPACITY = int(os.getenv("SENSOR_STATS_CAPACITY", 16384))
+# Weight of the newest reading in the exponential moving average
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", 0.1))
+# Readings per window of the rolling min/max (covers between 1x and 2x this number of readings)
+ROLLING_WINDOW = int(os.getenv("ROLLING_WINDOW", 100))
+# Smallest standard deviation used for the z-score, in units of the sensor: a quantized sensor (whole % of battery)
+# that stays flat does not turn a one-unit step into an anomaly
+ANOMALY_MIN_STD = float(os.getenv("ANOMALY_MIN_STD", 1))
+
+
+class SensorStats:
+
+    '''
+        Incremental statistics of every numeric sensor with O(1) cost per reading and bounded memory.
+        Every sensor gets a slot in preallocated arrays (one array per statistic, SENSOR_STATS_CAPACITY slots):
+        - count / mean / m2: Welford's algorithm for the mean and variance
+        - ewma: exponential moving average
+        - rolling min/max: two consecutive windows of ROLLING_WINDOW readings (current and previous),
+          so the value covers the last ROLLING_WINDOW to 2*ROLLING_WINDOW readings without storing them
+        When all the slots are taken new sensors are not tracked (a warning is logged once).
+    '''
+
+    def __init__(self, capacity: int = SENSOR_STATS_CAPACITY, alpha: float = EWMA_ALPHA, window: int = ROLLING_WINDOW,
+                 min_std: float = ANOMALY_MIN_STD):
+        self.capacity = capacity
+        self.alpha = alpha
+        self.window = window
+        self.min_std = min_std
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._full_warned = False
+
+        zeros = [0.0] * capacity
+        self._count = array("q", [0] * capacity)
+        self._mean = array("d", zeros)
+        self._m2 = array("d", zeros)
+        self._ewma = array("d", zeros)
+        self._min = array("d", zeros)
+        self._max = array("d", zeros)
+        self._prev_min = array("d", zeros)
+        self._prev_max = array("d", zeros)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _slot(self, sensor):
+        slot = self._slots.get(sensor)
+        if slot is None:
+            if len(self._slots) >= self.capacity:
+                if not self._full_warned:
+                    logger.warning(f"SensorStats lleno ({self.capacity} sensores), los nuevos no se analizan")
+                    self._full_warned = True
+                return None
+            slot = self._slots[sensor] = len(self._slots)
+        return slot
+
+    # ===============================
+    # UPDATE
+    # ===============================
+
+    def update(self, sensor, value: float):
+        '''
+        Add a reading and return the z-score of value against the statistics BEFORE this reading
+        (None while there are fewer than 2 readings, or if the sensor can not be tracked).
+        The std is at least min_std, so a flat history (std 0) still scores a jump by its size.
+        '''
+        value = float(value)
+        with self._lock:
+            slot = self._slot(sensor)
+            if slot is None:
+                return None
+
+            n = self._count[slot]
+            zscore = None
+            if n >= 2:
+                std = max(math.sqrt(self._m2[slot] / (n - 1)), self.min_std)
+                deviation = value - self._mean[slot]
+                if std > 0:
+                    zscore = deviation / std
+                else:
+                    # min_std 0: exact values are compared as they are
+                    zscore = math.copysign(math.inf, deviation) if deviation else 0.0
+
+            # Welford
+            n += 1
+            delta = value - self._mean[slot]
+            self._mean[slot] += delta / n
+            self._m2[slot] += delta * (value - self._mean[slot])
+            self._count[slot] = n
+
+            # EWMA
+            self._ewma[slot] = value if n == 1 else self.alpha * value + (1 - self.alpha) * self._ewma[slot]
+
+            # Rolling min/max: a new window starts every `window` readings
+            if (n - 1) % self.window == 0:
+                if n == 1:
+                    self._prev_min[slot] = self._prev_max[slot] = value
+                else:
+                    self._prev_min[slot] = self._min[slot]
+                    self._prev_max[slot] = self._max[slot]
+                self._min[slot] = self._max[slot] = value
+            else:
+                if value < self._min[slot]:
+                    self._min[slot] = value
+                if value > self._max[slot]:
+                    self._max[slot] = value
+
+            return zscore
+
+    # ===============================
+    # READ
+    # ===============================
+
+    def count(self, sensor) -> int:
+        '''Number of readings of a sensor.'''
+        slot = self._slots.get(sensor)
+        return 0 if slot is None else self._count[slot]
+
+    def get(self, sensor):
+        '''Statistics of a sensor, or None if it has no readings.'''
+        with self._lock:
+            slot = self._slots.get(sensor)
+            if slot is None:
+                return None
+            n = self._count[slot]
+            return {
+                "count": n,
+                "mean": self._mean[slot],
+                "std": math.sqrt(self._m2[slot] / (n - 1)) if n >= 2 else 0.0,
+                "ewma": self._ewma[slot],
+                "min": min(self._min[slot], self._prev_min[slot]),
+                "max": max(self._max[slot], self._prev_max[slot]),
+            }
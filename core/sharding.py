@@ -0,0 +1,91 @@
+import os
+import zlib
+
+# ===============================
+# ENV VARIABLES
+# ===============================
+# SHARD_COUNT is the total number of shards across all containers,
+# SHARD_WORKERS the number of BentoML workers (shards) running in this container
+# and SHARD_OFFSET the index of the first shard owned by this container.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", SHARD_COUNT))
+SHARD_OFFSET = int(os.getenv("SHARD_OFFSET", 0))
+# If set, the listeners subscribe with an MQTT v5 shared subscription
+# ($share/<group>/<topic>) and the broker balances messages between them (round-robin, not by device)
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP")
+
+
+def device_from_topic(topic: str) -> str:
+    '''Extract the device id from a "devices/<device_id>/readings" topic. Falls back to the full topic.'''
+    parts = topic.split("/")
+    if len(parts) >= 3 and parts[0] == "devices":
+        return parts[1]
+    return topic
+
+
+def shard_for(key: str, shard_count: int = SHARD_COUNT) -> int:
+    '''Stable shard number for a key. crc32 is used instead of hash() because it is the same on every process.'''
+    if shard_count <= 1:
+        return 0
+    return zlib.crc32(key.encode()) % shard_count
+
+
+class Shard:
+
+    '''
+        Partition of the devices owned by one listener/writer pair.
+        Every shard has its own disk queue file and its own flusher, so several workers
+        (or containers) can run in parallel without any distributed lock.
+    '''
+
+    def __init__(self, index: int = 0, count: int = SHARD_COUNT, shared_group: str = MQTT_SHARED_GROUP):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Shard inválido: {index}/{count}")
+        self.index = index
+        self.count = count
+        self.shared_group = shared_group
+
+    @classmethod
+    def from_worker(cls, worker_index):
+        '''Build the shard for a BentoML worker (worker_index is 1-based, None outside a server).'''
+        return cls(index=SHARD_OFFSET + max((worker_index or 1) - 1, 0))
+
+    @property
+    def name(self) -> str:
+        return f"shard-{self.index}"
+
+    @property
+    def per_device(self) -> bool:
+        '''
+        Whether every device belongs to one shard. A shared subscription spreads the messages round-robin:
+        the readings of a device (their order, sensor statistics and last values) are split between the shards.
+        '''
+        return not self.shared_group
+
+    # ===============================
+    # ROUTING
+    # ===============================
+
+    def owns(self, topic: str) -> bool:
+        '''Whether a message received on topic belongs to this shard.'''
+        # With shared subscriptions the broker already did the partition
+        if self.count <= 1 or self.shared_group:
+            return True
+        return shard_for(device_from_topic(topic), self.count) == self.index
+
+    def subscription(self, topic: str) -> str:
+        '''Topic filter this shard must subscribe to.'''
+        if self.shared_group:
+            return f"$share/{self.shared_group}/{topic}"
+        return topic
+
+    # ===============================
+    # QUEUE FILE
+    # ===============================
+
+    def queue_file(self, base_path: str) -> str:
+        '''Disk queue file of this shard: pending_readings.log -> pending_readings.shard-1.log'''
+        if self.count <= 1 or not base_path:
+            return base_path
+        root, ext = os.path.splitext(base_path)
+        return f"{root}.{self.name}{ext}"
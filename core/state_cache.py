@@ -0,0 +1,96 @@
+import threading
+
+
+class _Entry:
+
+    '''Last value of one sensor. __slots__ keeps every entry small (no per-instance dict).'''
+
+    __slots__ = ("sensor", "device", "type", "value", "time", "version")
+
+    def __init__(self, sensor, device, sensor_type, value, time, version):
+        self.sensor = sensor
+        self.device = device
+        self.type = sensor_type
+        self.value = value
+        self.time = time
+        self.version = version
+
+    def as_dict(self):
+        return {
+            "sensor": self.sensor,
+            "device": self.device,
+            "type": self.type,
+            "value": self.value,
+            "time": self.time,
+            "version": self.version,
+        }
+
+
+class FleetState:
+
+    '''
+        In-memory last-value cache of every sensor, updated by the listener after the EdgeProcessor.
+        Entries live in a list (one slot per sensor, never removed) indexed by sensor id, and every update
+        gets a new version number, so readers can ask for the whole fleet or only for what changed since
+        the last version they saw. Live status reads never touch PocketBase.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._entries = []
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ===============================
+    # UPDATE
+    # ===============================
+
+    def update(self, sensor, sensor_type, value, time, device=None):
+        with self._lock:
+            self.version += 1
+            slot = self._slots.get(sensor)
+            if slot is None:
+                self._slots[sensor] = len(self._entries)
+                self._entries.append(_Entry(sensor, device or sensor, sensor_type, value, time, self.version))
+                return
+            entry = self._entries[slot]
+            entry.type = sensor_type
+            entry.value = value
+            entry.time = time
+            entry.version = self.version
+            if device:
+                entry.device = device
+
+    def update_from(self, processed: dict, device=None):
+        '''Update with an EdgeProcessor result. Only valid readings (normal_record) change the state.'''
+        record = processed.get("normal_record")
+        if record:
+            self.update(record["sensor"], record["type"], record["value"], record["time"], device)
+
+    # ===============================
+    # READ
+    # ===============================
+
+    def snapshot(self):
+        '''Whole fleet: last value of every sensor grouped by device (AGV).'''
+        with self._lock:
+            version = self.version
+            entries = [entry.as_dict() for entry in self._entries]
+
+        devices = {}
+        for entry in entries:
+            device = devices.setdefault(entry["device"], {})
+            device[entry["type"]] = {"value": entry["value"], "time": entry["time"], "sensor": entry["sensor"]}
+        return {"version": version, "devices": devices}
+
+    def delta(self, since: int):
+        '''Sensors updated after version since. If since is newer than the cache (restart), returns every sensor with full=True.'''
+        with self._lock:
+            full = since > self.version
+            if full:
+                since = 0
+            changed = [entry.as_dict() for entry in self._entries if entry.version > since]
+            return {"version": self.version, "full": full, "sensors": changed}
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import base64
+import logging
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+PB_URL = os.getenv("POCKETBASE_URL")
+# The same (super)user the Benthos outputs need. Falls back to the normal user if it is not configured
+AUTH_COLLECTION = os.getenv("AUTHENTICATION_COLLECTION", "_superusers") if os.getenv("POCKETBASE_SUPERUSER") else "users"
+AUTH_IDENTITY = os.getenv("POCKETBASE_SUPERUSER") or os.getenv("POCKETBASE_USER")
+AUTH_PASSWORD = os.getenv("POCKETBASE_SUPERPASSWORD") if os.getenv("POCKETBASE_SUPERUSER") else os.getenv("POCKETBASE_PASSWORD")
+# Seconds before the expiry when the token is refreshed in background
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", 300))
+TOKEN_RETRY_DELAY = float(os.getenv("TOKEN_RETRY_DELAY", 5))
+
+
+def jwt_expiry(token: str):
+    '''Expiry (epoch seconds) of a JWT, from the "exp" claim. The signature is not checked. None if it can not be read.'''
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+
+    '''
+        Keeps a valid PocketBase token for all the HTTP clients of the process (PocketBaseClient, BatchWriter -> Benthos).
+        The expiry is read from the JWT and a background thread refreshes the token TOKEN_REFRESH_MARGIN seconds before it lapses,
+        so requests never pay a 401 plus a retry. Refreshes are single-flight: if many threads ask for a new token at the same
+        time only one request is made to PocketBase and the rest get its result.
+    '''
+
+    def __init__(self, collection=AUTH_COLLECTION, identity=AUTH_IDENTITY, password=AUTH_PASSWORD, margin=TOKEN_REFRESH_MARGIN):
+        self.collection = collection
+        self.identity = identity
+        self.password = password
+        self.margin = margin
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ===============================
+    # PUBLIC
+    # ===============================
+
+    def get(self) -> str:
+        '''Current token, authenticating if there is none or it already expired.'''
+        token = self._token
+        if token and not self._expired():
+            return token
+        return self.refresh(stale=token)
+
+    @property
+    def token(self):
+        '''Last token obtained (None before the first authentication), without refreshing it.'''
+        return self._token
+
+    def authorization(self) -> str:
+        '''Value of the Authorization header.'''
+        return f"Bearer {self.get()}"
+
+    def refresh(self, stale=None) -> str:
+        '''
+        Get a new token. stale is the token the caller saw as invalid (for example after a 401):
+        if another thread already replaced it, that new token is returned without calling PocketBase.
+        '''
+        with self._lock:
+            if self._token is not None and self._token != stale and not self._expired():
+                return self._token
+
+            token = self._auth_refresh() if self._token and not self._expired() else None
+            if token is None:
+                token = self._auth_with_password()
+
+            self._token = token
+            self._expires_at = jwt_expiry(token)
+            logger.info("Token de PocketBase renovado")
+
+        self._ensure_thread()
+        return token
+
+    def stop(self):
+        self._stop.set()
+
+    # ===============================
+    # INTERNAL
+    # ===============================
+
+    def _expired(self):
+        return self._expires_at is not None and time.time() >= self._expires_at
+
+    def _auth_with_password(self):
+        url = f"{PB_URL}/api/collections/{self.collection}/auth-with-password"
+        r = requests.post(url, json={"identity": self.identity, "password": self.password}, timeout=10)
+        r.raise_for_status()
+        return r.json()["token"]
+
+    def _auth_refresh(self):
+        '''Renew a still valid token without sending the password. None if PocketBase refuses it.'''
+        url = f"{PB_URL}/api/collections/{self.collection}/auth-refresh"
+        try:
+            r = requests.post(url, headers={"Authorization": f"Bearer {self._token}"}, timeout=10)
+            if r.status_code == 200:
+                return r.json()["token"]
+        except requests.RequestException as e:
+            logger.warning(f"auth-refresh falló, usando contraseña: {e}")
+        return None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            if self._expires_at is None:
+                # Token without "exp": nothing to anticipate, it is renewed on the next 401
+                return
+            remaining = self._expires_at - time.time()
+            # Short tokens (less than twice the margin) are renewed at half of their remaining life
+            wait = max(remaining - self.margin, remaining / 2, 1)
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh(stale=self._token)
+            except Exception as e:
+                logger.error(f"No se pudo renovar el token de PocketBase: {e}")
+                self._stop.wait(TOKEN_RETRY_DELAY)
+
+
+# ===============================
+# Default instance (lazy)
+# ===============================
+_default_manager = None
+_default_lock = threading.Lock()
+
+
+def get_token_manager():
+    '''Token manager shared by every client of the process.'''
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = TokenManager()
+        return _default_manager
@@ -1,15 +1,148 @@
-import uuid
+import os
+import math
+import time
+import threading
+from collections import deque
 from datetime import datetime, timezone
 
+# Fields that carry epoch milliseconds inside the pipeline and are formatted as ISO only at the sink
+TIME_FIELDS = ("time", "timestamp", "ingestion_timestamp")
+
+_id_lock = threading.Lock()
+_last_ms = 0
+_sequence = 0
+
+
 def fahrenheit_a_celsius(fahrenheit: float) -> float:
     '''Convert a temperature from Fahrenheit to Celsius.'''
     return (fahrenheit - 32) * 5 / 9
 
-def build_ingestion_metadata():
-    '''Build the metadata for the ingestion, including a unique message_id and an ingestion_timestamp in ISO format.'''
+# ===============================
+# TIME
+# ===============================
+
+def now_ms() -> int:
+    '''Current time as epoch milliseconds.'''
+    return time.time_ns() // 1_000_000
+
+def timestamp_ms(value) -> int:
+    '''
+    Convert a device timestamp to epoch milliseconds: ints/floats (seconds or milliseconds) or ISO 8601 strings.
+    Raises ValueError for anything else (text that is not a date, booleans, NaN or infinities).
+    '''
+    if isinstance(value, bool):
+        raise ValueError(f"invalid timestamp: {value!r}")
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            raise ValueError(f"invalid timestamp: {value!r}")
+        # Less than 1e11 can only be seconds (year 5138 in seconds, 1973 in milliseconds)
+        return int(value * 1000) if value < 1e11 else int(value)
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return int(parsed.timestamp() * 1000)
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+        raise ValueError(f"invalid timestamp: {value!r}")
+
+def parse_timestamp_ms(value) -> int:
+    '''
+    Like timestamp_ms, but a missing or invalid value is the current time. The validator (core/schema.py) already
+    rejects invalid timestamps and passes them on as epoch ms, so here they are only used as they are.
+    '''
+    if value is None:
+        return now_ms()
+    try:
+        return timestamp_ms(value)
+    except ValueError:
+        return now_ms()
+
+def ms_to_iso(ms: int) -> str:
+    '''Format epoch milliseconds as an ISO 8601 UTC string (2026-03-05T18:02:10.000Z).'''
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ms // 1000)) + f".{ms % 1000:03d}Z"
+
+def format_times(record: dict) -> dict:
+    '''Copy of record with the epoch millisecond TIME_FIELDS formatted as ISO strings, for the sink.'''
+    formatted = dict(record)
+    for field in TIME_FIELDS:
+        value = formatted.get(field)
+        if isinstance(value, int) and not isinstance(value, bool):
+            formatted[field] = ms_to_iso(value)
+    return formatted
+
+# ===============================
+# IDS
+# ===============================
+
+def new_message_id() -> str:
+    '''
+    Time-ordered unique id with the UUIDv7 layout: 48 bits of epoch milliseconds, a 12 bit counter and 62 random bits.
+    Ids generated by this process are strictly increasing, so they sort by creation time as plain strings.
+    '''
+    global _last_ms, _sequence
+    with _id_lock:
+        ms = now_ms()
+        if ms > _last_ms:
+            _last_ms = ms
+            _sequence = 0
+        else:
+            # Same millisecond (or clock going back): keep the last one and increase the counter
+            _sequence += 1
+            if _sequence > 0xFFF:
+                _last_ms += 1
+                _sequence = 0
+        ms, sequence = _last_ms, _sequence
+
+    value = (ms << 80) | (0x7 << 76) | (sequence << 64) | (0b10 << 62) | (int.from_bytes(os.urandom(8), "big") >> 2)
+    h = f"{value:032x}"
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+def message_id_ms(message_id: str):
+    '''Creation time (epoch ms) of an id made by new_message_id. None for other ids (for example uuid4 from devices).'''
+    if not isinstance(message_id, str) or len(message_id) != 36 or message_id[14] != "7":
+        return None
+    try:
+        return int(message_id[:8] + message_id[9:13], 16)
+    except ValueError:
+        return None
+
+class RecentIds:
+
+    '''
+        Dedup window with the last `size` message_ids seen. Lookups are O(1) (set) and the oldest id
+        is forgotten first (deque), so memory stays bounded no matter how long the process runs.
+    '''
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ids = set()
+        self._order = deque()
+
+    def __contains__(self, message_id):
+        return message_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, message_id) -> bool:
+        '''Remember message_id. Returns False if it was already in the window (duplicate).'''
+        if message_id in self._ids:
+            return False
+        self._ids.add(message_id)
+        self._order.append(message_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+# ===============================
+# METADATA
+# ===============================
+
+def build_ingestion_metadata(message_id: str = None):
+    '''Build the metadata for the ingestion: a time-ordered message_id (unless one is given) and the ingestion_timestamp in epoch ms.'''
     return {
-        "message_id": str(uuid.uuid4()),
-        "ingestion_timestamp": datetime.now(timezone.utc).isoformat()
+        "message_id": message_id or new_message_id(),
+        "ingestion_timestamp": now_ms()
     }
 
 def enrich_message(device_id: str, temp_f: float):
@@ -21,4 +154,4 @@ def enrich_message(device_id: str, temp_f: float):
         "device_id": device_id,
         "temp_f": temp_f,
         "temp_c": round(temp_c, 2)
-    }
\ No newline at end of file
+    }
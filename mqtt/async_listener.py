@@ -0,0 +1,141 @@
+import os
+import asyncio
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+from mqtt import listener
+from mqtt.listener import MQTT_BROKER, MQTT_PORT
+
+logger = logging.getLogger(__name__)
+
+# "threads" (paho network thread + flusher thread) or "asyncio" (one event loop, see AsyncListener)
+RUNTIME = os.getenv("RUNTIME", "threads").lower()
+MQTT_RECONNECT_MAX_DELAY = float(os.getenv("MQTT_RECONNECT_MAX_DELAY", 30))
+
+
+class AsyncioHelper:
+
+    '''
+        Drives the socket of a paho client from an asyncio loop with the external event loop hooks:
+        the socket is read/written when the loop reports it ready (loop_read / loop_write) instead of
+        from paho's own thread. The hooks can be called from other threads (publish from the publisher thread,
+        reconnect from the executor), so they are moved to the loop thread.
+    '''
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        # Set by the loop thread once it runs
+        self.thread_id = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, fn, *args):
+        # A closed socket can not be unregistered later: run now if already in the loop thread
+        if threading.get_ident() == self.thread_id:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+
+class AsyncListener:
+
+    '''
+        asyncio runtime: the MQTT client (AsyncioHelper), the flusher of an AsyncBatchWriter and its HTTP sends
+        run on one event loop in one thread, instead of paho's network thread plus a flusher thread with blocking
+        requests and sleeps. The disk operations run in the writer's disk executor.
+        Same callbacks as mqtt/listener.py; enabled with RUNTIME=asyncio.
+    '''
+
+    def __init__(self, batch_writer, shard=None, state=None, pool=None):
+        self.batch_writer = batch_writer
+        self.client = listener.create_client(batch_writer, shard, state, pool)
+        self.loop = asyncio.new_event_loop()
+        self.helper = AsyncioHelper(self.loop, self.client)
+        self.thread = None
+        self._stopping = False
+        self._tasks = []
+
+    def start(self):
+        '''Start the event loop thread with the connection and the flusher. Returns self.'''
+        self.client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+        self.thread = threading.Thread(target=self.loop.run_forever, name="asyncio-engine", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_tasks(), self.loop).result()
+        shard = self.client.user_data_get()["shard"]
+        logger.info(f"MQTT listener asyncio iniciado ({shard.name}/{shard.count})")
+        return self
+
+    async def _start_tasks(self):
+        self.helper.thread_id = threading.get_ident()
+        self._tasks = [
+            asyncio.create_task(self._connection()),
+            asyncio.create_task(self.batch_writer.run()),
+        ]
+
+    async def _connection(self):
+        '''Connect, keep the connection alive (loop_misc every second) and reconnect with backoff.'''
+        delay = 1
+        while not self._stopping:
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                delay = 1
+                while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                    await asyncio.sleep(1)
+                if self._stopping:
+                    return
+                logger.warning("Conexión MQTT perdida")
+            except OSError as e:
+                logger.error(f"No se pudo conectar a MQTT broker: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
+
+    def pause(self):
+        '''Unsubscribe so no new messages reach the batch writer.'''
+        listener.pause(self.client)
+
+    def stop(self, drain_timeout):
+        '''Stop receiving messages, drain the writer within drain_timeout seconds, disconnect and stop the loop.'''
+        self.pause()
+        pool = self.client.user_data_get()["pool"]
+        if pool is not None:
+            # The results still in the worker processes go to the writer before the drain
+            pool.stop()
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(drain_timeout), self.loop)
+        try:
+            return future.result(timeout=drain_timeout + 5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+            logger.info("MQTT listener asyncio parado")
+
+    async def _shutdown(self, drain_timeout):
+        tasks, self._tasks = self._tasks, []
+        # The flusher first, so drain() is the only one using the disk queue
+        tasks[1].cancel()
+        await asyncio.gather(tasks[1], return_exceptions=True)
+        pending = await self.batch_writer.drain(drain_timeout)
+
+        self._stopping = True
+        self.client.disconnect()
+        # Let the loop write the DISCONNECT packet
+        await asyncio.sleep(0.1)
+        tasks[0].cancel()
+        await asyncio.gather(tasks[0], return_exceptions=True)
+        return pending
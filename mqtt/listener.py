@@ -1,13 +1,11 @@
 import os
 import json
 import logging
-import threading
 import paho.mqtt.client as mqtt
-import datetime
-import uuid
 
-from core.batch_writer import batch_writer
-from core.edge_proccesor import EdgeProcessor
+from core.batch_writer import get_batch_writer
+from core.edge_proccesor import EdgeProcessor, PUBLISHED_ALERTS, BATTERY_ID, TEMP_ID
+from core.sharding import Shard, device_from_topic
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -18,12 +16,6 @@ logging.basicConfig(level=logging.INFO)
 MQTT_BROKER = os.getenv("MQTT_BROKER")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC")
-MQTT_PUBLISH_TOPIC_ALERTS = os.getenv("MQTT_PUBLISH_TOPIC_ALERTS")
-
-BATTERY_ID = os.getenv("BATTERY_ID")
-TEMP_ID = os.getenv("TEMP_ID")
-STATUS_ID = os.getenv("STATUS_ID")
-HAS_PALLET_ID = os.getenv("HAS_PALLET_ID")
 
 COLLECTION_READINGS = os.getenv("COLLECTION_READINGS")
 COLLECTION_URGENT = os.getenv("COLLECTION_URGENT")
@@ -39,102 +31,143 @@ edge_processor = EdgeProcessor()
 # ===============================
 # CALLBACKS MQTT
 # ===============================
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         logger.info("Conectado a MQTT broker")
-        client.subscribe(MQTT_TOPIC)
-        logger.info(f"Suscrito a topic: {MQTT_TOPIC}")
+        topic = userdata["shard"].subscription(MQTT_TOPIC)
+        client.subscribe(topic)
+        logger.info(f"Suscrito a topic: {topic}")
     else:
         logger.error(f"Error al conectar a MQTT broker: {rc}")
 
 def on_message(client, userdata, msg):
-    try:
-        payload = json.loads(msg.payload.decode())
+    # Messages of devices owned by other shards are discarded before decoding them
+    if not userdata["shard"].owns(msg.topic):
+        return
 
-        if "sensor" not in payload or "value" not in payload:
-            logger.warning(f"Mensaje MQTT incompleto: {payload}")
+    writer = userdata["batch_writer"]
+    try:
+        try:
+            payload = json.loads(msg.payload)
+        except ValueError:
+            raw = msg.payload.decode(errors="replace")
+            logger.warning(f"Mensaje MQTT descartado (invalid_json): {raw}")
+            writer.publisher.publish_dead_letter({"topic": msg.topic, "payload": raw}, "invalid: invalid_json")
             return
 
-        # Automatic timestamp
-        if "timestamp" not in payload:
-            payload["timestamp"] = datetime.datetime.utcnow().isoformat() + "Z"
-
-        # Generación automática de message_id único para trazabilidad
-        if "message_id" not in payload:
-            payload["message_id"] = str(uuid.uuid4())
-
-        sensor_id = payload["sensor"]
-
-        # ===============================
-        # Establish sensor type
-        # ===============================
-        if sensor_id == BATTERY_ID:
-            sensor_type = "battery"
-        elif sensor_id == TEMP_ID:
-            sensor_type = "temperature"
-        elif sensor_id == STATUS_ID:
-            sensor_type = "status"
-        elif sensor_id == HAS_PALLET_ID:
-            sensor_type = "has_pallet"
-        else:
-            sensor_type = "unknown"
-
-        logger.info(f"Procesando sensor {sensor_id} tipo {sensor_type}")
-
-        # ===============================
-        # Proccess readings
-        # ===============================
-        result = edge_processor.process_reading(
-            payload,
-            sensor_type=sensor_type,
-            sensor_id=sensor_id
-        )
+        pool = userdata.get("pool")
+        if pool is not None:
+            # Validation and rules run in the worker processes, the results come back to deliver() in micro-batches
+            pool.submit(msg.topic, payload)
+            return
 
+        result, reason = edge_processor.process_payload(payload)
         if not result:
-            logger.warning(f"EdgeProcessor devolvió None para: {payload}")
+            # Invalid payloads go straight to the error topic: never queued nor sent to Benthos
+            logger.warning(f"Mensaje MQTT descartado ({reason}): {payload}")
+            writer.publisher.publish_dead_letter({"topic": msg.topic, "payload": payload}, f"invalid: {reason}")
             return
 
         normal_record = result.get("normal_record")
         alerts = result.get("alerts", [])
 
+        # Last value of the sensor for the live fleet status endpoints
+        if userdata["state"] is not None:
+            userdata["state"].update_from(result, device=device_from_topic(msg.topic))
+
         # ===============================
         # save alerts (Normal alerts and invalid alerts )
         # ===============================
 
         # [SOLVED] batch_writer.add is called only once & deleted extracting AGV_ID on edge proccesor for avoiding errors here
 
-        if normal_record and isinstance(normal_record.get("time"), datetime.datetime):
-            normal_record["time"] = normal_record["time"].strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        for alert in alerts:
-            if isinstance(alert.get("timestamp"), datetime.datetime):
-                alert["timestamp"] = alert["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ")
-
         if alerts or normal_record:
-            batch_writer.add({"normal_record": normal_record, "alerts": alerts})
+            writer.add({"normal_record": normal_record, "alerts": alerts})
             logger.info(f"Enviando a batch_writer: normal_record = {normal_record}, alerts={alerts}")
 
+        # Published from the publisher thread, the callback does not wait for the broker
         for alert in alerts:
-            if alert["type"] in ("battery_low", "overheat"):
-                try:
-                    client.publish(MQTT_PUBLISH_TOPIC_ALERTS, json.dumps(alert))
-                    logger.info(f"Publicado en topic {MQTT_PUBLISH_TOPIC_ALERTS}: {alert}")
-                except Exception as e:
-                    logger.error(f"Error publicando alerta MQTT: {e}")
+            if alert["type"] in PUBLISHED_ALERTS:
+                writer.publisher.publish_alert(alert)
     except Exception as e:
         logger.error(f"Error procesando mensaje MQTT: {e}")
 
+def deliver(writer, state, items):
+    '''
+    Results of the edge worker processes (core/edge_pool.py), a micro-batch of (topic, payload, result, reason)
+    in the order of the readings of every sensor: a single disk append for the whole micro-batch.
+    '''
+    results = []
+    for topic, payload, result, reason in items:
+        if not result:
+            logger.warning(f"Mensaje MQTT descartado ({reason}): {payload}")
+            writer.publisher.publish_dead_letter({"topic": topic, "payload": payload}, f"invalid: {reason}")
+            continue
+        if state is not None:
+            state.update_from(result, device=device_from_topic(topic))
+        if result.get("normal_record") or result.get("alerts"):
+            results.append(result)
+
+    if results:
+        writer.add_many(results)
+    for result in results:
+        for alert in result.get("alerts", []):
+            if alert["type"] in PUBLISHED_ALERTS:
+                writer.publisher.publish_alert(alert)
+
 # ===============================
 # START LISTENER
 # ===============================
-def start(batch_writer_instance=None):
-    client = mqtt.Client()
+def create_client(batch_writer_instance=None, shard=None, state=None, pool=None):
+    '''
+    MQTT client with the listener callbacks, not connected. Messages are sent to batch_writer_instance
+    and, if given, the last value of every sensor is kept in state (core.state_cache.FleetState).
+    With a pool (core.edge_pool.EdgePool, started with deliver) the edge processing runs in its worker processes.
+    '''
+    shard = shard or Shard()
+    writer = batch_writer_instance or get_batch_writer()
+    userdata = {
+        "batch_writer": writer,
+        "shard": shard,
+        "state": state,
+        "pool": pool,
+    }
+
+    if shard.shared_group:
+        # Shared subscriptions ($share/...) need MQTT v5
+        client = mqtt.Client(client_id=f"bento-{shard.name}-{os.getpid()}", userdata=userdata, protocol=mqtt.MQTTv5)
+    else:
+        client = mqtt.Client(userdata=userdata)
     client.on_connect = on_connect
     client.on_message = on_message
 
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    # The writer publishes the alerts and the failed records with this client
+    if writer.publisher.client is None:
+        writer.publisher.attach(client)
+    return client
+
+
+def start(batch_writer_instance=None, shard=None, state=None, pool=None):
+    '''Start the MQTT listener in background (paho network thread) and return the client. See create_client.'''
+    client = create_client(batch_writer_instance, shard, state, pool)
+    shard = client.user_data_get()["shard"]
+
+    # connect_async + loop_start: does not block and paho keeps reconnecting if the broker is down
+    client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+    client.loop_start()
+
+    logger.info(f"MQTT listener iniciado en segundo plano ({shard.name}/{shard.count})")
+    return client
+
+
+def pause(client):
+    '''Unsubscribe so no new messages reach the batch writer. The client stays connected to publish the errors.'''
+    client.unsubscribe(client.user_data_get()["shard"].subscription(MQTT_TOPIC))
+    logger.info("MQTT listener en pausa")
 
-    thread = threading.Thread(target=client.loop_forever, daemon=True)
-    thread.start()
 
-    logger.info("MQTT listener iniciado en segundo plano")
\ No newline at end of file
+def stop(client):
+    '''Disconnect the MQTT client and stop its network thread.'''
+    client.disconnect()
+    client.loop_stop()
+    logger.info("MQTT listener parado")
@@ -0,0 +1,30 @@
+from core.adaptive_batch import AdaptiveBatchSize
+
+
+def test_batch_grows_while_fast_and_full():
+
+    '''Test that the batch size grows additively while Benthos is fast and batches are full.'''
+    controller = AdaptiveBatchSize(5, minimum=1, maximum=30, target_latency=1.0, step=10, backoff=0.5)
+
+    assert controller.record(size=5, latency=0.1, ok=True) == 15
+    assert controller.record(size=15, latency=0.1, ok=True) == 25
+    assert controller.record(size=25, latency=0.1, ok=True) == 30
+
+
+def test_batch_does_not_grow_with_a_trickle():
+
+    '''Test that partial batches (no backlog) do not make the batch grow.'''
+    controller = AdaptiveBatchSize(5, minimum=1, maximum=30, target_latency=1.0, step=10, backoff=0.5)
+
+    assert controller.record(size=2, latency=0.1, ok=True) == 5
+
+
+def test_batch_shrinks_on_errors_and_slow_responses():
+
+    '''Test that the batch size is halved on errors or slow responses, never under the minimum.'''
+    controller = AdaptiveBatchSize(40, minimum=4, maximum=100, target_latency=1.0, step=10, backoff=0.5)
+
+    assert controller.record(size=40, latency=2.0, ok=True) == 20
+    assert controller.record(size=20, latency=0.1, ok=False) == 10
+    assert controller.record(size=10, latency=0.1, ok=False) == 5
+    assert controller.record(size=5, latency=0.1, ok=False) == 4
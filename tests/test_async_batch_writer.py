@@ -0,0 +1,65 @@
+import json
+import time
+import asyncio
+import threading
+
+import httpx
+
+import core.async_batch_writer as abw
+from core.async_batch_writer import AsyncBatchWriter
+from core.disk_queue import DiskQueue
+
+
+def test_flush_sends_batches_concurrently(tmp_path, monkeypatch):
+
+    '''Test that the asyncio flusher sends several batches at once, acks the sent records and requeues the rest.'''
+    monkeypatch.setattr(abw, "BENTHOS_URL", "http://benthos/ingest")
+    monkeypatch.setattr(abw, "MAX_RETRIES", 1)
+    posted = []
+
+    def benthos(request):
+        records = json.loads(request.content)
+        posted.append([r["message_id"] for r in records])
+        # "r3" is always rejected with a retryable error
+        return httpx.Response(200, json=[
+            {"message_id": r["message_id"], "status": "error" if r["message_id"] == "r3" else "ok", "code": 503}
+            for r in records
+        ])
+
+    writer = AsyncBatchWriter(concurrency=3)
+    writer.batch_size.value = 2
+    writer._benthos_headers = lambda: {}
+    writer.running = True
+    writer.disk = DiskQueue(str(tmp_path / "queue.log"))
+    writer.disk.append([{"message_id": f"r{i}"} for i in range(6)])
+
+    async def flush():
+        writer.http = httpx.AsyncClient(transport=httpx.MockTransport(benthos))
+        # The retry delay does not fit before the deadline: "r3" stays on disk
+        await writer._flush_async(deadline=time.monotonic() + 0.5)
+        await writer.http.aclose()
+
+    asyncio.run(flush())
+
+    assert sorted(posted) == [["r0", "r1"], ["r2", "r3"], ["r4", "r5"]]
+    assert [r["message_id"] for r in writer.disk.read()] == ["r3"]
+
+
+def test_bulk_add_runs_in_the_disk_executor(tmp_path, monkeypatch):
+
+    '''Test that add_many writes from the disk executor and that stop() works without a flusher thread.'''
+    writer = AsyncBatchWriter(queue_file=str(tmp_path / "queue.log")).start()
+    monkeypatch.setattr(writer, "_is_db_alive", lambda timeout=3: False)
+    threads = []
+    append = writer.disk.append
+
+    def recording_append(records):
+        threads.append(threading.current_thread().name)
+        append(records)
+
+    monkeypatch.setattr(writer.disk, "append", recording_append)
+    written = writer.add_many([{"normal_record": {"message_id": "r0", "type": "battery", "value": 50}, "alerts": []}])
+
+    assert written.result(timeout=5) == [None]
+    assert threads and threads[0].startswith("disk-queue")
+    assert writer.stop(drain_timeout=1) == 1
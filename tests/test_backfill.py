@@ -0,0 +1,143 @@
+import json
+
+import core.batch_writer as bw
+import core.edge_proccesor as edge
+from core.backfill import Backfill, COLLECTION_READINGS, COLLECTION_URGENT
+from core.batch_writer import BatchWriter
+from core.disk_queue import DiskQueue
+
+
+class FakePublisher:
+
+    def __init__(self):
+        self.dead_letters = []
+
+    def start(self):
+        pass
+
+    def publish_dead_letter(self, record, reason):
+        self.dead_letters.append((record, reason))
+
+    def stop(self, timeout=None):
+        pass
+
+
+class FakeWriter:
+
+    '''Writer whose sink accepts every record and remembers the batches.'''
+
+    def __init__(self):
+        self.publisher = FakePublisher()
+        self.batches = []
+
+    def send(self, batch, deadline=None):
+        self.batches.append(batch)
+        return list(batch), []
+
+
+def _write(path, items, torn=None):
+    with open(path, "w") as f:
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+        if torn:
+            f.write(torn)
+    return str(path)
+
+
+def test_backfill_replays_every_source_once(monkeypatch, tmp_path):
+
+    '''Test that envelopes, dead letters, stored records and raw payloads are sent once, revalidated.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    reading = {"message_id": "r1", "sensor": "bat_1", "type": "battery", "value": 50, "time": 1_700_000_000_000}
+    alert = {"message_id": "a1", "sensor": "bat_1", "type": "low_battery", "value": 5, "timestamp": 1_700_000_000_000}
+    pending = _write(tmp_path / "pending.log", [reading, alert], torn='{"message_id": "half')
+    dead = _write(tmp_path / "dead.log", [
+        {"record": reading, "reason": "max_retries_exceeded", "failed_at": 1},
+        {"record": {"topic": "sensors/bat_1", "payload": {"sensor": "bat_1", "value": 40, "message_id": "p1"}},
+         "reason": "invalid_payload", "failed_at": 1},
+        {"record": {"topic": "sensors/bat_1", "payload": {"sensor": "bat_1", "value": "abc"}},
+         "reason": "invalid_payload", "failed_at": 1},
+    ])
+    dump = _write(tmp_path / "dump.jsonl", [
+        {"count": 2, "dead_letters": [{"record": alert, "reason": "rejected"},
+                                      {"record": {**reading, "message_id": "r2"}, "reason": "rejected"}]},
+    ])
+    writer = FakeWriter()
+
+    counts = Backfill(writer, batch=2, concurrency=2).run([pending, dead, dump])
+
+    sent = {r["message_id"]: r for batch in writer.batches for r in batch}
+    assert sorted(sent) == ["a1", "p1", "r1", "r2"]
+    assert sent["r1"]["_collection"] == COLLECTION_READINGS and sent["r1"]["time"] == reading["time"]
+    assert sent["a1"]["_collection"] == COLLECTION_URGENT
+    assert counts == {"read": 7, "sent": 4, "failed": 0, "duplicates": 2, "rejected": 1}
+    assert [reason for _, reason in writer.publisher.dead_letters] == ["invalid: invalid_value"]
+
+
+def test_backfill_resumes_from_the_checkpoint(monkeypatch, tmp_path):
+
+    '''Test that a second run only sends the lines appended after the saved position.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    readings = [{"message_id": f"r{i}", "sensor": "bat_1", "type": "battery", "value": i, "time": 1_700_000_000_000}
+                for i in range(5)]
+    path = _write(tmp_path / "pending.log", readings[:3])
+    checkpoint = str(tmp_path / "backfill.checkpoint")
+
+    Backfill(FakeWriter(), batch=2, checkpoint=checkpoint).run([path])
+    with open(path, "a") as f:
+        for reading in readings[3:]:
+            f.write(json.dumps(reading) + "\n")
+    writer = FakeWriter()
+    counts = Backfill(writer, batch=2, checkpoint=checkpoint).run([path])
+
+    assert [r["message_id"] for batch in writer.batches for r in batch] == ["r3", "r4"]
+    assert counts["sent"] == 2
+
+
+def test_stored_readings_do_not_depend_on_the_configured_sensors(tmp_path):
+
+    '''Test that a stored reading of a sensor not configured on this host is validated against its stored type.'''
+    path = _write(tmp_path / "pending.log", [
+        {"message_id": "r1", "sensor": "old_temp", "type": "temperature", "value": "21.5", "time": 1_700_000_000_000},
+        {"message_id": "r2", "sensor": "old_temp", "type": "temperature", "value": "abc", "time": 1_700_000_000_000},
+    ])
+    writer = FakeWriter()
+
+    counts = Backfill(writer).run([path])
+
+    sent = [r for batch in writer.batches for r in batch]
+    assert [(r["message_id"], r["type"], r["value"]) for r in sent] == [("r1", "temperature", 21.5)]
+    assert counts["rejected"] == 1
+
+
+def test_only_acked_records_count_as_sent(monkeypatch, tmp_path):
+
+    '''Test that records rejected by the sink or by the validation are written to the failed file, not counted as sent.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+
+    class Response:
+        status_code = 200
+        text = ""
+
+        def __init__(self, data):
+            self.data = data
+
+        def json(self):
+            return [{"message_id": r["message_id"], "status": "ok"} if r["message_id"] == "r1"
+                    else {"message_id": r["message_id"], "status": "error", "code": 400} for r in json.loads(self.data)]
+
+    monkeypatch.setattr(bw.requests, "post", lambda url, data, headers, timeout: Response(data))
+    monkeypatch.setattr(BatchWriter, "_benthos_headers", lambda self: {})
+    path = _write(tmp_path / "pending.log", [
+        {"message_id": f"r{i}", "sensor": "bat_1", "type": "battery", "value": value, "time": 1_700_000_000_000}
+        for i, value in enumerate(("abc", 50, 60))
+    ])
+    failed_file = str(tmp_path / "failed.log")
+
+    counts = Backfill(BatchWriter(dead_letter_file=failed_file)).run([path])
+
+    assert (counts["sent"], counts["failed"], counts["rejected"]) == (1, 1, 1)
+    failed = DiskQueue(failed_file).read()
+    assert sorted((d["record"]["message_id"], d["reason"].split(":")[0]) for d in failed) == [
+        ("r0", "invalid"), ("r2", "rejected"),
+    ]
@@ -0,0 +1,238 @@
+import json
+import threading
+import time
+
+from prometheus_client import REGISTRY
+
+import core.batch_writer as bw
+from core.batch_writer import BatchWriter
+from core.disk_queue import DiskQueue
+from core.metrics import WriterMetrics
+
+
+class FakeResponse:
+
+    def __init__(self, outcomes, status_code=200):
+        self.outcomes = outcomes
+        self.status_code = status_code
+        self.text = ""
+
+    def json(self):
+        return self.outcomes
+
+
+def _writer(monkeypatch, responses):
+    '''BatchWriter that answers the Benthos posts with the given outcomes, one list per call.'''
+    posted = []
+
+    def fake_post(url, data, headers, timeout):
+        posted.append(data)
+        return FakeResponse(responses.pop(0))
+
+    monkeypatch.setattr(bw.requests, "post", fake_post)
+    monkeypatch.setattr(bw.time, "sleep", lambda delay: None)
+    writer = BatchWriter()
+    monkeypatch.setattr(writer, "_benthos_headers", lambda: {})
+    monkeypatch.setattr(writer._wakeup, "wait", lambda timeout=None: False)
+    return writer, posted
+
+
+def test_only_failed_records_are_retried(monkeypatch):
+
+    '''Test that a transient failure of one record retries that record only.'''
+    writer, posted = _writer(monkeypatch, [
+        [{"message_id": "a", "status": "ok"}, {"message_id": "b", "status": "error", "code": 503}],
+        [{"message_id": "b", "status": "ok"}],
+    ])
+
+    done = writer._send_with_retry_batch([{"message_id": "a"}, {"message_id": "b"}])
+
+    assert sorted(r["message_id"] for r in done) == ["a", "b"]
+    assert len(posted) == 2
+    assert '"a"' not in posted[1]
+    assert writer.publisher.queue.empty()
+
+
+def test_rejected_records_are_dead_lettered_without_retry(monkeypatch):
+
+    '''Test that a record rejected by PocketBase (400) goes to the error topic and the rest are acked.'''
+    writer, posted = _writer(monkeypatch, [
+        [{"message_id": "a", "status": "ok"}, {"message_id": "b", "status": "error", "code": 400, "error": "bad"}],
+    ])
+
+    done = writer._send_with_retry_batch([{"message_id": "a"}, {"message_id": "b"}])
+
+    assert sorted(r["message_id"] for r in done) == ["a", "b"]
+    assert len(posted) == 1
+    kind, dead_letter = writer.publisher.queue.get_nowait()
+    assert kind == "dead" and dead_letter["record"]["message_id"] == "b"
+    assert dead_letter["reason"].startswith("rejected: 400")
+
+
+def test_flush_acks_sent_records_and_requeues_the_rest(tmp_path, monkeypatch):
+
+    '''Test that a drain acks the uploaded records and keeps the failed one on disk for the next start.'''
+    writer, posted = _writer(monkeypatch, [
+        [{"message_id": "a", "status": "ok"}, {"message_id": "b", "status": "error", "code": 503}],
+    ])
+    writer.disk = DiskQueue(str(tmp_path / "queue.log"))
+    writer.disk.append([{"message_id": "a"}, {"message_id": "b"}])
+
+    # The retry delay does not fit before the deadline: "b" stays pending
+    writer._flush(deadline=time.monotonic() + 0.5)
+
+    assert len(posted) == 1
+    assert [r["message_id"] for r in DiskQueue(writer.disk.file_path).read()] == ["b"]
+
+
+def test_flush_sets_the_prometheus_gauges(tmp_path, monkeypatch):
+
+    '''Test that the flusher writes the gauges after a batch instead of relying on callbacks at scrape time.'''
+    writer, _ = _writer(monkeypatch, [
+        [{"message_id": "a", "status": "ok"}, {"message_id": "b", "status": "error", "code": 503}],
+    ])
+    writer.metrics = WriterMetrics("test")
+    writer.disk = DiskQueue(str(tmp_path / "queue.log"))
+    writer.disk.append([{"message_id": "a"}, {"message_id": "b"}])
+
+    writer._flush(deadline=time.monotonic() + 0.5)
+
+    assert REGISTRY.get_sample_value("batch_writer_queue_records", {"shard": "test"}) == 1
+    assert REGISTRY.get_sample_value("batch_writer_queue_bytes", {"shard": "test"}) == writer.disk.pending_bytes()
+    assert REGISTRY.get_sample_value("batch_writer_batch_size", {"shard": "test"}) == writer.batch_size.value
+
+
+def test_disk_errors_do_not_raise(monkeypatch):
+
+    '''Test that a failing disk (volume full) sends the record to the error topic instead of raising.'''
+    writer, _ = _writer(monkeypatch, [])
+
+    class FullDisk:
+        def append(self, records):
+            raise OSError(28, "No space left on device")
+
+    writer.disk = FullDisk()
+    writer.add({"normal_record": {"message_id": "a"}, "alerts": []})
+
+    assert writer.write_errors == 1
+    kind, dead_letter = writer.publisher.queue.get_nowait()
+    assert kind == "dead" and dead_letter["reason"].startswith("disk_write_failed")
+
+
+def test_bulk_add_reports_duplicates_and_disk_errors(tmp_path, monkeypatch):
+
+    '''Test that add_many returns the outcome of every result: written, duplicate or disk_write_failed.'''
+    writer, _ = _writer(monkeypatch, [])
+    writer.disk = DiskQueue(str(tmp_path / "queue.log"))
+    results = [{"normal_record": {"message_id": "a"}, "alerts": []}, {"normal_record": {"message_id": "b"}, "alerts": []}]
+
+    assert writer.add_many(results[:1]) == [None]
+    assert writer.add_many(results) == ["duplicate", None]
+
+    def full_disk(records):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(writer.disk, "append", full_disk)
+    assert writer.add_many([{"normal_record": {"message_id": "c"}, "alerts": []}]) == ["disk_write_failed"]
+
+
+def test_unformattable_record_is_dead_lettered_alone(monkeypatch):
+
+    '''Test that a record whose time can not be formatted does not fail the rest of its batch.'''
+    writer, posted = _writer(monkeypatch, [
+        [{"message_id": "a", "status": "ok"}, {"message_id": "c", "status": "ok"}],
+    ])
+
+    done = writer._send_with_retry_batch([{"message_id": "a"}, {"message_id": "b", "time": 10 ** 20},
+                                          {"message_id": "c"}])
+
+    assert sorted(r["message_id"] for r in done) == ["a", "b", "c"]
+    assert len(posted) == 1 and '"b"' not in posted[0]
+    assert writer.publisher.queue.qsize() == 1
+
+
+def test_start_and_stop_are_idempotent(tmp_path, monkeypatch):
+
+    '''Test that a second start keeps the flusher thread and stop before start or twice does nothing.'''
+    monkeypatch.setattr(BatchWriter, "_is_db_alive", lambda self, timeout=3: False)
+    writer = BatchWriter(queue_file=str(tmp_path / "queue.log"), dead_letter_file=str(tmp_path / "dead.log"))
+
+    assert writer.stop() == 0
+    writer.start()
+    thread = writer.disk_thread
+    writer.start()
+
+    assert writer.disk_thread is thread
+    assert writer.stop(drain_timeout=1) == 0
+    assert not thread.is_alive()
+    assert writer.stop() == 0
+
+
+def test_stop_drains_the_backlog_within_the_deadline(tmp_path, monkeypatch):
+
+    '''Test that stop uploads the disk backlog and no request waits longer than the drain timeout.'''
+    timeouts = []
+
+    def fake_post(url, data, headers, timeout):
+        timeouts.append(timeout)
+        return FakeResponse([{"message_id": r["message_id"], "status": "ok"} for r in json.loads(data)])
+
+    monkeypatch.setattr(bw.requests, "post", fake_post)
+    monkeypatch.setattr(bw, "FLUSH_INTERVAL", 3600)
+    monkeypatch.setattr(BatchWriter, "_is_db_alive", lambda self, timeout=3: True)
+    monkeypatch.setattr(BatchWriter, "_benthos_headers", lambda self: {})
+    writer = BatchWriter(queue_file=str(tmp_path / "queue.log"), dead_letter_file=str(tmp_path / "dead.log"))
+    writer.start()
+    writer.add_many([{"normal_record": {"message_id": f"m{i}"}, "alerts": []} for i in range(12)])
+
+    assert writer.stop(drain_timeout=2) == 0
+    assert timeouts and max(timeouts) <= 2
+
+
+def test_stop_interrupts_the_flusher_retries(tmp_path, monkeypatch):
+
+    '''Test that stop does not wait for the retry delay of the flusher thread and still drains the backlog.'''
+    failing = threading.Event()
+
+    def fake_post(url, data, headers, timeout):
+        if not failing.is_set():
+            failing.set()
+            raise bw.requests.ConnectionError("down")
+        return FakeResponse([{"message_id": r["message_id"], "status": "ok"} for r in json.loads(data)])
+
+    monkeypatch.setattr(bw.requests, "post", fake_post)
+    monkeypatch.setattr(bw, "FLUSH_INTERVAL", 0.01)
+    monkeypatch.setattr(bw, "BASE_DELAY", 60)
+    monkeypatch.setattr(bw, "MAX_DELAY", 60)
+    monkeypatch.setattr(BatchWriter, "_is_db_alive", lambda self, timeout=3: True)
+    monkeypatch.setattr(BatchWriter, "_benthos_headers", lambda self: {})
+    writer = BatchWriter(queue_file=str(tmp_path / "queue.log"), dead_letter_file=str(tmp_path / "dead.log"))
+    writer.start()
+    writer.add({"normal_record": {"message_id": "a"}, "alerts": []})
+    assert failing.wait(5)
+
+    started = time.monotonic()
+    assert writer.stop(drain_timeout=5) == 0
+    assert time.monotonic() - started < 5
+    assert not writer.disk_thread.is_alive()
+
+
+def test_listener_uses_the_writer_it_is_given(monkeypatch):
+
+    '''Test that the MQTT callbacks add the messages to the writer passed to the listener, not the global one.'''
+    from mqtt import listener
+
+    writer = BatchWriter()
+    added = []
+    monkeypatch.setattr(writer, "add", added.append)
+    monkeypatch.setattr(listener.edge_processor, "process_payload",
+                        lambda payload: ({"normal_record": {"message_id": "a"}, "alerts": []}, None))
+    client = listener.create_client(writer)
+
+    class Message:
+        topic = "sensors/bat_1"
+        payload = b'{"sensor": "bat_1", "value": 50}'
+
+    assert client.user_data_get()["batch_writer"] is writer
+    listener.on_message(client, client.user_data_get(), Message())
+    assert added == [{"normal_record": {"message_id": "a"}, "alerts": []}]
@@ -1,127 +1,100 @@
-import pytest
+import re
+
 import yaml
 
+from core.benthos_config import SHARED_SETTINGS, build_config, render, retry_budget
+
+BENTHOS_FILE = "core/benthos.yaml"
+
+
+def load_live():
+    with open(BENTHOS_FILE, "r") as f:
+        return f.read()
+
+
+def test_benthos_yaml_is_generated():
+    # The live file must be regenerated after any change of core/benthos_config.py
+    assert load_live() == render()
+    assert yaml.safe_load(load_live()) == build_config()
+
 
 def test_bento_yaml_pipeline():
 
-    # -------------------------
-    # Load YAML
-    # -------------------------
-    with open("tests/test_bento.yml", "r") as f:
-        data = yaml.safe_load(f)
+    data = yaml.safe_load(load_live())
 
     # -------------------------
     # Validate HTTP service
     # -------------------------
-    assert "http" in data
-    assert "address" in data["http"]
     assert data["http"]["address"] == "0.0.0.0:4197"
 
     # -------------------------
     # Validate input
     # -------------------------
-    assert "input" in data
-    assert "http_server" in data["input"]
-
     http_input = data["input"]["http_server"]
 
-    assert "path" in http_input
     assert http_input["path"] == "/ingest"
-
-    assert "allowed_verbs" in http_input
     assert "POST" in http_input["allowed_verbs"]
+    assert "sync_response" in http_input
 
     # -------------------------
     # Validate pipeline
     # -------------------------
-    assert "pipeline" in data
-    assert "processors" in data["pipeline"]
-
     processors = data["pipeline"]["processors"]
-    assert len(processors) >= 2
 
     # Processor 1 -> unarchive
-    assert "unarchive" in processors[0]
     assert processors[0]["unarchive"]["format"] == "json_array"
 
     # Processor 2 -> mapping
-    assert "mapping" in processors[1]
-
     mapping_script = processors[1]["mapping"]
 
     assert "meta collection" in mapping_script
     assert "this._collection" in mapping_script
     assert "root = this.without" in mapping_script
 
-    # -------------------------
-    # Validate output
-    # -------------------------
-    assert "output" in data
-    assert "switch" in data["output"]
-
-    switch = data["output"]["switch"]
+    # Processor 3 -> one POST per record to its collection
+    http = processors[2]["http"]
 
-    assert "cases" in switch
-    cases = switch["cases"]
+    assert http["verb"] == "POST"
+    assert '/api/collections/${! meta("collection") }/records' in http["url"]
+    assert "Content-Type" in http["headers"]
+    assert "Authorization" in http["headers"]
+    assert http["parallel"] is True
+    assert http["rate_limit"] in [r["label"] for r in data["rate_limit_resources"]]
 
-    assert len(cases) >= 2
+    # Per-record outcomes, packed back into one response
+    assert "root.status" in processors[3]["mapping"]
+    assert "catch" in processors[4]
+    assert processors[-1]["archive"]["format"] == "json_array"
 
     # -------------------------
-    # Validate readings case
+    # Validate output
     # -------------------------
-    readings_case = cases[0]
+    assert "sync_response" in data["output"]
 
-    assert "check" in readings_case
-    assert "readings" in readings_case["check"]
 
-    readings_output = readings_case["output"]
-    assert "http_client" in readings_output
+def test_benthos_settings_shared_with_batch_writer():
+    data = yaml.safe_load(load_live())
+    http = data["pipeline"]["processors"][2]["http"]
 
-    http_client = readings_output["http_client"]
+    # Same retry policy variables as the BatchWriter
+    assert http["retry_period"] == "${BASE_DELAY:%s}s" % SHARED_SETTINGS["BASE_DELAY"]
+    assert http["max_retry_backoff"] == "${MAX_DELAY:%s}s" % SHARED_SETTINGS["MAX_DELAY"]
+    assert data["input"]["http_server"]["timeout"] == "${BENTHOS_TIMEOUT:%s}s" % SHARED_SETTINGS["BENTHOS_TIMEOUT"]
 
-    assert http_client["verb"] == "POST"
-    assert "url" in http_client
-    assert "/readings/records" in http_client["url"]
+    # Every environment reference has a default, so Benthos starts with an incomplete .env
+    content = load_live()
+    for name in re.findall(r"\$\{([A-Z_]+)\}", content):
+        assert name == "POCKETBASE_TOKEN"
 
-    assert "headers" in http_client
-    assert "Content-Type" in http_client["headers"]
 
-    # -------------------------
-    # Validate urgent_alerts case
-    # -------------------------
-    alerts_case = cases[1]
+def test_benthos_retries_fit_in_the_batch_timeout():
+    http = yaml.safe_load(load_live())["pipeline"]["processors"][2]["http"]
 
-    assert "check" in alerts_case
-    assert "urgent_alerts" in alerts_case["check"]
+    # Records rejected by PocketBase are reported at once, without retries
+    assert http["drop_on"] == [400, 404, 422]
+    assert http["timeout"] == "${BENTHOS_REQUEST_TIMEOUT:%s}s" % SHARED_SETTINGS["BENTHOS_REQUEST_TIMEOUT"]
 
-    alerts_output = alerts_case["output"]
-    assert "http_client" in alerts_output
-
-    http_client = alerts_output["http_client"]
-
-    assert http_client["verb"] == "POST"
-    assert "url" in http_client
-    assert "/urgent_alerts/records" in http_client["url"]
-
-    assert "headers" in http_client
-    assert "Content-Type" in http_client["headers"]
-
-    # -------------------------
-    # Validate example input format
-    # -------------------------
-    example_input = [
-        {
-            "message_id": "abc",
-            "_collection": "readings",
-            "sensor": "sensor1",
-            "value": 25.5,
-            "time": "2026-03-04T12:00:00Z"
-        }
-    ]
-
-    msg = example_input[0]
-
-    assert "_collection" in msg
-    assert "sensor" in msg
-    assert "value" in msg
-    assert "time" in msg
\ No newline at end of file
+    # Every attempt of a record plus its backoff ends before the http_server timeout (no whole-batch 408)
+    assert retry_budget() < SHARED_SETTINGS["BENTHOS_TIMEOUT"]
+    slow = {**SHARED_SETTINGS, "BENTHOS_RETRIES": 3, "BENTHOS_REQUEST_TIMEOUT": 5}
+    assert retry_budget(slow) > SHARED_SETTINGS["BENTHOS_TIMEOUT"]
@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+import core.disk_queue as dq
+from core.disk_queue import DiskQueue
+
+
+def _records(start, stop):
+    return [{"message_id": str(i), "value": i} for i in range(start, stop)]
+
+
+def _ids(records):
+    return [r["message_id"] for r in records]
+
+
+def test_ack_moves_the_head(tmp_path):
+
+    '''Test that acked records are skipped without rewriting the log, and the queue empties the files at the end.'''
+    queue = DiskQueue(str(tmp_path / "queue.log"))
+    queue.append(_records(0, 5))
+
+    assert _ids(queue.read(2)) == ["0", "1"]
+    queue.ack(2)
+    assert queue.count() == 3
+    assert _ids(queue.read()) == ["2", "3", "4"]
+    assert _ids(queue.tail(2)) == ["3", "4"]
+
+    queue.ack(3)
+    assert queue.count() == 0
+    assert os.path.getsize(queue.file_path) == 0
+
+
+def test_recovery_keeps_the_acked_position(tmp_path):
+
+    '''Test that a reopened queue starts from the last acked record.'''
+    path = str(tmp_path / "queue.log")
+    queue = DiskQueue(path)
+    queue.append(_records(0, 4))
+    queue.ack(1)
+    # Appended after the last manifest write, only in the log and the index
+    queue.append(_records(4, 6))
+
+    recovered = DiskQueue(path)
+    assert recovered.count() == 5
+    assert _ids(recovered.read()) == ["1", "2", "3", "4", "5"]
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+
+    '''Test that a crash in the middle of a write (line without index entry and without end) is truncated.'''
+    path = str(tmp_path / "queue.log")
+    queue = DiskQueue(path)
+    queue.append(_records(0, 3))
+    queue.ack(1)
+    with open(path, "ab") as f:
+        f.write(b'{"message_id": "3", "value": 3}\n{"message_id": "4", "va')
+
+    recovered = DiskQueue(path)
+    # The complete line without index entry is recovered, the torn one is dropped
+    assert _ids(recovered.read()) == ["1", "2", "3"]
+    recovered.append(_records(5, 6))
+    assert _ids(DiskQueue(path).read()) == ["1", "2", "3", "5"]
+
+
+def test_log_without_sidecars_is_indexed(tmp_path):
+
+    '''Test that a queue file of the old format (no index nor manifest) is fully pending.'''
+    path = tmp_path / "queue.log"
+    path.write_text('{"message_id": "a"}\n{"message_id": "b"}\n')
+
+    queue = DiskQueue(str(path))
+    assert _ids(queue.read()) == ["a", "b"]
+    assert os.path.exists(queue.index_path) and os.path.exists(queue.manifest_path)
+
+
+def test_compaction_drops_acked_records(tmp_path, monkeypatch):
+
+    '''Test that the acked part of the log is removed once it is big enough, and the queue still recovers.'''
+    monkeypatch.setattr(dq, "QUEUE_COMPACT_BYTES", 100)
+    path = str(tmp_path / "queue.log")
+    queue = DiskQueue(path)
+    queue.append(_records(0, 20))
+    size = os.path.getsize(path)
+
+    queue.ack(15)
+    assert os.path.getsize(path) < size / 2
+    assert _ids(queue.read()) == [str(i) for i in range(15, 20)]
+    assert _ids(DiskQueue(path).read()) == [str(i) for i in range(15, 20)]
+
+
+def test_corrupt_lines_in_the_middle_keep_the_records_after_them(tmp_path):
+
+    '''Test that a corrupt or blank line before valid records is skipped, not truncated as a torn tail.'''
+    path = tmp_path / "queue.log"
+    path.write_text('{"message_id": "a"}\n{bad\n{"message_id": "b"}\n\n{"message_id": "c"}\n')
+
+    queue = DiskQueue(str(path))
+    assert _ids(queue.read()) == ["a", "b", "c"]
+    queue.ack(1)
+    queue.append(_records(0, 1))
+    assert _ids(DiskQueue(str(path)).read()) == ["b", "c", "0"]
+
+
+class _FailingFile:
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        raise OSError(28, "No space left on device")
+
+    def close(self):
+        self.f.close()
+
+
+def test_failed_append_leaves_the_queue_as_it_was(tmp_path):
+
+    '''Test that an append that fails after writing the log is undone, so memory and files stay in sync.'''
+    path = str(tmp_path / "queue.log")
+    queue = DiskQueue(path)
+    queue.append(_records(0, 2))
+    size = os.path.getsize(path)
+    queue._files()
+    queue._index = _FailingFile(queue._index)
+
+    with pytest.raises(OSError):
+        queue.append(_records(2, 4))
+
+    assert queue.count() == 2 and os.path.getsize(path) == size
+    queue.append(_records(4, 5))
+    assert _ids(queue.read()) == ["0", "1", "4"]
+    assert _ids(DiskQueue(path).read()) == ["0", "1", "4"]
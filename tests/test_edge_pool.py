@@ -0,0 +1,75 @@
+import threading
+
+from core.edge_pool import EdgePool, worker_for
+from core.edge_proccesor import BATTERY_ID, TEMP_ID
+
+
+def test_worker_for_is_stable():
+
+    '''Test that a sensor always goes to the same worker.'''
+    assert worker_for("sensor-a", 4) == worker_for("sensor-a", 4)
+    assert 0 <= worker_for("sensor-b", 4) < 4
+    assert worker_for(None, 4) == worker_for("", 4)
+
+
+def test_results_keep_the_order_of_every_sensor():
+
+    '''Test that the worker processes return every result, in order for each sensor, in micro-batches.'''
+    delivered = []
+    lock = threading.Lock()
+
+    def handler(items):
+        with lock:
+            delivered.append(items)
+
+    pool = EdgePool(workers=2, batch=8, wait=0.01).start(handler)
+    for i in range(50):
+        pool.submit("devices/agv1/readings", {"sensor": BATTERY_ID, "value": 50, "message_id": f"b{i}"})
+        pool.submit("devices/agv1/readings", {"sensor": TEMP_ID, "value": 20, "message_id": f"t{i}"})
+    pool.submit("devices/agv1/readings", {"sensor": BATTERY_ID})
+    pool.stop()
+
+    items = [item for batch in delivered for item in batch]
+    assert len(items) == 101
+    assert all(len(batch) <= 8 for batch in delivered)
+
+    ids = [result["normal_record"]["message_id"] for _, _, result, _ in items if result]
+    assert [i for i in ids if i.startswith("b")] == [f"b{i}" for i in range(50)]
+    assert [i for i in ids if i.startswith("t")] == [f"t{i}" for i in range(50)]
+
+    rejected = [(payload, reason) for _, payload, result, reason in items if not result]
+    assert rejected == [({"sensor": BATTERY_ID}, "missing_value")]
+
+
+def test_bulk_ingestion_and_statistics_run_in_the_workers(monkeypatch):
+
+    '''Test that process_batch answers in order from the workers and the statistics come from the sensor owner.'''
+    monkeypatch.setenv("BATTERY_ID", "bat_1")
+    pool = EdgePool(workers=2, batch=8, wait=0.01).start(lambda items: None)
+    try:
+        payloads = [{"sensor": "bat_1", "value": 40 + i} for i in range(5)] + [None, {"sensor": "bat_1"}]
+        answers = pool.process_batch(payloads)
+
+        assert [reason for _, reason in answers] == [None] * 5 + ["not_an_object", "missing_value"]
+        assert [result["normal_record"]["value"] for result, _ in answers[:5]] == [40, 41, 42, 43, 44]
+        # The payloads get their message_id, as in the service process
+        assert payloads[0]["message_id"] == answers[0][0]["normal_record"]["message_id"]
+        assert pool.sensor_stats("bat_1")["count"] == 5
+        assert pool.sensor_stats("nobody") is None
+    finally:
+        pool.stop()
+
+
+def test_dead_worker_rejects_instead_of_blocking():
+
+    '''Test that payloads for a dead worker go to the handler as rejected instead of blocking submit().'''
+    delivered = []
+    pool = EdgePool(workers=1, batch=1, wait=0.01, queue_size=1).start(delivered.extend)
+    pool.processes[0].terminate()
+    pool.processes[0].join()
+
+    pool.submit("devices/agv1/readings", {"sensor": BATTERY_ID, "value": 50})
+    pool.stop(timeout=1)
+
+    assert delivered == [("devices/agv1/readings", {"sensor": BATTERY_ID, "value": 50}, None, "edge_worker_unavailable")]
+    assert pool.rejected == 1
@@ -0,0 +1,78 @@
+import core.edge_proccesor as edge
+from core.edge_proccesor import EdgeProcessor
+
+
+def test_process_batch_returns_one_result_per_payload(monkeypatch):
+
+    '''Test that the batch path completes, processes and rejects every payload in order.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    processor = EdgeProcessor()
+
+    results = processor.process_batch([
+        {"sensor": "bat_1", "value": 50},
+        {"sensor": "bat_1"},
+        {"sensor": "bat_1", "value": None},
+    ])
+
+    (ok, reason), (missing, missing_reason), (null, null_reason) = results
+    assert reason is None
+    assert ok["normal_record"]["type"] == "battery"
+    assert ok["normal_record"]["message_id"]
+    assert missing is None and missing_reason == "missing_value"
+    assert null is None and null_reason == "missing_value"
+
+
+def test_invalid_payloads_are_rejected_at_the_edge(monkeypatch):
+
+    '''Test that payloads that do not match the schema are rejected with their reason and values are coerced.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    monkeypatch.setitem(edge.SENSOR_TYPES, "sta_1", "status")
+    processor = EdgeProcessor()
+
+    reasons = [reason for _, reason in processor.process_batch([
+        {"value": 50},
+        {"sensor": "bat_1", "value": "abc"},
+        {"sensor": "bat_1", "value": True},
+        {"sensor": "sta_1", "value": 1.5},
+        {"sensor": "nobody", "value": 1},
+        {"sensor": "bat_1", "value": 50, "timestamp": {}},
+    ])]
+    assert reasons == [
+        "missing_sensor", "invalid_value", "invalid_value", "invalid_value", "unknown_sensor", "invalid_timestamp"
+    ]
+
+    result, reason = processor.process_payload({"sensor": "sta_1", "value": "2"})
+    assert reason is None
+    assert result["normal_record"]["value"] == 2
+
+
+def test_non_finite_and_out_of_range_timestamps_are_rejected(monkeypatch):
+
+    '''Test that timestamps that can not be converted to epoch milliseconds are rejected at the edge.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    processor = EdgeProcessor()
+
+    reasons = [reason for _, reason in processor.process_batch([
+        {"sensor": "bat_1", "value": 50, "timestamp": float("nan")},
+        {"sensor": "bat_1", "value": 50, "timestamp": float("inf")},
+        {"sensor": "bat_1", "value": 50, "timestamp": 1e300},
+        {"sensor": "bat_1", "value": 50, "timestamp": -1},
+        {"sensor": "bat_1", "value": 50, "timestamp": 1_700_000_000},
+    ])]
+    assert reasons == ["invalid_timestamp"] * 4 + [None]
+
+
+def test_string_timestamps_are_parsed_by_the_validator(monkeypatch):
+
+    '''Test that ISO timestamps reach the records as epoch ms and text that is not a date is rejected.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    processor = EdgeProcessor()
+
+    results = processor.process_batch([
+        {"sensor": "bat_1", "value": 50, "timestamp": "2026-03-04T12:00:00Z"},
+        {"sensor": "bat_1", "value": 50, "timestamp": "yesterday"},
+        {"sensor": "bat_1", "value": 50, "timestamp": "0001-01-01T00:00:00"},
+    ])
+
+    assert results[0][0]["normal_record"]["time"] == 1_772_625_600_000
+    assert [reason for _, reason in results] == [None, "invalid_timestamp", "invalid_timestamp"]
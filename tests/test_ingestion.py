@@ -1,4 +1,23 @@
-from core.utils import fahrenheit_a_celsius, enrich_message
+import asyncio
+import json
+
+import pytest
+from bentoml.exceptions import BadInput
+
+import core.edge_proccesor as edge
+from api.service import INGEST_TOPIC, MQTTService, parse_ingest_body
+from core.edge_proccesor import EdgeProcessor
+from core.state_cache import FleetState
+from core.utils import (
+    RecentIds,
+    enrich_message,
+    fahrenheit_a_celsius,
+    format_times,
+    message_id_ms,
+    new_message_id,
+    now_ms,
+    parse_timestamp_ms,
+)
 
 
 def test_fahrenheit_to_celsius_exact():
@@ -20,3 +39,125 @@ def test_mapping_does_not_lose_information():
 
     assert "message_id" in msg
     assert "ingestion_timestamp" in msg
+
+
+def test_message_ids_are_time_ordered():
+
+    '''Test that generated message_ids are unique, sorted by creation and carry their creation time.'''
+    ids = [new_message_id() for _ in range(5000)]
+
+    assert len(set(ids)) == len(ids)
+    assert ids == sorted(ids)
+    assert abs(message_id_ms(ids[-1]) - now_ms()) < 1000
+    assert message_id_ms("c2c9c1c2-8b7e-4b0c-9e5c-8c4d3b1c6f1a") is None
+
+
+def test_timestamps_are_epoch_ms_until_the_sink():
+
+    '''Test that device timestamps are parsed once to epoch ms and formatted back as ISO for the sink.'''
+    ms = parse_timestamp_ms("2026-03-04T12:00:00Z")
+
+    assert ms == parse_timestamp_ms(ms) == parse_timestamp_ms(ms / 1000)
+    assert format_times({"time": ms, "value": 1}) == {"time": "2026-03-04T12:00:00.000Z", "value": 1}
+
+
+def test_dedup_window_is_bounded():
+
+    '''Test that the dedup window detects duplicates and forgets the oldest ids.'''
+    window = RecentIds(2)
+
+    assert window.add("a") and window.add("b")
+    assert not window.add("b")
+    assert window.add("c")
+    assert "a" not in window and len(window) == 2
+
+
+class FakePublisher:
+
+    def __init__(self):
+        self.dead_letters = []
+
+    def publish_dead_letter(self, record, reason):
+        self.dead_letters.append((record, reason))
+
+    def publish_alert(self, alert):
+        pass
+
+
+class FakeWriter:
+
+    def __init__(self, outcomes=None):
+        self.publisher = FakePublisher()
+        self.added = []
+        self.outcomes = outcomes
+
+    def add_many(self, results):
+        self.added.extend(results)
+        return self.outcomes or [None] * len(results)
+
+
+class FakeRequest:
+
+    def __init__(self, body, content_type):
+        self.body_bytes = body
+        self.headers = {"content-type": content_type}
+
+    async def body(self):
+        return self.body_bytes
+
+
+class FakeContext:
+
+    def __init__(self, body, content_type="application/json"):
+        self.request = FakeRequest(body, content_type)
+
+
+def _service(writer):
+    service = MQTTService.inner.__new__(MQTTService.inner)
+    service.edge_processor = EdgeProcessor()
+    service.edge_pool = None
+    service.state = FleetState()
+    service.batch_writer = writer
+    return service
+
+
+def test_rejected_bulk_payloads_are_dead_lettered(monkeypatch):
+
+    '''Test that the bulk ingestion sends rejected payloads to the error topic, like the MQTT listener.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    service = _service(FakeWriter())
+    body = b'{"sensor": "bat_1", "value": 50}\n{"sensor": "bat_1"}\n\n{bad\n'
+
+    response = asyncio.run(service.ingest(FakeContext(body, "application/x-ndjson; charset=utf-8")))
+
+    assert response["accepted"] == 1 and response["rejected"] == 2
+    assert len(service.batch_writer.added) == 1
+    assert service.batch_writer.publisher.dead_letters == [
+        ({"topic": INGEST_TOPIC, "payload": {"sensor": "bat_1"}}, "invalid: missing_value"),
+        ({"topic": INGEST_TOPIC, "payload": "{bad"}, "invalid: invalid_json"),
+    ]
+
+
+def test_bulk_items_report_the_outcome_of_the_disk_append(monkeypatch):
+
+    '''Test that a JSON array body is ingested and every item reports a duplicate or a failed disk append.'''
+    monkeypatch.setitem(edge.SENSOR_TYPES, "bat_1", "battery")
+    service = _service(FakeWriter(outcomes=[None, "duplicate", "disk_write_failed"]))
+    readings = [{"sensor": "bat_1", "value": v, "message_id": f"m{v}"} for v in (50, 51, 52)]
+
+    response = asyncio.run(service.ingest(FakeContext(json.dumps(readings).encode())))
+
+    assert [(item["status"], item["reason"]) for item in response["items"]] == [
+        ("accepted", None), ("duplicate", "duplicate"), ("failed", "disk_write_failed"),
+    ]
+    assert (response["accepted"], response["duplicates"], response["failed"]) == (1, 1, 1)
+
+
+def test_bulk_body_must_be_a_json_array():
+
+    '''Test that a JSON body that is not an array (or not JSON) is refused as bad input.'''
+    assert parse_ingest_body(b"[]") == ([], {})
+    with pytest.raises(BadInput):
+        parse_ingest_body(b'{"readings": []}', "application/json")
+    with pytest.raises(BadInput):
+        parse_ingest_body(b'{"sensor": "bat_1"}\n{"sensor": "bat_2"}\n')
@@ -0,0 +1,91 @@
+import json
+import time
+
+import pytest
+
+from core.mqtt_publisher import MQTTPublisher
+
+
+class FakeInfo:
+    rc = 0
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+
+class FakeClient:
+
+    '''Minimal paho client that records the publishes.'''
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.published = []
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append((topic, json.loads(payload), qos))
+        return FakeInfo()
+
+
+def _wait_empty(publisher):
+    for _ in range(100):
+        if publisher.queue.empty():
+            break
+        time.sleep(0.01)
+
+
+def test_dead_letters_are_packed_in_envelopes(tmp_path):
+
+    '''Test that the dead letters of a failed batch are published in a few envelopes, not one by one.'''
+    client = FakeClient()
+    publisher = MQTTPublisher(client, spill_file=str(tmp_path / "dead.log"))
+    for n in range(50):
+        publisher.publish_dead_letter({"message_id": str(n)}, "max_retries_exceeded")
+
+    publisher.start()
+    _wait_empty(publisher)
+    publisher.stop()
+
+    records = [d["record"] for _, envelope, _ in client.published for d in envelope["dead_letters"]]
+    assert len(client.published) < 50
+    assert [r["message_id"] for r in records] == [str(n) for n in range(50)]
+
+
+def test_dead_letters_are_spilled_and_replayed(tmp_path):
+
+    '''Test that dead letters go to the spill file when the broker is down and can be replayed later.'''
+    client = FakeClient(connected=False)
+    publisher = MQTTPublisher(client, spill_file=str(tmp_path / "dead.log"))
+    publisher.start()
+    publisher.publish_dead_letter({"message_id": "a"}, "max_retries_exceeded")
+    _wait_empty(publisher)
+    publisher.stop()
+
+    assert client.published == []
+    assert publisher.spill.count() == 1
+
+    client.connected = True
+    assert publisher.replay() == 1
+    assert publisher.spill.count() == 0
+    assert client.published[0][1]["dead_letters"][0]["record"]["message_id"] == "a"
+
+
+def test_replay_is_refused_while_the_service_owns_the_spill_file(tmp_path):
+
+    '''Test that the replay tool can not use a spill file held by a running publisher, and can after stop.'''
+    spill_file = str(tmp_path / "dead.log")
+    service = MQTTPublisher(FakeClient(connected=False), spill_file=spill_file)
+    service.start()
+    service.publish_dead_letter({"message_id": "a"}, "max_retries_exceeded")
+    _wait_empty(service)
+    tool = MQTTPublisher(FakeClient(connected=True), spill_file=spill_file)
+
+    with pytest.raises(RuntimeError):
+        tool.replay()
+    service.stop()
+
+    assert tool.replay() == 1
@@ -0,0 +1,112 @@
+import os
+import threading
+
+from core.disk_queue import DiskQueue
+from core.retention import Retention, downsample
+
+NOW = 1_000_000_000
+
+
+def _reading(i, sensor="s1", value=None, age=0):
+    return {
+        "message_id": f"r{i}",
+        "_collection": "readings",
+        "sensor": sensor,
+        "type": "battery",
+        "value": i if value is None else value,
+        "time": NOW - age * 1000,
+        "ingestion_timestamp": NOW - age * 1000,
+    }
+
+
+def _alert(i, age=0):
+    return {"message_id": f"a{i}", "_collection": "urgent_alerts", "sensor": "s1", "ingestion_timestamp": NOW - age * 1000}
+
+
+def _retention(**limits):
+    return Retention(keep=lambda record: record["_collection"] == "urgent_alerts", **limits)
+
+
+def test_drop_oldest_keeps_urgent_alerts(tmp_path):
+
+    '''Test that over the record limit the oldest readings are dropped but the alerts are kept.'''
+    queue = DiskQueue(str(tmp_path / "queue.log"))
+    queue.append([_alert(0), *(_reading(i) for i in range(10)), _alert(1)])
+    retention = _retention(max_records=5)
+
+    retention.enforce(queue, threading.Lock(), now=NOW)
+
+    ids = [r["message_id"] for r in queue.read()]
+    assert len(ids) == 5
+    assert "a0" in ids and "a1" in ids
+    assert ids[:3] == ["r7", "r8", "r9"]
+    assert retention.dropped == 7
+
+
+def test_age_limit_stops_at_recent_records(tmp_path):
+
+    '''Test that only the readings older than the age limit are dropped.'''
+    queue = DiskQueue(str(tmp_path / "queue.log"))
+    queue.append([_reading(0, age=120), _reading(1, age=90), _reading(2, age=10)])
+
+    _retention(max_age=60).enforce(queue, threading.Lock(), now=NOW)
+
+    assert [r["message_id"] for r in queue.read()] == ["r2"]
+
+
+def test_downsample_aggregates_old_readings(tmp_path):
+
+    '''Test that old readings are replaced by one aggregate per sensor and bucket.'''
+    queue = DiskQueue(str(tmp_path / "queue.log"))
+    queue.append([_reading(i, value=v, age=300) for i, v in enumerate((10, 20, 30))])
+    queue.append([_reading(3, sensor="s2", value=5, age=300), _reading(4, age=0)])
+    retention = _retention(max_age=60, policy="downsample", bucket=600)
+
+    retention.enforce(queue, threading.Lock(), now=NOW)
+
+    records = queue.read()
+    assert [r["message_id"] for r in records] == ["r4", "r2", "r3"]
+    aggregate = records[1]
+    assert aggregate["value"] == 20 and aggregate["min"] == 10 and aggregate["max"] == 30
+    assert aggregate["samples"] == 3
+    assert retention.downsampled == 4
+    # The aggregates are not aggregated again until they are old again
+    assert retention.enforce(queue, threading.Lock(), now=NOW) == 0
+
+
+def test_downsample_merges_aggregates():
+
+    '''Test that aggregates of the same bucket are merged weighting their samples.'''
+    first = downsample([_reading(0, value=10), _reading(1, value=20)], 600, NOW)
+    merged = downsample(first + [_reading(2, value=60)], 600, NOW)
+
+    assert len(merged) == 1
+    assert merged[0]["value"] == 30 and merged[0]["samples"] == 3 and merged[0]["max"] == 60
+
+
+def test_downsample_keeps_the_last_value_of_categorical_readings():
+
+    '''Test that status and has_pallet readings are not averaged: the newest of every bucket is kept.'''
+    pallet = [{**_reading(i, sensor="p1", value=v), "type": "has_pallet", "time": NOW + i} for i, v in enumerate((0, 1, 1, 0))]
+    battery = [_reading(4, value=10), _reading(5, value=20)]
+
+    aggregates = {r["sensor"]: r for r in downsample(pallet + battery, 600, NOW)}
+
+    assert aggregates["p1"]["value"] == 0 and aggregates["p1"]["message_id"] == "r3"
+    assert aggregates["p1"]["samples"] == 4 and "min" not in aggregates["p1"]
+    assert aggregates["s1"]["value"] == 15 and aggregates["s1"]["samples"] == 2
+
+
+def test_kept_records_over_the_limit_are_not_rewritten(tmp_path):
+
+    '''Test that a queue over the limit because of urgent alerts alone is left as it is.'''
+    queue = DiskQueue(str(tmp_path / "queue.log"))
+    queue.append([_alert(0), _alert(1), _reading(0), _alert(2), _reading(1)])
+    retention = _retention(max_records=2)
+
+    assert retention.enforce(queue, threading.Lock(), now=NOW) == 2
+    size = os.path.getsize(queue.file_path)
+
+    assert retention.enforce(queue, threading.Lock(), now=NOW) == 0
+    assert os.path.getsize(queue.file_path) == size
+    assert [r["message_id"] for r in queue.read()] == ["a0", "a1", "a2"]
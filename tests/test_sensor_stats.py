@@ -0,0 +1,99 @@
+import statistics
+
+import pytest
+
+import core.edge_proccesor as edge
+from core.edge_proccesor import EdgeProcessor
+from core.sensor_stats import SensorStats
+
+
+def test_streaming_statistics_match_batch_statistics():
+
+    '''Test that the incremental mean/std/min/max match the values computed over all the readings.'''
+    values = [20.5, 21.0, 22.3, 19.8, 20.1, 25.0, 18.2]
+    stats = SensorStats(capacity=4, alpha=0.5, window=100)
+    for value in values:
+        stats.update("temp_1", value)
+
+    result = stats.get("temp_1")
+
+    assert result["count"] == len(values)
+    assert result["mean"] == pytest.approx(statistics.mean(values))
+    assert result["std"] == pytest.approx(statistics.stdev(values))
+    assert result["min"] == min(values) and result["max"] == max(values)
+
+
+def test_rolling_min_max_forgets_old_windows():
+
+    '''Test that the rolling min/max only cover the last one or two windows of readings.'''
+    stats = SensorStats(capacity=4, window=3)
+    for value in [100, 1, 1, 5, 5, 5, 6, 6, 6]:
+        stats.update("bat_1", value)
+
+    assert stats.get("bat_1")["max"] == 6
+    assert stats.get("bat_1")["min"] == 5
+
+
+def test_capacity_is_bounded():
+
+    '''Test that sensors over the capacity are not tracked.'''
+    stats = SensorStats(capacity=2)
+
+    assert stats.update("a", 1) is None
+    stats.update("b", 1)
+    stats.update("c", 1)
+
+    assert len(stats) == 2
+    assert stats.get("c") is None
+
+
+def test_anomaly_alert(monkeypatch):
+
+    '''Test that a reading far from the sensor history raises an anomaly alert.'''
+    monkeypatch.setattr(edge, "ANOMALY_DETECTION", True)
+    monkeypatch.setattr(edge, "ANOMALY_MIN_SAMPLES", 10)
+    monkeypatch.setattr(edge, "TEMP_THRESHOLD", 1000)
+    monkeypatch.setattr(edge, "TEMP_MAXIMUM_INVALID", 1000)
+    processor = EdgeProcessor()
+
+    for n in range(20):
+        result = processor.process_reading({"value": 20 + n % 3}, "temperature", "temp_1")
+        assert result["alerts"] == []
+
+    result = processor.process_reading({"value": 60}, "temperature", "temp_1")
+
+    assert [alert["type"] for alert in result["alerts"]] == ["anomaly"]
+    assert result["normal_record"]["value"] == 60
+
+
+def test_jump_from_a_flat_signal_is_an_anomaly(monkeypatch):
+
+    '''Test that a stuck sensor (std 0) that suddenly changes raises an anomaly alert, and the same value does not.'''
+    monkeypatch.setattr(edge, "ANOMALY_DETECTION", True)
+    monkeypatch.setattr(edge, "ANOMALY_MIN_SAMPLES", 10)
+    monkeypatch.setattr(edge, "TEMP_THRESHOLD", 1000)
+    monkeypatch.setattr(edge, "TEMP_MAXIMUM_INVALID", 1000)
+    processor = EdgeProcessor()
+
+    for _ in range(20):
+        result = processor.process_reading({"value": 20}, "temperature", "temp_1")
+        assert result["alerts"] == []
+
+    result = processor.process_reading({"value": 25}, "temperature", "temp_1")
+
+    assert [alert["type"] for alert in result["alerts"]] == ["anomaly"]
+
+
+def test_one_unit_step_of_a_quantized_sensor_is_not_an_anomaly(monkeypatch):
+
+    '''Test that a battery held at 80 that drops to 79 does not raise an anomaly alert (std floor ANOMALY_MIN_STD).'''
+    monkeypatch.setattr(edge, "ANOMALY_DETECTION", True)
+    monkeypatch.setattr(edge, "ANOMALY_MIN_SAMPLES", 10)
+    processor = EdgeProcessor()
+
+    for _ in range(40):
+        processor.process_reading({"value": 80}, "battery", "bat_1")
+    result = processor.process_reading({"value": 79}, "battery", "bat_1")
+
+    assert result["alerts"] == []
+    assert result["normal_record"]["value"] == 79
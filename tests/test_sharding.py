@@ -0,0 +1,41 @@
+from core.sharding import Shard, device_from_topic, shard_for
+
+
+def test_device_from_topic():
+
+    '''Test that the device id is taken from the devices/<id>/readings topic.'''
+    assert device_from_topic("devices/AGV_05/readings") == "AGV_05"
+    assert device_from_topic("other") == "other"
+
+
+def test_every_device_has_exactly_one_owner():
+
+    '''Test that each device is owned by one and only one shard.'''
+    shards = [Shard(index=i, count=4, shared_group=None) for i in range(4)]
+
+    for n in range(200):
+        topic = f"devices/AGV_{n}/readings"
+        owners = [s for s in shards if s.owns(topic)]
+        assert len(owners) == 1
+        assert owners[0].index == shard_for(f"AGV_{n}", 4)
+
+
+def test_shard_queue_file_and_subscription():
+
+    '''Test that each shard has its own queue file and the shared subscription topic.'''
+    assert Shard(0, 1, None).queue_file("/app/data/pending_readings.log") == "/app/data/pending_readings.log"
+    assert Shard(2, 4, None).queue_file("/app/data/pending_readings.log") == "/app/data/pending_readings.shard-2.log"
+
+    shared = Shard(1, 4, "bento")
+    assert shared.subscription("devices/+/readings") == "$share/bento/devices/+/readings"
+    assert shared.owns("devices/any/readings")
+
+
+def test_shared_subscription_gives_up_device_ownership():
+
+    '''Test that with a shared subscription every shard takes any device, so no shard owns a device.'''
+    shards = [Shard(index=i, count=2, shared_group="ingest") for i in range(2)]
+
+    assert all(s.owns("devices/AGV_1/readings") for s in shards)
+    assert not any(s.per_device for s in shards)
+    assert Shard(index=0, count=2, shared_group=None).per_device
@@ -0,0 +1,35 @@
+from core.state_cache import FleetState
+
+
+def test_snapshot_groups_last_value_by_device():
+
+    '''Test that the snapshot keeps only the last value of every sensor, grouped by device.'''
+    state = FleetState()
+    state.update("bat_1", "battery", 80, "2026-03-04T12:00:00Z", device="AGV_01")
+    state.update("sta_1", "status", 1, "2026-03-04T12:00:00Z", device="AGV_01")
+    state.update("bat_1", "battery", 79, "2026-03-04T12:00:05Z", device="AGV_01")
+
+    snapshot = state.snapshot()
+
+    assert len(state) == 2
+    assert snapshot["version"] == 3
+    assert snapshot["devices"]["AGV_01"]["battery"]["value"] == 79
+    assert snapshot["devices"]["AGV_01"]["status"]["value"] == 1
+
+
+def test_delta_returns_only_changes_since_version():
+
+    '''Test that the delta has only the sensors updated after the given version.'''
+    state = FleetState()
+    state.update("bat_1", "battery", 80, "t1")
+    state.update("sta_1", "status", 1, "t1")
+    version = state.version
+    state.update("bat_1", "battery", 79, "t2")
+
+    delta = state.delta(version)
+
+    assert delta["full"] is False
+    assert [s["sensor"] for s in delta["sensors"]] == ["bat_1"]
+    assert state.delta(state.version)["sensors"] == []
+    # A version newer than the cache (service restarted) returns everything
+    assert len(state.delta(version + 100)["sensors"]) == 2
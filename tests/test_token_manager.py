@@ -0,0 +1,43 @@
+import base64
+import json
+import threading
+import time
+
+from core.token_manager import TokenManager, jwt_expiry
+
+
+def _jwt(exp):
+    '''Unsigned JWT with the given expiry.'''
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def test_jwt_expiry():
+
+    '''Test that the expiry is read from the JWT payload.'''
+    assert jwt_expiry(_jwt(1772705154)) == 1772705154
+    assert jwt_expiry("not-a-jwt") is None
+
+
+def test_concurrent_refresh_is_single_flight(monkeypatch):
+
+    '''Test that many threads refreshing the same stale token make only one call to PocketBase.'''
+    manager = TokenManager(collection="users", identity="u", password="p", margin=60)
+    calls = []
+
+    def fake_auth():
+        calls.append(1)
+        time.sleep(0.05)
+        return _jwt(time.time() + 3600)
+
+    monkeypatch.setattr(manager, "_auth_with_password", fake_auth)
+    monkeypatch.setattr(manager, "_ensure_thread", lambda: None)
+
+    threads = [threading.Thread(target=manager.refresh, kwargs={"stale": None}) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert manager.get() == manager.token